@@ -2,15 +2,37 @@
 后端 API 服务 - 使用 DeepSeek API
 """
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-import json
 import os
-from openai import OpenAI
-from typing import List, Dict
+import tempfile
+from typing import Callable, List, Dict, Optional, Tuple
 import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from prompt_database import db
+from llm_gateway import LLMGateway, LLM_MAX_CONCURRENCY
+from llm_backends import load_backends
+from upstream_limits import SharedRateLimiter, UpstreamLimits, endpoint_priority
+from summary_cache import SummaryCache
+from document_summary import DocumentSummaryStore
+from generation_buffers import GenerationRegistry, GenerationStore, current_generation, parse_event_id
+from sse_encoder import StreamProfile, DEFAULT_PROFILE, iter_sse
+from prompt_templates import CompiledTemplate, compile_template, compile_prompt
+from prompt_vectors import PromptVectorIndex
+from background_jobs import BackgroundJobs
+from prompt_backup import iter_backup, restore_backup
+from catalog_cache import CatalogCache
+from single_flight import SingleFlight
+from response_cache import ResponseCache, CachedStream
+from context_budget import (ContextPart, allocate_context, completion_budget, count_tokens, log_token_usage,
+                            trim_to_tokens, PREVIOUS_CONTENT_SUMMARY_TOKENS, RECENT_CONTENT_TOKENS,
+                            SECTION_CONTEXT_TOKENS, SECTION_MAX_TOKENS)
+from metrics import (metrics, instrument_stream, LLM_COMPLETION_TOKENS, LLM_ERRORS, LLM_PROMPT_TOKENS,
+                     LLM_REQUEST_SECONDS, SUMMARY_SECONDS)
+from document_generation import (DocumentGeneration, parse_outline_sections,
+                                 DOCUMENT_MAX_PARALLEL, DOCUMENT_SEQUENTIAL_WINDOW)
 
 # 加载 .env 文件
 load_dotenv()
@@ -31,6 +53,7 @@ CORS(app,
 # 手动处理 OPTIONS 请求
 @app.before_request
 def handle_preflight():
+    g.request_started = time.perf_counter()  # 流式接口的首个文本片段时间从这里开始计算
     if request.method == "OPTIONS":
         response = app.make_default_options_response()
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -38,41 +61,325 @@ def handle_preflight():
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         return response
 
-# DeepSeek API 配置
-DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', '')
-DEEPSEEK_BASE_URL = "https://api.deepseek.com"
-DEEPSEEK_MODEL = "deepseek-chat"
+# 上游 LLM 后端：LLM_BACKENDS 按顺序配置多个 OpenAI 兼容后端（首 token 前失败或变慢时依次切换），
+# 未配置时使用 DEEPSEEK_API_KEY / DEEPSEEK_BASE_URL / DEEPSEEK_MODEL
+LLM_BACKENDS = load_backends()
 
 # 检查 API Key 是否配置
-if not DEEPSEEK_API_KEY:
-    print("=" * 60)
-    print("警告：DeepSeek API Key 未配置！")
-    print("请设置环境变量 DEEPSEEK_API_KEY")
-    print("=" * 60)
-
-client = OpenAI(
-    api_key=DEEPSEEK_API_KEY,
-    base_url=DEEPSEEK_BASE_URL
+for backend in LLM_BACKENDS:
+    if not backend.api_key:
+        print("=" * 60)
+        print(f"警告：LLM 后端 {backend.name} 的 API Key 未配置！")
+        print("请设置环境变量 DEEPSEEK_API_KEY（或在 LLM_BACKENDS 中配置 api_key / api_key_env）")
+        print("=" * 60)
+
+# 上游准入控制：按接口优先级排队、AIMD 自适应并发上限、所有 worker 共享的每分钟请求数 / token 数限制
+# （LLM_REQUESTS_PER_MINUTE / LLM_TOKENS_PER_MINUTE，状态存放在 prompts.db 同目录）；
+# 设置 LLM_ADAPTIVE_CONCURRENCY=false 时并发上限固定为 LLM_MAX_CONCURRENCY，排队和共享限流不受影响
+LLM_ADAPTIVE_CONCURRENCY = os.environ.get('LLM_ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+upstream_limits = UpstreamLimits(
+    SharedRateLimiter(os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'rate_limits.db')),
+    maximum=LLM_MAX_CONCURRENCY,
+    adaptive=LLM_ADAPTIVE_CONCURRENCY
 )
 
+# 异步网关：所有上游请求在后台事件循环中并发执行，共享连接池
+gateway = LLMGateway(
+    LLM_BACKENDS,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    limits=upstream_limits
+)
+
+
+# 请求合并：完全相同的请求同时进行时只调用一次上游，设置 LLM_SINGLE_FLIGHT=false 关闭
+LLM_SINGLE_FLIGHT = os.environ.get('LLM_SINGLE_FLIGHT', 'true').lower() == 'true'
+single_flight = SingleFlight()
+
+
+# 响应缓存：确定性较强的接口（章节提示词、自动生成提示词）按请求内容缓存完整结果，
+# 存放在 prompts.db 同目录；调用方通过 use_cache 启用，设置 RESPONSE_CACHE=false 全部关闭
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() == 'true'
+response_cache = ResponseCache(
+    os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'response_cache.db')
+) if RESPONSE_CACHE else None
+
+
+def call_deepseek(messages: List[Dict[str, str]], stream: bool, max_tokens: int, key: str, endpoint: str):
+    """调用上游；相同的请求同时进行时共享同一个上游调用"""
+    def on_usage(prompt_tokens, completion_tokens):
+        LLM_PROMPT_TOKENS.inc(prompt_tokens, endpoint=endpoint)
+        LLM_COMPLETION_TOKENS.inc(completion_tokens, endpoint=endpoint)
+    
+    params = dict(max_tokens=max_tokens, temperature=0.7, on_usage=on_usage, priority=endpoint_priority(endpoint))
+    if not LLM_SINGLE_FLIGHT:
+        if stream:
+            return gateway.stream(messages, **params)
+        return gateway.complete(messages, **params)
+    
+    if stream:
+        return single_flight.stream(key, lambda: gateway.stream(messages, **params))
+    
+    started = time.perf_counter()
+    result = single_flight.complete(key, lambda: gateway.complete(messages, **params))
+    LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    return result
+
 
-def query_deepseek(messages: List[Dict[str, str]], stream: bool = False, max_tokens: int = 4000):
-    """调用 DeepSeek API"""
+def cancellable(stream):
+    """在生成的后台线程中调用时，把流式结果登记到当前生成：生成被取消时立即关闭上游"""
+    generation = current_generation()
+    if generation is not None:
+        generation.on_cancel(stream.close)
+    return stream
+
+
+def query_deepseek(messages: List[Dict[str, str]], stream: bool = False, max_tokens: int = 4000,
+                   endpoint: str = 'other', use_cache: bool = False, bypass_cache: bool = False):
+    """调用 DeepSeek API
+
+    stream=True 时返回逐个产出文本片段的迭代器（可调用 close() 取消上游请求，
+    所在的生成被取消时自动关闭），否则返回完整的文本内容；相同的请求同时进行时共享同一个上游调用。
+    endpoint 用于指标标签和响应缓存的 TTL；use_cache=True 时启用响应缓存，
+    bypass_cache=True 时跳过读取缓存、重新生成并覆盖缓存
+    """
     try:
-        response = client.chat.completions.create(
-            model=DEEPSEEK_MODEL,
-            messages=messages,
-            stream=stream,
-            max_tokens=max_tokens,
-            temperature=0.7
-        )
-        return response
+        key = SingleFlight.make_key(messages, gateway.model, max_tokens=max_tokens, temperature=0.7)
+        if not use_cache or response_cache is None:
+            result = call_deepseek(messages, stream, max_tokens, key, endpoint)
+            return cancellable(result) if stream else result
+        
+        if not bypass_cache:
+            chunks = response_cache.get(key)
+            if chunks is not None:
+                return CachedStream(chunks) if stream else ''.join(chunks)
+        
+        if stream:
+            return cancellable(response_cache.record(
+                key, endpoint, call_deepseek(messages, True, max_tokens, key, endpoint)))
+        result = call_deepseek(messages, False, max_tokens, key, endpoint)
+        response_cache.set(key, endpoint, [result])
+        return result
     except Exception as e:
         print(f"Error calling DeepSeek API: {e}")
+        LLM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
         raise e
 
 
+def cache_bypassed(data: Optional[Dict] = None) -> bool:
+    """请求体带 no_cache: true 或请求头 Cache-Control: no-cache 时跳过响应缓存"""
+    if data and data.get('no_cache'):
+        return True
+    return 'no-cache' in request.headers.get('Cache-Control', '').lower()
+
+
+# 摘要缓存：持久化层默认放在 prompts.db 同目录，设置 SUMMARY_CACHE_PERSIST=false 只用内存
+SUMMARY_CACHE_PERSIST = os.environ.get('SUMMARY_CACHE_PERSIST', 'true').lower() == 'true'
+summary_cache = SummaryCache(
+    db_path=os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'summary_cache.db')
+    if SUMMARY_CACHE_PERSIST else None
+)
+
+
+def timed_summary(kind: str, summarize: Callable[[], str], cached: bool = False) -> str:
+    """调用摘要并记录耗时（kind 区分前文摘要和文档滚动摘要）"""
+    started = time.perf_counter()
+    try:
+        return summarize()
+    finally:
+        SUMMARY_SECONDS.observe(time.perf_counter() - started, kind=kind, cached=str(cached).lower())
+
+
+# 文档滚动摘要：章节完成后在后台更新，存放在 prompts.db 同目录
+document_summaries = DocumentSummaryStore(
+    db_path=os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'document_summaries.db'),
+    summarize=lambda messages, max_tokens: timed_summary(
+        'document', lambda: query_deepseek(messages, stream=False, max_tokens=max_tokens, endpoint='document-summary'))
+)
+
+
+# 提示词语义索引：快照放在 prompts.db 同目录，启动后在后台加载（没有快照时全量构建）
+prompt_index = PromptVectorIndex(db, os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'prompt_vectors'))
+prompt_index.warm_up()
+
+
+# 提示词目录缓存：分类列表、提示词列表的响应体按数据版本缓存，支持 ETag / 304
+catalog_cache = CatalogCache(db)
+
+
+def cached_catalog_response(key: str, build: Callable[[], Dict]):
+    """返回缓存的 JSON 响应；请求带的 If-None-Match 与当前 ETag 一致时返回 304"""
+    body, etag = catalog_cache.get(key, lambda: jsonify(build()).get_data())
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # 允许浏览器缓存，但每次都要重新验证
+    return response.make_conditional(request)
+
+
+# 后台任务（Excel 导入等）：任务状态存放在 prompts.db 同目录，所有 worker 共享
+background_jobs = BackgroundJobs(os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'jobs.db'))
+
+
+def summarize_previous_content(previous_content: str, max_tokens: int) -> str:
+    """对过长的已生成内容（开头和结尾各约 RECENT_CONTENT_TOKENS 个 token）做摘要，结果按内容哈希缓存"""
+    summary_prompt = f"""请简要概括以下内容的核心要点（200字以内）：
+
+{trim_to_tokens(previous_content, RECENT_CONTENT_TOKENS, 'head')}
+
+...（中间省略）...
+
+{trim_to_tokens(previous_content, RECENT_CONTENT_TOKENS, 'tail')}"""
+    
+    summary_messages = [
+        {"role": "system", "content": "你是一位专业的内容总结助手。"},
+        {"role": "user", "content": summary_prompt}
+    ]
+    
+    cache_key = SummaryCache.make_key(summary_messages, gateway.model, max_tokens)
+    started = time.perf_counter()
+    summary = summary_cache.get(cache_key)
+    if summary is not None:
+        SUMMARY_SECONDS.observe(time.perf_counter() - started, kind='previous-content', cached='true')
+        return summary
+    summary = timed_summary('previous-content', lambda: query_deepseek(
+        summary_messages, stream=False, max_tokens=max_tokens, endpoint='previous-content-summary'))
+    summary_cache.set(cache_key, summary)
+    return summary
+
+
+# ==================== 可恢复的流式生成 ====================
+
+# 每次生成写入服务端缓冲区，客户端断线后可带 Last-Event-ID 重连继续读取；
+# 事件同时写入 prompts.db 同目录的 generations.db，重连落到其他 worker 时也能续读，
+# 设置 GENERATION_SHARED=false 时只在本进程内续读（单 worker 部署）
+GENERATION_SHARED = os.environ.get('GENERATION_SHARED', 'true').lower() == 'true'
+generations = GenerationRegistry(
+    GenerationStore(os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'generations.db'))
+    if GENERATION_SHARED else None
+)
+
+# 各流式接口的编码参数：文本片段按时间窗口/字节阈值合并后再写出
+# 交互式编辑追求低延迟，整篇文档生成多个章节交错输出，合并窗口更大
+STREAM_PROFILES = {
+    'edit-selection': StreamProfile(coalesce_ms=20),
+    'generate-document': StreamProfile(coalesce_ms=100, coalesce_bytes=16384),
+}
+
+
+def sse_response(buffer, after_seq: int = -1) -> Response:
+    """从缓冲区读取事件并输出 SSE，每个事件带 "<generation_id>:<seq>" 形式的 id"""
+    profile = getattr(buffer, 'stream_profile', None) or STREAM_PROFILES.get(buffer.endpoint, DEFAULT_PROFILE)
+    response = Response(iter_sse(buffer, after_seq, profile), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['X-Generation-Id'] = buffer.id
+    return response
+
+
+def stream_generation(produce, endpoint: str = '') -> Response:
+    """在后台运行 produce()（产出事件字典），结果写入新的生成缓冲区并以 SSE 返回"""
+    buffer = generations.create(endpoint)
+    buffer.stream_profile = STREAM_PROFILES.get(endpoint, DEFAULT_PROFILE)
+    buffer.append({'generation_id': buffer.id})
+    started = getattr(g, 'request_started', None)
+    generations.run(buffer, lambda: instrument_stream(endpoint, produce(), started),
+                    on_error=lambda e: {'error': str(e)})
+    return sse_response(buffer)
+
+
+def resumable(view):
+    """流式接口装饰器：请求带有 Last-Event-ID 时直接从缓冲区续传，不再调用 LLM"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        if not last_event_id:
+            return view(*args, **kwargs)
+        
+        parsed = parse_event_id(last_event_id)
+        buffer = generations.get(parsed[0]) if parsed else None
+        if buffer is None:
+            return jsonify({'error': '生成记录不存在或已过期，请重新生成'}), 410
+        return sse_response(buffer, parsed[1])
+    return wrapper
+
+
+@app.route('/api/generations/<generation_id>/events', methods=['GET'])
+def generation_events(generation_id):
+    """按 generation id 读取（或续读）生成结果，便于 EventSource 重连"""
+    buffer = generations.get(generation_id)
+    if buffer is None:
+        return jsonify({'error': '生成记录不存在或已过期，请重新生成'}), 410
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    parsed = parse_event_id(last_event_id) if last_event_id else None
+    after_seq = parsed[1] if parsed and parsed[0] == generation_id else -1
+    return sse_response(buffer, after_seq)
+
+
+@app.route('/api/generations/<generation_id>/cancel', methods=['POST'])
+def cancel_generation(generation_id):
+    """停止生成：立即关闭上游请求，正在读取的客户端收到 {"cancelled": true} 后结束"""
+    buffer = generations.get(generation_id)
+    if buffer is None:
+        return jsonify({'error': '生成记录不存在或已过期'}), 404
+    cancelled = buffer.cancel('client')
+    return jsonify({'generation_id': generation_id, 'cancelled': cancelled, 'finished': buffer.finished})
+
+
+# ==================== 默认提示词模板（启动时编译一次） ====================
+
+DEFAULT_OUTLINE_TEMPLATE = compile_template("""你是一位专业的公文写作助手。用户想要写一篇关于"{topic}"的文章。
+
+请为这个主题生成一个详细的大纲。大纲应该：
+1. 结构清晰，层次分明
+2. 涵盖主题的关键方面
+3. 逻辑流畅，易于理解
+4. 使用 Markdown 格式，支持层级结构（使用 ## 和 ### 标记）
+
+只需要返回大纲内容，不要有其他解释。以 Markdown 格式输出。""")
+
+DEFAULT_SECTION_TEMPLATE = compile_template("""{context}
+
+现在需要详细撰写以下部分：
+{current_section}
+
+要求：
+1. 内容要详细、深入、有见地
+2. 与之前的内容保持连贯，避免重复
+3. 使用 Markdown 格式
+4. 如果是第一部分，可以有引言；如果是最后一部分，可以有总结
+5. 篇幅控制在 500-800 字之间
+6. 只返回正文内容，不要包含章节标题（标题已在大纲中）""")
+
+REGENERATE_SECTION_TEMPLATE = compile_template("""#角色
+你是一个交通运输与管理局工作过15年，在发展改革委评审委员会工作过10年的公务员。
+
+#写作风格和内容要求
+1. 公文风，内容详细、深入、有见地；
+2. 与之前的内容保持连贯，避免重复；
+
+#格式要求
+1. 使用 Markdown 格式
+2. 每一个段落的篇幅在500字到1200字；
+3. 只返回正文内容，不要包含章节标题（标题已在大纲中）
+
+文档主题：
+{topic}
+
+这是之前撰写的内容：
+{context}
+
+这是用户要求调整或重新撰写的章节：
+{current_section}
+
+这是原有的生成内容：
+{preview_context}
+
+这是用户的新要求：
+{new_prompt}""")
+
+
 @app.route('/api/generate-outline', methods=['POST'])
+@resumable
 def generate_outline():
     """生成大纲 - 流式输出"""
     data = request.json
@@ -84,103 +391,145 @@ def generate_outline():
     
     # 如果用户提供了自定义提示词，使用自定义提示词；否则使用默认提示词
     if custom_prompt:
-        prompt = custom_prompt.replace('{topic}', topic)
+        prompt = compile_template(custom_prompt).render({'topic': topic})
     else:
-        prompt = f"""你是一位专业的公文写作助手。用户想要写一篇关于"{topic}"的文章。
-
-请为这个主题生成一个详细的大纲。大纲应该：
-1. 结构清晰，层次分明
-2. 涵盖主题的关键方面
-3. 逻辑流畅，易于理解
-4. 使用 Markdown 格式，支持层级结构（使用 ## 和 ### 标记）
-
-只需要返回大纲内容，不要有其他解释。以 Markdown 格式输出。"""
+        prompt = DEFAULT_OUTLINE_TEMPLATE.render({'topic': topic})
 
     messages = [
         {"role": "system", "content": "你是一位专业的写作助手，擅长创建清晰、有逻辑的文章大纲。"},
         {"role": "user", "content": prompt}
     ]
     
-    def generate():
-        try:
-            response = query_deepseek(messages, stream=True)
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    def produce():
+        for content in query_deepseek(messages, stream=True, endpoint='generate-outline'):
+            yield {'content': content}
+        yield {'done': True}
     
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_generation(produce, 'generate-outline')
 
 
-@app.route('/api/generate-section', methods=['POST'])
-def generate_section():
-    """生成单个章节的内容"""
-    data = request.json
-    topic = data.get('topic', '')
-    outline = data.get('outline', '')
-    current_section = data.get('current_section', '')
-    previous_content = data.get('previous_content', '')
-    custom_prompt = data.get('custom_prompt', '')
-    section_hint = data.get('section_hint', '')  # 章节下方的专属提示词
-    
-    if not topic or not current_section:
-        return jsonify({'error': '主题和当前章节不能为空'}), 400
-    
-    # 如果用户提供了自定义提示词，使用自定义提示词
-    if custom_prompt:
-        # 构建上下文用于替换占位符
-        context_parts = []
-        
-        if outline:
-            context_parts.append(f"完整大纲：\n{outline}")
-        
-        if previous_content:
-            content_length = len(previous_content)
-            if content_length > 3000:
-                # 对长内容进行摘要
-                summary_prompt = f"""请简要概括以下内容的核心要点（200字以内）：
+def load_prompt_template(prompt_id):
+    """按 id 读取提示词库中的提示词并编译，返回 (模板, 错误响应)"""
+    if not prompt_id:
+        return None, None
+    try:
+        prompt_id = int(prompt_id)
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': 'prompt_id 必须是整数'}), 400)
+    prompt = db.get_prompt(prompt_id)
+    if not prompt:
+        return None, (jsonify({'error': '提示词不存在'}), 404)
+    return compile_prompt(prompt), None
+
+
+def int_param(data: Dict, name: str, default: int):
+    """读取请求体中的整数参数，返回 (值, 错误响应)；参数不存在时使用默认值"""
+    if name not in data:
+        return default, None
+    try:
+        return int(data[name]), None
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': f'{name} 必须是整数'}), 400)
 
-{previous_content[:1000]}
 
-...（中间省略）...
+def plan_section_context(outline: str, previous_content: str = '', section_hint: str = '',
+                         document_summary: Optional[str] = None, summary_tokens: int = 300,
+                         extra_parts: Optional[List[ContextPart]] = None) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """按 token 预算分配章节上下文，返回 (各部分文本, 各部分 token 数)
 
-{previous_content[-1000:]}"""
-                
-                summary_messages = [
-                    {"role": "system", "content": "你是一位专业的内容总结助手。"},
-                    {"role": "user", "content": summary_prompt}
-                ]
-                
+    各部分为 outline（大纲）、summary（前文摘要）、recent（摘要之外保留的最近内容）、
+    previous（前文不长时的全文）、hint（章节专属提示词）；前文超过 PREVIOUS_CONTENT_SUMMARY_TOKENS
+    且没有文档摘要时调用 LLM 生成摘要，摘要失败时只保留最近内容
+    """
+    summary = document_summary or ''
+    recent = previous = ''
+    if previous_content:
+        if summary or count_tokens(previous_content) > PREVIOUS_CONTENT_SUMMARY_TOKENS:
+            if not summary:
                 try:
-                    summary_response = query_deepseek(summary_messages, stream=False, max_tokens=300)
-                    summary = summary_response.choices[0].message.content
-                    context_parts.append(f"\n已生成内容的摘要：\n{summary}")
+                    summary = summarize_previous_content(previous_content, max_tokens=summary_tokens)
                 except Exception as e:
                     print(f"生成摘要失败: {e}")
-                    context_parts.append(f"\n已生成内容（最近1000字）：\n{previous_content[-1000:]}")
-            else:
-                context_parts.append(f"\n已生成的内容：\n{previous_content}")
+            recent = previous_content
         else:
-            context_parts.append("\n（这是第一个章节，没有之前的内容）")
+            previous = previous_content
+    
+    return allocate_context([
+        ContextPart('hint', section_hint, weight=2, keep='head'),
+        ContextPart('outline', outline, weight=3, keep='head'),
+        ContextPart('summary', summary, weight=2, keep='head'),
+        ContextPart('recent', recent, weight=1, keep='tail', max_tokens=RECENT_CONTENT_TOKENS),
+        ContextPart('previous', previous, weight=2, keep='tail'),
+    ] + (extra_parts or []), SECTION_CONTEXT_TOKENS)
+
+
+def build_section_messages(topic: str, outline: str, current_section: str,
+                           previous_content: str = '', custom_prompt: str = '',
+                           section_hint: str = '', document_summary: Optional[str] = None,
+                           no_previous_note: Optional[str] = None,
+                           prompt_template: Optional[CompiledTemplate] = None,
+                           endpoint: str = 'generate-section') -> Tuple[List[Dict[str, str]], int]:
+    """构建章节生成的消息（单章节生成和整篇文档生成共用），返回 (消息, max_tokens)
+
+    document_summary 为后台生成的文档滚动摘要；no_previous_note 用于替换没有之前内容时的说明；
+    prompt_template 为已编译的自定义提示词（如数据库中的提示词），优先于 custom_prompt。
+    大纲、前文和章节提示词按 token 预算裁剪，max_tokens 按提示词长度和模型上下文窗口计算
+    """
+    if prompt_template is None and custom_prompt:
+        prompt_template = compile_template(custom_prompt)
+    
+    # 自定义提示词直接引用的 {outline}、{previous_content} 与上下文共用同一个预算
+    raw_parts = []
+    if prompt_template is not None:
+        if prompt_template.uses('outline'):
+            raw_parts.append(ContextPart('raw_outline', outline, weight=3, keep='head'))
+        if prompt_template.uses('previous_content'):
+            raw_parts.append(ContextPart('raw_previous', previous_content, weight=2, keep='tail'))
+    
+    # 自定义提示词用不到 {context} 时不构建上下文（避免调用摘要），只裁剪章节提示词
+    if prompt_template is None or prompt_template.uses('context'):
+        parts, usage = plan_section_context(
+            outline, previous_content, section_hint, document_summary,
+            summary_tokens=200 if prompt_template is None else 300, extra_parts=raw_parts
+        )
+    else:
+        parts, usage = allocate_context([ContextPart('hint', section_hint, keep='head')] + raw_parts,
+                                        SECTION_CONTEXT_TOKENS)
+    section_hint = parts['hint']
+    
+    # 如果用户提供了自定义提示词，使用自定义提示词
+    if prompt_template is not None:
+        def build_context():
+            context_parts = []
         
-        context = "\n".join(context_parts)
+            if parts['outline']:
+                context_parts.append(f"完整大纲：\n{parts['outline']}")
+        
+            if parts['summary']:
+                context_parts.append(f"\n已生成内容的摘要：\n{parts['summary']}")
+            if parts['recent']:
+                context_parts.append(f"\n已生成内容（最近部分）：\n{parts['recent']}")
+            elif parts['previous']:
+                context_parts.append(f"\n已生成的内容：\n{parts['previous']}")
+            elif not parts['summary']:
+                context_parts.append(no_previous_note or "\n（这是第一个章节，没有之前的内容）")
+
+            return "\n".join(context_parts)
         
-        # 替换自定义提示词中的占位符
-        prompt = custom_prompt.replace('{topic}', topic)
-        prompt = prompt.replace('{outline}', outline if outline else '')
-        prompt = prompt.replace('{current_section}', current_section)
-        prompt = prompt.replace('{previous_content}', previous_content if previous_content else '')
-        prompt = prompt.replace('{context}', context)
+        # 单次渲染替换自定义提示词中的占位符
+        prompt = prompt_template.render({
+            'topic': topic,
+            'outline': parts.get('raw_outline', ''),
+            'current_section': current_section,
+            'previous_content': parts.get('raw_previous', ''),
+            'context': build_context,
+        })
         
         # 如果有章节专属提示词，添加到提示词末尾
         if section_hint:
             prompt += f"\n\n针对本章节的专属要求：\n{section_hint}"
         
         print(f"使用自定义提示词生成章节: {current_section[:50]}...")
-        print(f"提示词长度: {len(prompt)} 字符")
         if section_hint:
             print(f"包含章节专属提示词: {section_hint[:100]}...")
     else:
@@ -188,52 +537,22 @@ def generate_section():
         # 构建上下文
         context_parts = [f"整体主题：{topic}"]
         
-        if outline:
-            context_parts.append(f"\n完整大纲：\n{outline}")
+        if parts['outline']:
+            context_parts.append(f"\n完整大纲：\n{parts['outline']}")
         
-        if previous_content:
-            # 处理长上下文：如果之前的内容太长，进行摘要或截取
-            content_length = len(previous_content)
-            if content_length > 3000:
-                # 只保留最近的内容和开头部分
-                summary_prompt = f"""请简要概括以下内容的核心要点（200字以内）：
-
-{previous_content[:1000]}
-
-...（中间省略）...
-
-{previous_content[-1000:]}"""
-                
-                summary_messages = [
-                    {"role": "system", "content": "你是一位专业的内容总结助手。"},
-                    {"role": "user", "content": summary_prompt}
-                ]
-                
-                try:
-                    summary_response = query_deepseek(summary_messages, stream=False, max_tokens=200)
-                    summary = summary_response.choices[0].message.content
-                    context_parts.append(f"\n之前内容的摘要：\n{summary}")
-                except:
-                    # 如果摘要失败，使用简单截取
-                    context_parts.append(f"\n之前内容（截取）：\n{previous_content[-1000:]}")
-            else:
-                context_parts.append(f"\n已生成的内容：\n{previous_content}")
+        if parts['summary']:
+            context_parts.append(f"\n之前内容的摘要：\n{parts['summary']}")
+        if parts['recent']:
+            context_parts.append(f"\n之前内容（截取）：\n{parts['recent']}")
+        elif parts['previous']:
+            context_parts.append(f"\n已生成的内容：\n{parts['previous']}")
+        elif no_previous_note and not parts['summary']:
+            context_parts.append(no_previous_note)
         
         context = "\n".join(context_parts)
         
         # 构建基础提示词
-        prompt_parts = [f"""{context}
-
-现在需要详细撰写以下部分：
-{current_section}
-
-要求：
-1. 内容要详细、深入、有见地
-2. 与之前的内容保持连贯，避免重复
-3. 使用 Markdown 格式
-4. 如果是第一部分，可以有引言；如果是最后一部分，可以有总结
-5. 篇幅控制在 500-800 字之间
-6. 只返回正文内容，不要包含章节标题（标题已在大纲中）"""]
+        prompt_parts = [DEFAULT_SECTION_TEMPLATE.render({'context': context, 'current_section': current_section})]
         
         # 如果有章节专属提示词，添加额外要求
         if section_hint:
@@ -249,28 +568,150 @@ def generate_section():
     # 如果有章节专属提示词，添加到系统消息中（提高权重）
     if section_hint:
         system_message += f"\n\n【本章节专属要求】\n{section_hint}"
-        print(f"将章节提示词添加到系统消息中: {section_hint[:100]}...")
     
     messages = [
         {"role": "system", "content": system_message},
         {"role": "user", "content": prompt}
     ]
+    max_tokens = completion_budget(messages, SECTION_MAX_TOKENS)
+    log_token_usage(endpoint, messages, max_tokens, usage)
+    return messages, max_tokens
+
+
+@app.route('/api/generate-section', methods=['POST'])
+@resumable
+def generate_section():
+    """生成单个章节的内容"""
+    data = request.json
+    topic = data.get('topic', '')
+    outline = data.get('outline', '')
+    current_section = data.get('current_section', '')
+    previous_content = data.get('previous_content', '')
+    custom_prompt = data.get('custom_prompt', '')
+    section_hint = data.get('section_hint', '')  # 章节下方的专属提示词
+    document_id = data.get('document_id', '')  # 用于读取和更新文档滚动摘要
+    section_id = data.get('section_id') or current_section
+    section_index = data.get('section_index')
+    prompt_id = data.get('prompt_id')  # 直接使用提示词库中的提示词作为自定义提示词
     
-    def generate():
-        try:
-            response = query_deepseek(messages, stream=True)
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    if not topic or not current_section:
+        return jsonify({'error': '主题和当前章节不能为空'}), 400
     
-    return Response(generate(), mimetype='text/event-stream')
+    prompt_template, error = load_prompt_template(prompt_id)
+    if error:
+        return error
+    
+    # 已有后台生成的文档摘要时，长内容直接使用摘要（不再同步调用 LLM）；
+    # 客户端也可以只传 document_id 和 section_index，省略 previous_content
+    document_summary = None
+    if document_id and section_index != 0 and (
+            not previous_content or count_tokens(previous_content) > PREVIOUS_CONTENT_SUMMARY_TOKENS):
+        document_summary = document_summaries.get_context(document_id, section_index)
+    
+    messages, max_tokens = build_section_messages(
+        topic, outline, current_section,
+        previous_content=previous_content,
+        custom_prompt=custom_prompt,
+        section_hint=section_hint,
+        document_summary=document_summary,
+        prompt_template=prompt_template
+    )
+    
+    def produce():
+        section_content = []
+        for content in query_deepseek(messages, stream=True, max_tokens=max_tokens, endpoint='generate-section'):
+            section_content.append(content)
+            yield {'content': content}
+        if document_id:
+            # 后台把本章节合并进文档摘要，供后续章节使用
+            document_summaries.record_section(document_id, section_id, current_section,
+                                              "".join(section_content), section_index)
+        yield {'done': True}
+    
+    return stream_generation(produce, 'generate-section')
+
+
+@app.route('/api/generate-document', methods=['POST'])
+@resumable
+def generate_document():
+    """根据大纲生成整篇文档：章节并行生成，结果合并为一个按章节编号标记的事件流"""
+    data = request.json
+    topic = data.get('topic', '')
+    outline = data.get('outline', '')
+    custom_prompt = data.get('custom_prompt', '')
+    document_id = data.get('document_id', '')
+    section_hints = data.get('section_hints') or {}  # 覆盖大纲中解析出的章节提示词
+    dependent_sections = data.get('dependent_sections')  # 依赖前文的章节编号
+    prompt_id = data.get('prompt_id')
+    
+    if not topic or not outline:
+        return jsonify({'error': '主题和大纲不能为空'}), 400
+    
+    max_parallel, error = int_param(data, 'max_parallel', DOCUMENT_MAX_PARALLEL)
+    if error:
+        return error
+    sequential_window, error = int_param(data, 'sequential_window', DOCUMENT_SEQUENTIAL_WINDOW)
+    if error:
+        return error
+    if not isinstance(section_hints, dict) or not all(isinstance(hint, str) for hint in section_hints.values()):
+        return jsonify({'error': 'section_hints 必须是 章节标题 -> 提示 的对象'}), 400
+    if dependent_sections is not None and (
+            not isinstance(dependent_sections, list)
+            or not all(isinstance(index, int) and not isinstance(index, bool) for index in dependent_sections)):
+        return jsonify({'error': 'dependent_sections 必须是章节编号（整数）列表'}), 400
+    if data.get('sections') and (not isinstance(data['sections'], list)
+                                 or not all(isinstance(title, str) for title in data['sections'])):
+        return jsonify({'error': 'sections 必须是章节标题列表'}), 400
+    
+    prompt_template, error = load_prompt_template(prompt_id)
+    if error:
+        return error
+    
+    if data.get('sections'):
+        sections = [{'title': title, 'hint': ''} for title in data['sections']]
+    else:
+        sections = parse_outline_sections(outline)
+    if not sections:
+        return jsonify({'error': '大纲中没有找到章节标题（## 开头）'}), 400
+    for section in sections:
+        section['hint'] = section_hints.get(section['title'], section['hint'])
+    
+    def stream_section(index, section, previous_content):
+        messages, max_tokens = build_section_messages(
+            topic, outline, section['title'],
+            previous_content=previous_content,
+            custom_prompt=custom_prompt,
+            section_hint=section['hint'],
+            prompt_template=prompt_template,
+            no_previous_note=None if index == 0 else "\n（本章节与其他章节并行撰写，请依据大纲把握与前后章节的衔接，避免重复）",
+            endpoint='generate-document'
+        )
+        return query_deepseek(messages, stream=True, max_tokens=max_tokens, endpoint='generate-document')
+    
+    def on_section_done(index, section, text):
+        if document_id:
+            document_summaries.record_section(document_id, section['title'], section['title'], text, index)
+    
+    generation = DocumentGeneration(
+        sections, stream_section,
+        max_parallel=max_parallel,
+        sequential_window=sequential_window,
+        dependent_sections=dependent_sections,
+        on_section_done=on_section_done
+    )
+    
+    print(f"整篇生成: {len(sections)} 个章节, 并行 {generation.max_parallel}, 顺序窗口 {generation.sequential_window}")
+    
+    def produce():
+        current_generation().on_cancel(generation.cancel)
+        yield from generation.events()
+        yield {'done': True, 'sections': len(sections)}
+    
+    return stream_generation(produce, 'generate-document')
 
 
 @app.route('/api/regenerate-section', methods=['POST'])
+@resumable
 def regenerate_section():
     """重新生成单个章节的内容"""
     data = request.json
@@ -281,75 +722,45 @@ def regenerate_section():
     preview_context = data.get('preview_context', '')  # 原有的生成内容
     new_prompt = data.get('new_prompt', '')  # 用户的新要求
     section_hint = data.get('section_hint', '')  # 章节下方的专属提示词
+    document_id = data.get('document_id', '')  # 重新生成的结果会更新文档滚动摘要
+    section_id = data.get('section_id') or current_section
+    section_index = data.get('section_index')
     
     if not topic or not current_section or not new_prompt:
         return jsonify({'error': '主题、当前章节和新要求不能为空'}), 400
     
     # 构建重新生成的提示词
-    # 构建上下文
+    # 构建上下文（原有内容与大纲、前文一起按 token 预算裁剪）
+    parts, usage = plan_section_context(
+        outline, previous_content, section_hint,
+        extra_parts=[ContextPart('preview', preview_context, weight=3, keep='head')]
+    )
+    section_hint = parts['hint']
+    preview_context = parts['preview']
     context_parts = []
     
-    if outline:
-        context_parts.append(f"完整大纲：\n{outline}")
+    if parts['outline']:
+        context_parts.append(f"完整大纲：\n{parts['outline']}")
     
-    if previous_content:
-        content_length = len(previous_content)
-        if content_length > 3000:
-            # 对长内容进行摘要
-            summary_prompt = f"""请简要概括以下内容的核心要点（200字以内）：
-
-{previous_content[:1000]}
-
-...（中间省略）...
-
-{previous_content[-1000:]}"""
-            
-            summary_messages = [
-                {"role": "system", "content": "你是一位专业的内容总结助手。"},
-                {"role": "user", "content": summary_prompt}
-            ]
-            
-            try:
-                summary_response = query_deepseek(summary_messages, stream=False, max_tokens=300)
-                summary = summary_response.choices[0].message.content
-                context_parts.append(f"\n已生成内容的摘要：\n{summary}")
-            except Exception as e:
-                print(f"生成摘要失败: {e}")
-                context_parts.append(f"\n已生成内容（最近1000字）：\n{previous_content[-1000:]}")
-        else:
-            context_parts.append(f"\n已生成的内容：\n{previous_content}")
-    else:
+    if parts['summary']:
+        context_parts.append(f"\n已生成内容的摘要：\n{parts['summary']}")
+    if parts['recent']:
+        context_parts.append(f"\n已生成内容（最近部分）：\n{parts['recent']}")
+    elif parts['previous']:
+        context_parts.append(f"\n已生成的内容：\n{parts['previous']}")
+    elif not parts['summary']:
         context_parts.append("\n（这是第一个章节，没有之前的内容）")
     
     context = "\n".join(context_parts)
     
     # 使用新的提示词模板
-    prompt_parts = [f"""#角色
-你是一个交通运输与管理局工作过15年，在发展改革委评审委员会工作过10年的公务员。
-
-#写作风格和内容要求
-1. 公文风，内容详细、深入、有见地；
-2. 与之前的内容保持连贯，避免重复；
-
-#格式要求
-1. 使用 Markdown 格式
-2. 每一个段落的篇幅在500字到1200字；
-3. 只返回正文内容，不要包含章节标题（标题已在大纲中）
-
-文档主题：
-{topic}
-
-这是之前撰写的内容：
-{context}
-
-这是用户要求调整或重新撰写的章节：
-{current_section}
-
-这是原有的生成内容：
-{preview_context}
-
-这是用户的新要求：
-{new_prompt}"""]
+    prompt_parts = [REGENERATE_SECTION_TEMPLATE.render({
+        'topic': topic,
+        'context': context,
+        'current_section': current_section,
+        'preview_context': preview_context,
+        'new_prompt': new_prompt,
+    })]
     
     # 如果有章节专属提示词，添加到提示词中
     if section_hint:
@@ -361,7 +772,6 @@ def regenerate_section():
     
     print(f"重新生成章节: {current_section[:50]}...")
     print(f"用户新要求: {new_prompt}")
-    print(f"提示词长度: {len(prompt)} 字符")
     
     # 构建系统消息：基础角色 + 章节专属提示词（如果有）
     system_message = "你是一位专业的内容创作者，擅长撰写深入、有见地的文章内容。你能够根据用户的反馈进行调整和改进。"
@@ -375,22 +785,24 @@ def regenerate_section():
         {"role": "system", "content": system_message},
         {"role": "user", "content": prompt}
     ]
+    max_tokens = completion_budget(messages, SECTION_MAX_TOKENS)
+    log_token_usage('regenerate-section', messages, max_tokens, usage)
     
-    def generate():
-        try:
-            response = query_deepseek(messages, stream=True)
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    def produce():
+        section_content = []
+        for content in query_deepseek(messages, stream=True, max_tokens=max_tokens, endpoint='regenerate-section'):
+            section_content.append(content)
+            yield {'content': content}
+        if document_id:
+            document_summaries.record_section(document_id, section_id, current_section,
+                                              "".join(section_content), section_index)
+        yield {'done': True}
     
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_generation(produce, 'regenerate-section')
 
 
 @app.route('/api/edit-selection', methods=['POST'])
+@resumable
 def edit_selection():
     """编辑选中的文本片段"""
     data = request.json
@@ -422,18 +834,12 @@ def edit_selection():
         {"role": "user", "content": prompt}
     ]
     
-    def generate():
-        try:
-            response = query_deepseek(messages, stream=True, max_tokens=2000)
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    def produce():
+        for content in query_deepseek(messages, stream=True, max_tokens=2000, endpoint='edit-selection'):
+            yield {'content': content}
+        yield {'done': True}
     
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_generation(produce, 'edit-selection')
 
 
 @app.route('/api/health', methods=['GET'])
@@ -442,14 +848,82 @@ def health():
     return jsonify({'status': 'ok'})
 
 
+@app.route('/api/documents/<document_id>/summary', methods=['GET'])
+def get_document_summary(document_id):
+    """获取文档的滚动摘要（文档摘要 + 各章节摘要）"""
+    summary = document_summaries.get_summary(document_id)
+    if summary:
+        return jsonify(summary)
+    else:
+        return jsonify({'error': '文档摘要不存在'}), 404
+
+
+@app.route('/api/documents/<document_id>/sections', methods=['POST'])
+def record_document_section(document_id):
+    """手动编辑章节后提交最新内容，更新文档滚动摘要"""
+    data = request.json
+    title = data.get('title', '')
+    content = data.get('content', '')
+    section_id = data.get('section_id') or title
+    
+    if not section_id or not content:
+        return jsonify({'error': '章节和内容不能为空'}), 400
+    
+    document_summaries.record_section(document_id, section_id, title, content, data.get('section_index'))
+    return jsonify({'message': '章节已提交，摘要将在后台更新'}), 202
+
+
+@app.route('/api/catalog-cache/stats', methods=['GET'])
+def catalog_cache_stats():
+    """提示词目录缓存命中统计"""
+    return jsonify(catalog_cache.stats())
+
+
+@app.route('/api/single-flight/stats', methods=['GET'])
+def single_flight_stats():
+    """请求合并统计（进行中的上游调用数、发起次数、被合并的请求数）"""
+    return jsonify(single_flight.stats())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 格式的指标（汇总所有 worker 进程）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/llm-backends/stats', methods=['GET'])
+def llm_backends_stats():
+    """各上游后端的健康状态（本进程）、最近的首 token 时间分位数和对冲阈值"""
+    return jsonify(gateway.stats())
+
+
+@app.route('/api/upstream-limits/stats', methods=['GET'])
+def upstream_limits_stats():
+    """上游准入控制状态（本进程的并发上限、进行中和排队的请求数，共享令牌桶的剩余额度）"""
+    return jsonify(dict(upstream_limits.stats(), enabled=True))
+
+
+@app.route('/api/response-cache/stats', methods=['GET'])
+def response_cache_stats():
+    """LLM 响应缓存统计（条目数、占用字节、命中次数）"""
+    if response_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(response_cache.stats(), enabled=True))
+
+
+@app.route('/api/summary-cache/stats', methods=['GET'])
+def summary_cache_stats():
+    """摘要缓存命中统计"""
+    return jsonify(summary_cache.stats())
+
+
 # ==================== 提示词管理 API ====================
 
 @app.route('/api/prompts/categories', methods=['GET'])
 def get_categories():
     """获取所有分类"""
     try:
-        categories = db.get_all_categories()
-        return jsonify({'categories': categories})
+        return cached_catalog_response('categories', lambda: {'categories': db.get_all_categories()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -506,11 +980,28 @@ def delete_category(category_id):
 
 @app.route('/api/prompts', methods=['GET'])
 def get_prompts():
-    """获取所有提示词（可按分类筛选）"""
+    """获取提示词列表（可按分类筛选）
+    
+    查询参数：
+    - fields: 逗号分隔的字段列表，如 id,title,keywords（列表页不需要 content）
+    - limit / cursor: 键集分页，响应中的 next_cursor 用于请求下一页；不传 limit 时返回全部
+    """
     try:
         category_id = request.args.get('category_id', type=int)
-        prompts = db.get_all_prompts(category_id)
-        return jsonify({'prompts': prompts})
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()] or None
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor') or None
+        
+        def build():
+            prompts, next_cursor = db.list_prompts(category_id, fields=fields, limit=limit, cursor=cursor)
+            result = {'prompts': prompts}
+            if limit is not None:
+                result['next_cursor'] = next_cursor
+            return result
+        
+        return cached_catalog_response(f'prompts:{category_id}:{fields}:{limit}:{cursor}', build)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -595,6 +1086,9 @@ def search_prompts():
         return jsonify({'error': str(e)}), 500
 
 
+MATCH_SECTIONS_MAX = 500
+
+
 @app.route('/api/prompts/match-section', methods=['POST'])
 def match_section():
     """为章节标题匹配最佳提示词"""
@@ -618,7 +1112,41 @@ def match_section():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/prompts/match-sections', methods=['POST'])
+def match_sections():
+    """批量为章节标题匹配最佳提示词（传入 section_titles 列表，或传入 outline 由后端解析章节）"""
+    try:
+        data = request.json
+        section_titles = data.get('section_titles')
+        category_name = data.get('category_name', '章节生成')
+        
+        if not section_titles and data.get('outline'):
+            section_titles = [section['title'] for section in parse_outline_sections(data['outline'])]
+        if not section_titles:
+            return jsonify({'error': '章节标题不能为空'}), 400
+        if len(section_titles) > MATCH_SECTIONS_MAX:
+            return jsonify({'error': f'一次最多匹配 {MATCH_SECTIONS_MAX} 个章节'}), 400
+        
+        matches = db.find_best_matches_for_sections(section_titles, category_name)
+        
+        results = []
+        for section_title, match in zip(section_titles, matches):
+            if match:
+                # 增加使用次数
+                db.increment_usage(match['id'])
+            results.append({
+                'section_title': section_title,
+                'match': match,
+                'score': match.get('score') if match else None
+            })
+        
+        return jsonify({'matches': results, 'matched': sum(1 for match in matches if match)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/prompts/auto-generate', methods=['POST'])
+@resumable
 def auto_generate_prompt():
     """使用AI为章节生成提示词（流式响应）"""
     try:
@@ -651,29 +1179,15 @@ def auto_generate_prompt():
             {"role": "user", "content": prompt}
         ]
         
-        def generate():
-            """生成器函数，用于流式响应"""
-            try:
-                response = query_deepseek(messages, stream=True, max_tokens=500)
-                
-                for chunk in response:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        # 立即发送，避免缓冲
-                        data = f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
-                        yield data
-                
-                # 发送完成信号
-                yield f"data: {json.dumps({'done': True})}\n\n"
-            
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        # 禁用缓冲，确保流式数据立即发送
-        response = Response(generate(), mimetype='text/event-stream')
-        response.headers['Cache-Control'] = 'no-cache'
-        response.headers['X-Accel-Buffering'] = 'no'
-        return response
+        bypass = cache_bypassed(data)
+        
+        def produce():
+            for content in query_deepseek(messages, stream=True, max_tokens=500, endpoint='auto-generate',
+                                          use_cache=True, bypass_cache=bypass):
+                yield {'content': content}
+            yield {'done': True}
+        
+        return stream_generation(produce, 'auto-generate')
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -681,7 +1195,7 @@ def auto_generate_prompt():
 
 @app.route('/api/prompts/import-excel', methods=['POST'])
 def import_excel():
-    """从Excel导入提示词"""
+    """从Excel导入提示词（后台任务，立即返回任务 id，通过 /api/jobs/<job_id> 查询进度）"""
     try:
         # 检查是否有上传的文件
         if 'file' not in request.files:
@@ -691,41 +1205,83 @@ def import_excel():
         if file.filename == '':
             return jsonify({'error': '文件名为空'}), 400
         
-        # 保存临时文件
-        temp_path = 'temp_import.xlsx'
-        file.save(temp_path)
+        # 保存临时文件（每次上传单独一个文件，任务结束后删除）
+        fd, temp_path = tempfile.mkstemp(prefix='prompt_import_', suffix='.xlsx')
+        with os.fdopen(fd, 'wb') as f:
+            file.save(f)
         
-        # 导入
-        result = db.import_from_excel(temp_path)
+        def remove_temp_file():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
         
-        # 删除临时文件
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        job_id = background_jobs.submit(
+            'import-excel',
+            lambda progress: db.import_from_excel(temp_path, progress=progress),
+            cleanup=remove_temp_file
+        )
         
-        return jsonify(result)
+        return jsonify({
+            'job_id': job_id,
+            'status_url': f'/api/jobs/{job_id}',
+            'message': '导入任务已提交'
+        }), 202
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-# ==================== 章节提示词生成 API（新增）====================
+@app.route('/api/prompts/export', methods=['GET'])
+def export_prompts():
+    """流式导出提示词库备份（NDJSON，gzip=true 时压缩）"""
+    compress = request.args.get('gzip', 'false').lower() == 'true'
+    filename = f"prompts-{time.strftime('%Y%m%d-%H%M%S')}.ndjson" + ('.gz' if compress else '')
+    return Response(
+        iter_backup(db, compress=compress),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
 
-@app.route('/api/generate-section-prompt', methods=['POST'])
-def generate_section_prompt():
-    """为单个章节生成专属提示词（非流式，直接返回）"""
+
+@app.route('/api/prompts/restore', methods=['POST'])
+def restore_prompts():
+    """从备份恢复提示词库
+    
+    请求体可以直接是备份文件内容（NDJSON 或 gzip），也可以是 multipart 上传的 file 字段；
+    边读取边分批写入，已存在的分类/提示词按名称/标题合并
+    """
     try:
-        data = request.json
-        section_title = data.get('section_title', '')
-        topic = data.get('topic', '')
-        outline = data.get('outline', '')
-        project_name = data.get('project_name', '')
-        doc_name = data.get('doc_name', '')
-        
-        if not section_title:
-            return jsonify({'error': '章节标题不能为空'}), 400
+        if request.content_type and request.content_type.startswith('multipart/form-data'):
+            if 'file' not in request.files:
+                return jsonify({'error': '没有上传文件'}), 400
+            stream = request.files['file'].stream
+        else:
+            stream = request.stream
         
-        # 构建生成提示词的提示
-        prompt = f"""你是一个专业的写作提示词生成助手。用户正在写一篇关于"{topic}"的文档，需要为以下章节生成一个写作提示词。
+        result = restore_backup(db, stream)
+        if 'error' in result:
+            return jsonify(result), 400
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询后台任务状态和进度"""
+    job = background_jobs.get(job_id)
+    if job:
+        return jsonify(job)
+    else:
+        return jsonify({'error': '任务不存在'}), 404
+
+
+# ==================== 章节提示词生成 API（新增）====================
+
+SECTION_PROMPT_SYSTEM_MESSAGE = "你是一个专业的写作提示词生成助手，擅长为不同类型的文章章节生成精准的写作指导。你生成的提示词清晰、具体、易于AI理解和执行。"
+
+# 同一文档各章节共用的前缀（主题、项目、大纲）放在最前面，章节标题放在最后，
+# 批量生成时各请求的前缀完全相同，上游的前缀缓存（context caching）可以命中
+SECTION_PROMPT_PREFIX_TEMPLATE = compile_template("""你是一个专业的写作提示词生成助手。用户正在写一篇关于"{topic}"的文档，需要为其中的章节生成写作提示词。
 
 项目名称：{project_name}
 文档名称：{doc_name}
@@ -733,8 +1289,6 @@ def generate_section_prompt():
 完整大纲：
 {outline}
 
-当前章节：{section_title}
-
 请生成一个简洁但详细的写作提示词，指导 AI 如何撰写这个章节。提示词应该包含：
 1. 该章节的核心内容和要点
 2. 写作风格和语气建议（公文风、专业、详实等）
@@ -745,16 +1299,44 @@ def generate_section_prompt():
 - 直接返回提示词内容，不要有其他解释
 - 字数控制在 150-300 字之间
 - 使用第二人称（"你需要..."）或祈使句（"请..."）
-- 内容具体、可执行"""
+- 内容具体、可执行
+""")
 
-        messages = [
-            {"role": "system", "content": "你是一个专业的写作提示词生成助手，擅长为不同类型的文章章节生成精准的写作指导。你生成的提示词清晰、具体、易于AI理解和执行。"},
-            {"role": "user", "content": prompt}
-        ]
+SECTION_PROMPT_MAX_PARALLEL = int(os.environ.get('SECTION_PROMPT_MAX_PARALLEL', 8))
+
+
+def build_section_prompt_messages(prefix: str, section_title: str) -> List[Dict[str, str]]:
+    """构建章节提示词生成的消息：共用前缀 + 当前章节"""
+    return [
+        {"role": "system", "content": SECTION_PROMPT_SYSTEM_MESSAGE},
+        {"role": "user", "content": f"{prefix}\n当前章节：{section_title}"}
+    ]
+
+
+def render_section_prompt_prefix(data: Dict) -> str:
+    return SECTION_PROMPT_PREFIX_TEMPLATE.render({
+        'topic': data.get('topic', ''),
+        'project_name': data.get('project_name', ''),
+        'doc_name': data.get('doc_name', ''),
+        'outline': data.get('outline', ''),
+    })
+
+
+@app.route('/api/generate-section-prompt', methods=['POST'])
+def generate_section_prompt():
+    """为单个章节生成专属提示词（非流式，直接返回）"""
+    try:
+        data = request.json
+        section_title = data.get('section_title', '')
+        
+        if not section_title:
+            return jsonify({'error': '章节标题不能为空'}), 400
+        
+        messages = build_section_prompt_messages(render_section_prompt_prefix(data), section_title)
         
         # 非流式调用，直接获取结果
-        response = query_deepseek(messages, stream=False, max_tokens=600)
-        generated_prompt = response.choices[0].message.content
+        generated_prompt = query_deepseek(messages, stream=False, max_tokens=600, endpoint='generate-section-prompt',
+                                          use_cache=True, bypass_cache=cache_bypassed(data))
         
         print(f"为章节 '{section_title}' 生成提示词成功，长度: {len(generated_prompt)} 字符")
         
@@ -768,64 +1350,107 @@ def generate_section_prompt():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/prompts/ai-semantic-match', methods=['POST'])
-def ai_semantic_match():
-    """AI 语义匹配提示词（预留接口，使用小模型）
+@app.route('/api/generate-section-prompts', methods=['POST'])
+@resumable
+def generate_section_prompts():
+    """批量为章节生成专属提示词：各章节并发生成，每个章节完成后立即推送
+    
+    请求体同 /api/generate-section-prompt，section_title 换成 section_titles 列表，
+    可选 max_parallel；事件格式为 {'section_id': 序号, 'section_title', 'prompt'}，
+    失败的章节为 {'section_id', 'section_title', 'error'}
+    """
+    data = request.json
+    section_titles = data.get('section_titles') or []
+    
+    if not section_titles:
+        return jsonify({'error': '章节标题不能为空'}), 400
+    
+    max_parallel, error = int_param(data, 'max_parallel', SECTION_PROMPT_MAX_PARALLEL)
+    if error:
+        return error
+    max_parallel = max(1, min(max_parallel, SECTION_PROMPT_MAX_PARALLEL))
     
-    此接口预留给后续使用小型 AI 模型（如 embedding 模型）进行语义相似度匹配
-    当关键词匹配分数较低时，可以调用此接口进行更智能的匹配
+    prefix = render_section_prompt_prefix(data)
+    bypass = cache_bypassed(data)
     
-    实现思路：
-    1. 使用小模型（如 text-embedding-ada-002）计算章节标题的 embedding
-    2. 与提示词库中所有提示词的 embedding 进行相似度计算
-    3. 返回相似度最高的提示词
+    def generate(section_title):
+        return query_deepseek(build_section_prompt_messages(prefix, section_title), stream=False, max_tokens=600,
+                              endpoint='generate-section-prompt', use_cache=True, bypass_cache=bypass)
     
-    优势：
-    - 更智能的语义理解
-    - 能匹配到意思相近但关键词不同的提示词
-    - 使用小模型成本低、速度快
+    def produce():
+        executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='section-prompt')
+        # 取消时丢弃还没开始的章节（已经发出的非流式请求会完成，结果不再输出）
+        current_generation().on_cancel(lambda: executor.shutdown(wait=False, cancel_futures=True))
+        try:
+            futures = {executor.submit(generate, title): index for index, title in enumerate(section_titles)}
+            generated = 0
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    yield {'section_id': index, 'section_title': section_titles[index], 'prompt': future.result()}
+                    generated += 1
+                except Exception as e:
+                    print(f"生成章节提示词失败: {section_titles[index]}: {e}")
+                    yield {'section_id': index, 'section_title': section_titles[index], 'error': str(e)}
+            yield {'done': True, 'generated': generated, 'failed': len(section_titles) - generated}
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    print(f"批量生成章节提示词: {len(section_titles)} 个章节, 并发 {max_parallel}")
+    return stream_generation(produce, 'generate-section-prompts')
+
+
+@app.route('/api/prompts/ai-semantic-match', methods=['POST'])
+def ai_semantic_match():
+    """AI 语义匹配提示词
+    
+    在本地向量索引中按余弦相似度查找与章节标题最接近的提示词，
+    能匹配到意思相近但关键词不同的提示词（关键词匹配分数较低时使用）
     """
     try:
         data = request.json
         section_title = data.get('section_title', '')
-        prompts = data.get('prompts', [])  # 前端传入的提示词列表
+        prompts = data.get('prompts', [])  # 可选：只在前端传入的提示词中匹配
+        category_name = data.get('category_name')
+        top_k = max(1, min(int(data.get('top_k', 1)), 50))
+        min_score = float(data.get('min_score', 0))  # 相似度不高于该值的结果不返回
         
         if not section_title:
             return jsonify({'error': '章节标题不能为空'}), 400
         
-        # TODO: 实现 AI 语义匹配
-        # 1. 获取章节标题的 embedding
-        # section_embedding = get_embedding(section_title)
-        
-        # 2. 计算与每个提示词的相似度
-        # best_match = None
-        # best_score = 0
-        # for prompt in prompts:
-        #     prompt_embedding = get_embedding(prompt['title'] + ' ' + prompt['keywords'])
-        #     similarity = cosine_similarity(section_embedding, prompt_embedding)
-        #     if similarity > best_score:
-        #         best_score = similarity
-        #         best_match = prompt
-        
-        # 3. 返回最佳匹配
-        # return jsonify({
-        #     'match': best_match,
-        #     'score': best_score,
-        #     'method': 'ai_semantic'
-        # })
-        
-        # 当前返回未实现提示
+        category_id = data.get('category_id')
+        if category_name:
+            category_id = db.get_category_id(category_name)
+            if category_id is None:
+                return jsonify({'match': None, 'score': 0, 'matches': [], 'method': 'ai_semantic'})
+        prompt_ids = [prompt['id'] for prompt in prompts if prompt.get('id')] or None
+        
+        results = prompt_index.search(section_title, top_k=top_k, category_id=category_id, prompt_ids=prompt_ids)
+        results = [(prompt_id, score) for prompt_id, score in results if score > min_score]
+        scores = dict(results)
+        matches = db.get_prompts_by_ids([prompt_id for prompt_id, _ in results])
+        for match in matches:
+            match['score'] = round(scores[match['id']], 4)
+        
+        best_match = matches[0] if matches else None
         return jsonify({
-            'error': 'AI 语义匹配功能尚未实现',
-            'message': '此接口已预留，后续可集成小型 embedding 模型进行语义匹配',
-            'suggestion': '请先使用关键词匹配或 AI 生成功能'
-        }), 501  # 501 Not Implemented
+            'match': best_match,
+            'score': best_match['score'] if best_match else 0,
+            'matches': matches,
+            'method': 'ai_semantic'
+        })
     
     except Exception as e:
         print(f"AI 语义匹配失败: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/prompts/semantic-index/stats', methods=['GET'])
+def semantic_index_stats():
+    """提示词语义索引状态"""
+    return jsonify(prompt_index.stats())
+
+
 if __name__ == '__main__':
     # 生产环境配置
     port = int(os.environ.get('PORT', 8000))
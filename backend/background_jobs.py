@@ -0,0 +1,123 @@
+"""
+后台任务模块
+耗时的操作（如 Excel 批量导入）提交到后台线程执行，请求立即返回任务 id。
+任务状态和进度写入 SQLite（与 prompts.db 放在同一目录），任意 worker 进程都可以查询。
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from prompt_database import ConnectionPool
+
+
+BACKGROUND_JOB_WORKERS = int(os.environ.get('BACKGROUND_JOB_WORKERS', 1))
+BACKGROUND_JOB_RETENTION = float(os.environ.get('BACKGROUND_JOB_RETENTION', 7 * 24 * 3600))
+
+# run(progress) -> 结果字典；progress(dict) 用于上报进度
+JobFunction = Callable[[Callable[[Dict], None]], Dict]
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class BackgroundJobs:
+    def __init__(self, db_path: str, max_workers: int = BACKGROUND_JOB_WORKERS,
+                 retention: float = BACKGROUND_JOB_RETENTION):
+        self.retention = retention
+        self.max_workers = max(1, max_workers)
+        self.pool = ConnectionPool(db_path, max_size=4)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._init_database()
+
+    def _init_database(self):
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    pid INTEGER,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """线程池按进程创建（fork 出的 worker 不能复用父进程的线程）"""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='background-job')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        for key in ('progress', 'result'):
+            if key in fields:
+                fields[key] = json.dumps(fields[key], ensure_ascii=False)
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        with self.pool.connection() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def submit(self, kind: str, run: JobFunction, cleanup: Optional[Callable[[], None]] = None) -> str:
+        """提交任务，返回任务 id；cleanup 在任务结束后调用（如删除临时文件）"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM jobs WHERE updated_at < ? AND status IN (?, ?)',
+                         (now - self.retention, 'done', 'error'))
+            conn.execute(
+                '''INSERT INTO jobs (id, kind, status, pid, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (job_id, kind, 'pending', os.getpid(), now, now)
+            )
+
+        def execute():
+            self._update(job_id, status='running')
+            try:
+                result = run(lambda progress: self._update(job_id, progress=progress))
+                if result.get('error'):
+                    self._update(job_id, status='error', result=result, error=result['error'])
+                else:
+                    self._update(job_id, status='done', result=result)
+            except Exception as e:
+                print(f"后台任务 {kind} 失败: {e}")
+                self._update(job_id, status='error', error=str(e))
+            finally:
+                if cleanup:
+                    cleanup()
+
+        self._get_executor().submit(execute)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """查询任务状态；执行任务的进程已退出时状态为 interrupted"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        for key in ('progress', 'result'):
+            job[key] = json.loads(job[key]) if job[key] else None
+        if job['status'] in ('pending', 'running') and not _process_alive(job['pid']):
+            job['status'] = 'interrupted'
+        del job['pid']
+        return job
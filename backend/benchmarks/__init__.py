@@ -0,0 +1,4 @@
+"""
+离线基准测试：模拟 LLM 服务（mock_llm）+ 负载驱动（run）
+在 backend 目录下运行：python -m benchmarks.run --help
+"""
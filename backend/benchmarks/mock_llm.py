@@ -0,0 +1,230 @@
+"""
+OpenAI 兼容的本地模拟 LLM 服务（用于基准测试，不访问真实的 DeepSeek API）
+
+支持 /chat/completions 和 /v1/chat/completions，流式和非流式，返回 usage。
+可配置：
+- 首个 token 延迟：对数正态分布，由中位数和 p99 确定
+- 输出速度（tokens/秒）和每次回复的 token 数
+- 错误注入：按比例返回 429 / 500，或在流式输出中途断开连接
+
+用法：python -m benchmarks.mock_llm --port 18080 --tokens-per-second 50 --ttft-median 0.3 --ttft-p99 1.5
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+
+TOKEN_TEXT = '模拟'  # 每个 token 输出的文本
+
+
+class MockConfig:
+    def __init__(self, tokens_per_second: float = 50, completion_tokens: int = 200,
+                 ttft_median: float = 0.3, ttft_p99: float = 1.5,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, disconnect_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.ttft_median = ttft_median
+        self.ttft_p99 = max(ttft_p99, ttft_median)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0, 'disconnects': 0,
+                      'cancelled': 0, 'completion_tokens': 0}
+
+    def ttft(self) -> float:
+        """对数正态分布的首 token 延迟（p99 = 中位数 * e^(2.326σ)）"""
+        if self.ttft_median <= 0:
+            return 0.0
+        sigma = math.log(self.ttft_p99 / self.ttft_median) / 2.326
+        with self.lock:
+            return self.random.lognormvariate(math.log(self.ttft_median), sigma)
+
+    def roll(self) -> str:
+        """本次请求的结果：ok / error / rate_limit / disconnect"""
+        with self.lock:
+            value = self.random.random()
+        for outcome, rate in (('error', self.error_rate), ('rate_limit', self.rate_limit_rate),
+                              ('disconnect', self.disconnect_rate)):
+            if value < rate:
+                return outcome
+            value -= rate
+        return 'ok'
+
+    def count(self, **fields):
+        with self.lock:
+            for key, value in fields.items():
+                self.stats[key] += value
+
+
+def _completion_tokens(config: MockConfig, body: Dict) -> int:
+    return max(1, min(config.completion_tokens, int(body.get('max_tokens') or config.completion_tokens)))
+
+
+def _prompt_tokens(body: Dict) -> int:
+    return sum(len(message.get('content') or '') for message in body.get('messages', [])) * 6 // 10
+
+
+def make_handler(config: MockConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, status: int, payload: Dict):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _chunk(self, data: bytes):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                with config.lock:
+                    self._json(200, dict(config.stats))
+            else:
+                self._json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._json(404, {'error': {'message': 'not found'}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            config.count(requests=1)
+
+            outcome = config.roll()
+            if outcome == 'error':
+                config.count(errors=1)
+                self._json(500, {'error': {'message': 'injected server error', 'type': 'server_error'}})
+                return
+            if outcome == 'rate_limit':
+                config.count(rate_limited=1)
+                self._json(429, {'error': {'message': 'injected rate limit', 'type': 'rate_limit_error'}})
+                return
+
+            tokens = _completion_tokens(config, body)
+            prompt_tokens = _prompt_tokens(body)
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens,
+                     'total_tokens': prompt_tokens + tokens}
+            time.sleep(config.ttft())
+
+            if not body.get('stream'):
+                time.sleep(tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0)
+                config.count(completion_tokens=tokens)
+                self._json(200, {
+                    'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': TOKEN_TEXT * tokens},
+                                 'finish_reason': 'stop'}],
+                    'usage': usage,
+                })
+                return
+
+            config.count(streams=1)
+            try:
+                self._stream(body, outcome, tokens, usage)
+            except (BrokenPipeError, ConnectionResetError):
+                config.count(cancelled=1)  # 客户端提前关闭了连接（取消生成）
+                self.close_connection = True
+
+        def _stream(self, body: Dict, outcome: str, tokens: int, usage: Dict):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            disconnect_at = None
+            if outcome == 'disconnect':
+                with config.lock:
+                    disconnect_at = config.random.randint(1, tokens)
+            interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+            started = time.perf_counter()
+            for index in range(tokens):
+                if disconnect_at is not None and index == disconnect_at:
+                    config.count(disconnects=1)
+                    self.close_connection = True
+                    return  # 不发送结束块，客户端读到不完整的响应
+                chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': 0, 'model': body.get('model'),
+                         'choices': [{'index': 0, 'delta': {'content': TOKEN_TEXT}, 'finish_reason': None}]}
+                self._chunk(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+                # 按目标速度输出：睡到第 index+1 个 token 的计划时间
+                delay = started + (index + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            final = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': 0, 'model': body.get('model'),
+                     'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            if (body.get('stream_options') or {}).get('include_usage'):
+                final['usage'] = usage
+            self._chunk(b'data: ' + json.dumps(final).encode('utf-8') + b'\n\n')
+            self._chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+            config.count(completion_tokens=tokens)
+
+    return Handler
+
+
+class MockLLMServer:
+    """在后台线程中运行的模拟服务"""
+
+    def __init__(self, config: MockConfig, host: str = '127.0.0.1', port: int = 0):
+        self.config = config
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(config))
+        self.httpd.daemon_threads = True
+        self.base_url = f'http://{host}:{self.httpd.server_address[1]}'
+
+    def start(self) -> 'MockLLMServer':
+        threading.Thread(target=self.httpd.serve_forever, name='mock-llm', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=200)
+    parser.add_argument('--ttft-median', type=float, default=0.3)
+    parser.add_argument('--ttft-p99', type=float, default=1.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回 429 的比例')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='流式输出中途断开的比例')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        ttft_median=args.ttft_median,
+        ttft_p99=args.ttft_p99,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI 兼容的模拟 LLM 服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockLLMServer(config_from_args(args), args.host, args.port)
+    print(f"模拟 LLM 服务: {server.base_url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,415 @@
+"""
+基准测试驱动
+启动模拟 LLM 服务，用 gunicorn 按指定的 worker/线程配置启动后端（DEEPSEEK_BASE_URL 指向模拟服务），
+并发执行真实形态的负载，输出 JSON 结果（p50/p95/p99 延迟、首 token 时间、每秒请求数），
+可以保存下来在不同提交之间对比。
+
+负载：
+- outline：生成大纲（流式）
+- document：每个虚拟用户依次生成 30 个章节，previous_content 为不断增长的长文本
+- search：在合成的 10 万条提示词库上搜索 / 分页列出
+- excel：上传合成的 Excel 文件导入，轮询后台任务直到完成
+
+用法（在 backend 目录下）：
+  python -m benchmarks.run --configs 1x50,2x50 --concurrency 8 --output bench.json
+  python -m benchmarks.run --workloads search --prompts 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from benchmarks.mock_llm import MockLLMServer, add_arguments, config_from_args
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKLOADS = ('outline', 'document', 'search', 'excel')
+
+WORDS = ['引言', '背景', '方法', '结果', '讨论', '总结', '市场', '技术', '风险', '方案', '需求', '架构',
+         '测试', '部署', '运营', '财务', '用户', '数据', '安全', '性能', '规划', '评估', '案例', '趋势']
+
+
+# ==================== 统计 ====================
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 4)
+
+
+def summarize(samples: List[Dict], wall_time: float) -> Dict:
+    ok = [sample for sample in samples if not sample.get('error')]
+    latencies = [sample['latency'] for sample in ok]
+    ttfts = [sample['ttft'] for sample in ok if sample.get('ttft') is not None]
+    result = {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'wall_time': round(wall_time, 3),
+        'rps': round(len(ok) / wall_time, 3) if wall_time > 0 else None,
+        'latency': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99), 'max': percentile(latencies, 100)},
+    }
+    if ttfts:
+        result['ttft'] = {'p50': percentile(ttfts, 50), 'p95': percentile(ttfts, 95), 'p99': percentile(ttfts, 99)}
+    errors = sorted({sample['error'] for sample in samples if sample.get('error')})
+    if errors:
+        result['error_samples'] = errors[:5]
+    return result
+
+
+# ==================== 客户端 ====================
+
+def stream_request(client: httpx.Client, path: str, body: Dict) -> Dict:
+    """请求流式接口并读完整个 SSE 流，返回 {latency, ttft, chars, error}"""
+    started = time.perf_counter()
+    sample = {'ttft': None, 'chars': 0, 'text': ''}
+    parts = []
+    try:
+        with client.stream('POST', path, json=body) as response:
+            if response.status_code != 200:
+                response.read()
+                sample['error'] = f'HTTP {response.status_code}'
+            else:
+                for line in response.iter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[6:])
+                    if event.get('content'):
+                        if sample['ttft'] is None:
+                            sample['ttft'] = time.perf_counter() - started
+                        parts.append(event['content'])
+                    if event.get('error'):
+                        sample['error'] = str(event['error'])[:200]
+                    if event.get('done') or event.get('error'):
+                        break
+    except httpx.HTTPError as e:
+        sample['error'] = f'{type(e).__name__}: {e}'[:200]
+    sample['latency'] = time.perf_counter() - started
+    sample['text'] = ''.join(parts)
+    sample['chars'] = len(sample['text'])
+    return sample
+
+
+def json_request(client: httpx.Client, method: str, path: str, **kwargs) -> Dict:
+    started = time.perf_counter()
+    sample = {}
+    try:
+        response = client.request(method, path, **kwargs)
+        if response.status_code >= 400:
+            sample['error'] = f'HTTP {response.status_code}'
+        sample['body'] = response.json() if response.headers.get('content-type', '').startswith('application/json') else None
+    except httpx.HTTPError as e:
+        sample['error'] = f'{type(e).__name__}: {e}'[:200]
+    sample['latency'] = time.perf_counter() - started
+    return sample
+
+
+def run_users(base_url: str, users: int, user_task: Callable[[httpx.Client, int], List[Dict]]) -> Dict:
+    """users 个虚拟用户并发执行 user_task，汇总所有请求的样本"""
+    samples: List[Dict] = []
+    lock = threading.Lock()
+
+    def run(user: int):
+        with httpx.Client(base_url=base_url, timeout=httpx.Timeout(600, connect=10)) as client:
+            result = user_task(client, user)
+        with lock:
+            samples.extend(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(run, range(users)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+# ==================== 负载 ====================
+
+def outline_workload(args) -> Callable:
+    def task(client, user):
+        return [stream_request(client, '/api/generate-outline', {'topic': f'基准测试主题 {user}-{i} {random.random()}'})
+                for i in range(args.outline_requests)]
+    return task
+
+
+def document_workload(args) -> Callable:
+    def task(client, user):
+        topic = f'基准测试文档 {user} {random.random()}'
+        sections = [f'第{i + 1}章 {random.choice(WORDS)}' for i in range(args.sections)]
+        outline = '\n'.join(f'## {title}' for title in sections)
+        previous = '前文内容。' * (args.previous_chars // 5)  # 模拟已有的长文档
+        samples = []
+        for index, title in enumerate(sections):
+            sample = stream_request(client, '/api/generate-section', {
+                'topic': topic, 'outline': outline, 'current_section': title,
+                'previous_content': previous, 'section_index': index,
+            })
+            previous += f'\n\n## {title}\n\n' + sample.pop('text')
+            samples.append(sample)
+        return samples
+    return task
+
+
+def search_workload(args) -> Callable:
+    def task(client, user):
+        samples = []
+        rng = random.Random(user)
+        for i in range(args.search_requests):
+            if i % 4 == 3:
+                sample = json_request(client, 'GET', '/api/prompts', params={'limit': 50, 'fields': 'id,title'})
+            else:
+                query = ' '.join(rng.sample(WORDS, 2))
+                sample = json_request(client, 'POST', '/api/prompts/search', json={'query': query, 'limit': 10})
+            sample.pop('body', None)
+            samples.append(sample)
+        return samples
+    return task
+
+
+def excel_workload(args, excel_path: str) -> Callable:
+    def task(client, user):
+        started = time.perf_counter()
+        with open(excel_path, 'rb') as f:
+            sample = json_request(client, 'POST', '/api/prompts/import-excel',
+                                  files={'file': ('bench.xlsx', f, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')})
+        job_id = (sample.pop('body', None) or {}).get('job_id')
+        if sample.get('error') or not job_id:
+            sample.setdefault('error', '没有返回 job_id')
+            return [sample]
+        while True:
+            job = json_request(client, 'GET', f'/api/jobs/{job_id}').get('body') or {}
+            if job.get('status') not in ('pending', 'running'):
+                break
+            time.sleep(0.2)
+        result = {'latency': time.perf_counter() - started}
+        if job.get('status') != 'done':
+            result['error'] = f"任务状态 {job.get('status')}: {job.get('error')}"
+        return [result]
+    return task
+
+
+# ==================== 数据准备 ====================
+
+def populate_dataset(rows: int):
+    """在当前目录生成合成提示词库和语义索引快照（在子进程中运行，prompt_database 的默认库就在当前目录）"""
+    from prompt_database import db
+    from prompt_vectors import PromptVectorIndex
+
+    rng = random.Random(42)
+    category_ids = [db.create_category(f'基准分类{i}') for i in range(20)]
+    with db.connection() as conn:
+        for start in range(0, rows, 5000):
+            conn.executemany(
+                'INSERT INTO prompts (title, content, category_id, keywords) VALUES (?, ?, ?, ?)',
+                [(
+                    f"{rng.choice(WORDS)}{rng.choice(WORDS)}写作提示 {start + i}",
+                    '请围绕' + '、'.join(rng.sample(WORDS, 4)) + '展开论述，' + '注意结构清晰、论据充分。' * 8,
+                    rng.choice(category_ids),
+                    ','.join(rng.sample(WORDS, 3)),
+                ) for i in range(min(5000, rows - start))]
+            )
+
+    index = PromptVectorIndex(db, os.path.abspath('prompt_vectors'))
+    index.sync()
+    index.save()
+
+
+def build_dataset(cache_dir: str, rows: int) -> str:
+    """合成提示词库（含语义索引快照），按行数缓存，返回数据目录"""
+    dataset_dir = os.path.join(cache_dir, f'prompts-{rows}')
+    if os.path.exists(os.path.join(dataset_dir, 'prompts.db')):
+        return dataset_dir
+
+    building_dir = dataset_dir + '.building'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    os.makedirs(building_dir)
+    print(f"生成合成提示词库: {rows} 条 -> {dataset_dir}", file=sys.stderr)
+    subprocess.check_call(
+        [sys.executable, '-c', f'from benchmarks.run import populate_dataset; populate_dataset({int(rows)})'],
+        cwd=building_dir, env=dict(os.environ, PYTHONPATH=BACKEND_DIR)
+    )
+    os.replace(building_dir, dataset_dir)
+    return dataset_dir
+
+
+def build_excel(cache_dir: str, rows: int) -> str:
+    path = os.path.join(cache_dir, f'import-{rows}.xlsx')
+    if os.path.exists(path):
+        return path
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['标题', '内容', '分类', '关键词'])
+    rng = random.Random(7)
+    for i in range(rows):
+        sheet.append([f'导入提示词 {i}', '导入的提示词内容。' * 10, f'导入分类{i % 10}', ','.join(rng.sample(WORDS, 3))])
+    workbook.save(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+# ==================== 服务进程 ====================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """在独立工作目录中用 gunicorn 启动后端"""
+
+    def __init__(self, dataset_dir: str, llm_base_url: str, workers: int, threads: int):
+        self.workdir = tempfile.mkdtemp(prefix='long-context-bench-')
+        for name in os.listdir(dataset_dir):
+            if name.startswith(('prompts.db', 'prompt_vectors')):
+                shutil.copy(os.path.join(dataset_dir, name), self.workdir)
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        env = dict(os.environ,
+                   DEEPSEEK_API_KEY='bench',
+                   DEEPSEEK_BASE_URL=llm_base_url,
+                   METRICS_DIR=os.path.join(self.workdir, 'metrics'),
+                   RESPONSE_CACHE='false')
+        command = [sys.executable, '-m', 'gunicorn',
+                   '-c', os.path.join(BACKEND_DIR, 'gunicorn.conf.py'),
+                   '--chdir', self.workdir, '--pythonpath', BACKEND_DIR,
+                   '--bind', f'127.0.0.1:{self.port}', '--workers', str(workers), '--threads', str(threads),
+                   'app:app']
+        self.log = open(os.path.join(self.workdir, 'gunicorn.log'), 'w')
+        self.process = subprocess.Popen(command, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'gunicorn 启动失败，日志: {self.log.name}')
+            try:
+                if httpx.get(self.base_url + '/api/health', timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('等待后端启动超时')
+
+    def metrics(self) -> str:
+        try:
+            return httpx.get(self.base_url + '/api/metrics', timeout=10).text
+        except httpx.HTTPError:
+            return ''
+
+    def stop(self, keep: bool = False):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_configs(value: str) -> List[Dict[str, int]]:
+    """"1x50,2x50" -> [{'workers': 1, 'threads': 50}, ...]"""
+    configs = []
+    for item in value.split(','):
+        workers, _, threads = item.strip().partition('x')
+        configs.append({'workers': int(workers), 'threads': int(threads or 50)})
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='后端基准测试（使用本地模拟 LLM 服务）')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='逗号分隔: ' + ','.join(WORKLOADS))
+    parser.add_argument('--configs', default='1x50', help='gunicorn 配置列表，格式 <workers>x<threads>，逗号分隔')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发虚拟用户数')
+    parser.add_argument('--outline-requests', type=int, default=5, help='每个用户生成大纲的次数')
+    parser.add_argument('--sections', type=int, default=30, help='每篇文档的章节数')
+    parser.add_argument('--previous-chars', type=int, default=20000, help='文档生成时已有前文的字数')
+    parser.add_argument('--search-requests', type=int, default=200, help='每个用户的搜索请求数')
+    parser.add_argument('--prompts', type=int, default=100000, help='合成提示词库的行数')
+    parser.add_argument('--excel-rows', type=int, default=10000)
+    parser.add_argument('--excel-imports', type=int, default=1, help='并发导入的 Excel 文件数')
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'long-context-bench'),
+                        help='合成数据的缓存目录')
+    parser.add_argument('--output', help='结果 JSON 文件（默认输出到标准输出）')
+    parser.add_argument('--keep-workdir', action='store_true', help='保留每次运行的工作目录（含 gunicorn 日志）')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    workloads = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"未知的负载: {', '.join(sorted(unknown))}")
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    dataset_dir = build_dataset(args.cache_dir, args.prompts)
+    excel_path = build_excel(args.cache_dir, args.excel_rows) if 'excel' in workloads else None
+
+    mock = MockLLMServer(config_from_args(args)).start()
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(),
+        'mock': {key: getattr(args, key) for key in ('tokens_per_second', 'completion_tokens', 'ttft_median',
+                                                      'ttft_p99', 'error_rate', 'rate_limit_rate', 'disconnect_rate')},
+        'params': {key: getattr(args, key) for key in ('concurrency', 'outline_requests', 'sections', 'previous_chars',
+                                                        'search_requests', 'prompts', 'excel_rows', 'excel_imports')},
+        'runs': [],
+    }
+
+    try:
+        for config in parse_configs(args.configs):
+            server = AppServer(dataset_dir, mock.base_url, config['workers'], config['threads'])
+            run = dict(config, workloads={})
+            try:
+                server.wait_ready()
+                for name in workloads:
+                    print(f"[{config['workers']}x{config['threads']}] {name} ...", file=sys.stderr)
+                    if name == 'outline':
+                        run['workloads'][name] = run_users(server.base_url, args.concurrency, outline_workload(args))
+                    elif name == 'document':
+                        run['workloads'][name] = run_users(server.base_url, args.concurrency, document_workload(args))
+                    elif name == 'search':
+                        run['workloads'][name] = run_users(server.base_url, args.concurrency, search_workload(args))
+                    elif name == 'excel':
+                        run['workloads'][name] = run_users(server.base_url, args.excel_imports,
+                                                           excel_workload(args, excel_path))
+            finally:
+                server.stop(keep=args.keep_workdir)
+            report['runs'].append(run)
+    finally:
+        mock.stop()
+    report['mock']['stats'] = dict(mock.config.stats)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+提示词目录缓存模块
+对提示词列表、分类列表等读多写少的接口做进程内的读穿透缓存：
+缓存的是序列化好的响应体和内容哈希（ETag），按数据版本失效。
+数据版本由两部分组成：
+- 本进程的写入代数（PromptDatabase.generation，每次提交修改后加一）
+- 专用监视连接上的 PRAGMA data_version（其他连接/其他 worker 进程提交修改后会变化）
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from prompt_database import PromptDatabase
+
+
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', 256))
+
+
+class CatalogCache:
+    def __init__(self, database: PromptDatabase):
+        self.database = database
+        self._entries: Dict[str, Tuple[Tuple[int, int], bytes, str]] = {}  # key -> (版本, 响应体, ETag)
+        self._lock = threading.Lock()
+        self._watch: Optional[sqlite3.Connection] = None
+        self._watch_pid = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _data_version(self) -> int:
+        """监视连接上的 data_version（调用方需持有锁；fork 之后重建连接）"""
+        if self._watch is None or self._watch_pid != os.getpid():
+            self._watch = sqlite3.connect(self.database.db_path, check_same_thread=False)
+            self._watch_pid = os.getpid()
+        return self._watch.execute('PRAGMA data_version').fetchone()[0]
+
+    def version(self) -> Tuple[int, int]:
+        with self._lock:
+            return self.database.generation, self._data_version()
+
+    def get(self, key: str, build: Callable[[], bytes]) -> Tuple[bytes, str]:
+        """读取缓存的响应体和 ETag；数据版本变化后调用 build() 重新生成"""
+        version = self.version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        # 先取版本再读数据：读取期间有新的写入时，数据只会比版本新，下次请求会重新生成
+        body = build()
+        etag = hashlib.sha1(body).hexdigest()  # 按内容计算，不同 worker 的 ETag 一致
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= CATALOG_CACHE_MAX_ENTRIES:
+                self._entries.clear()
+            self._entries[key] = (version, body, etag)
+        return body, etag
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,164 @@
+"""
+上下文预算模块
+按 token（而不是字符数）控制发给模型的上下文：
+- count_tokens：估算 token 数。配置 CONTEXT_TOKENIZER_PATH（tokenizer.json）且安装了 tokenizers 时用真实分词器，
+  否则按 DeepSeek 官方的经验比例估算（1 个汉字约 0.6 token，1 个英文字符约 0.3 token）
+- trim_to_tokens：按章节标题、段落、句子的边界裁剪到指定 token 数，保留开头或结尾
+- allocate_context：把总预算按权重分给大纲、摘要、最近内容、章节提示词等部分，用不完的额度分给其他部分
+- completion_budget：根据提示词长度和模型上下文窗口计算本次请求的 max_tokens
+"""
+
+import math
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+LLM_CONTEXT_WINDOW = int(os.environ.get('LLM_CONTEXT_WINDOW', 65536))
+LLM_MAX_OUTPUT_TOKENS = int(os.environ.get('LLM_MAX_OUTPUT_TOKENS', 8192))
+LLM_MIN_OUTPUT_TOKENS = int(os.environ.get('LLM_MIN_OUTPUT_TOKENS', 256))
+CONTEXT_SAFETY_TOKENS = int(os.environ.get('CONTEXT_SAFETY_TOKENS', 512))
+
+# 章节生成：上下文总预算、生成长度上限、前文超过多少 token 时改用摘要、摘要时保留的最近内容
+SECTION_CONTEXT_TOKENS = int(os.environ.get('SECTION_CONTEXT_TOKENS', 6000))
+SECTION_MAX_TOKENS = int(os.environ.get('SECTION_MAX_TOKENS', 4000))
+PREVIOUS_CONTENT_SUMMARY_TOKENS = int(os.environ.get('PREVIOUS_CONTENT_SUMMARY_TOKENS', 1800))
+RECENT_CONTENT_TOKENS = int(os.environ.get('RECENT_CONTENT_TOKENS', 600))
+
+CONTEXT_TOKENIZER_PATH = os.environ.get('CONTEXT_TOKENIZER_PATH', '')
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 裁剪边界，从粗到细：Markdown 标题之前、空行之后、句末标点/换行之后
+_BOUNDARIES = [
+    re.compile(r'(?m)^(?=#{1,6}\s)'),
+    re.compile(r'(?<=\n\n)'),
+    re.compile(r'(?<=[。！？；.!?;\n])'),
+]
+
+_tokenizer = None
+if CONTEXT_TOKENIZER_PATH:
+    try:
+        from tokenizers import Tokenizer
+        _tokenizer = Tokenizer.from_file(CONTEXT_TOKENIZER_PATH)
+    except Exception as e:
+        print(f"加载分词器失败，改用估算: {e}")
+
+
+def count_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    if _tokenizer is not None:
+        return len(_tokenizer.encode(text, add_special_tokens=False).ids)
+    cjk = len(_CJK_PATTERN.findall(text))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+def message_tokens(messages: List[Dict[str, str]]) -> int:
+    """消息列表的 token 数（每条消息另加少量格式开销）"""
+    return sum(count_tokens(message.get('content') or '') + 4 for message in messages)
+
+
+def _cut(text: str, max_tokens: int, keep: str) -> str:
+    """没有可用边界时按字符截断"""
+    length = int(len(text) * max_tokens / max(count_tokens(text), 1))
+    while length > 0:
+        piece = text[-length:] if keep == 'tail' else text[:length]
+        if count_tokens(piece) <= max_tokens:
+            return piece
+        length = int(length * 0.9)
+    return ''
+
+
+def trim_to_tokens(text: str, max_tokens: int, keep: str = 'tail', level: int = 0) -> str:
+    """裁剪到 max_tokens 以内，尽量在章节/段落/句子边界处截断
+
+    keep='tail' 保留结尾（最近的内容），keep='head' 保留开头（大纲、摘要）
+    """
+    if not text or max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+    if level >= len(_BOUNDARIES):
+        return _cut(text, max_tokens, keep)
+
+    pieces = [piece for piece in _BOUNDARIES[level].split(text) if piece]
+    if keep == 'tail':
+        pieces.reverse()
+    kept = []
+    used = 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if used + tokens > max_tokens:
+            # 放不下的这一块在更细的边界上裁剪，用完剩余的额度；
+            # 已经是句子边界时只有一块都放不下才按字符截断，避免留下半句话
+            if not kept or level + 1 < len(_BOUNDARIES):
+                kept.append(trim_to_tokens(piece, max_tokens - used, keep, level + 1))
+            break
+        kept.append(piece)
+        used += tokens
+    if keep == 'tail':
+        kept.reverse()
+    return ''.join(kept)
+
+
+class ContextPart:
+    """上下文的一个组成部分：weight 为预算分配权重，max_tokens 为该部分的上限"""
+
+    def __init__(self, name: str, text: str, weight: float = 1.0, keep: str = 'tail',
+                 max_tokens: Optional[int] = None):
+        self.name = name
+        self.text = text or ''
+        self.weight = weight
+        self.keep = keep
+        self.max_tokens = max_tokens
+
+
+def allocate_context(parts: List[ContextPart], budget: int) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """按权重把 budget 分给各部分并裁剪，返回 (各部分文本, 各部分 token 数)
+
+    需要的比分到的少的部分只拿需要的量，剩余额度按权重再分给其他部分
+    """
+    needed = {}
+    for part in parts:
+        tokens = count_tokens(part.text)
+        needed[part.name] = tokens if part.max_tokens is None else min(tokens, part.max_tokens)
+
+    allocation = {}
+    remaining = max(budget, 0)
+    active = [part for part in parts if needed[part.name] > 0]
+    while active:
+        total_weight = sum(part.weight for part in active) or 1.0
+        satisfied = [part for part in active if needed[part.name] <= remaining * part.weight / total_weight]
+        if not satisfied:
+            for part in active:
+                allocation[part.name] = int(remaining * part.weight / total_weight)
+            break
+        for part in satisfied:
+            allocation[part.name] = needed[part.name]
+            remaining -= needed[part.name]
+            active.remove(part)
+
+    texts = {}
+    usage = {}
+    for part in parts:
+        limit = allocation.get(part.name, 0)
+        text = part.text if count_tokens(part.text) <= limit else trim_to_tokens(part.text, limit, part.keep)
+        texts[part.name] = text
+        usage[part.name] = count_tokens(text)
+    return texts, usage
+
+
+def completion_budget(messages: List[Dict[str, str]], desired: int = SECTION_MAX_TOKENS) -> int:
+    """本次请求的 max_tokens：不超过期望值、模型输出上限和上下文窗口的剩余空间"""
+    available = LLM_CONTEXT_WINDOW - message_tokens(messages) - CONTEXT_SAFETY_TOKENS
+    return max(LLM_MIN_OUTPUT_TOKENS, min(desired, LLM_MAX_OUTPUT_TOKENS, available))
+
+
+def log_token_usage(endpoint: str, messages: List[Dict[str, str]], max_tokens: int,
+                    usage: Optional[Dict[str, int]] = None):
+    """打印单次请求的 token 用量（提示词、各上下文部分、max_tokens）"""
+    used = [f'{name}={tokens}' for name, tokens in (usage or {}).items() if tokens]
+    detail = ' (' + ', '.join(used) + ')' if used else ''
+    print(f"[tokens] {endpoint}: 提示词约 {message_tokens(messages)}{detail}, max_tokens={max_tokens}")
@@ -0,0 +1,164 @@
+"""
+整篇文档生成模块
+解析大纲得到章节列表，在有界线程池中调度各章节的生成：
+只依赖大纲和章节提示词的章节并行生成；依赖前文的章节按"顺序窗口"等待前面的章节完成，
+并把这些章节的正文作为上下文。所有章节的输出合并成一个按章节编号标记的事件流。
+"""
+
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+DOCUMENT_MAX_PARALLEL = int(os.environ.get('DOCUMENT_MAX_PARALLEL', 8))
+DOCUMENT_SEQUENTIAL_WINDOW = int(os.environ.get('DOCUMENT_SEQUENTIAL_WINDOW', 0))
+
+_TASK_DONE = object()
+
+# generate_section(index, section, previous_content) -> 文本片段迭代器（可选 close()）
+SectionGenerator = Callable[[int, Dict[str, str], str], Iterable[str]]
+
+
+def parse_outline_sections(outline: str) -> List[Dict[str, str]]:
+    """解析大纲中的章节标题（## 及以上）和标题下方的章节提示词
+
+    与前端 WritingWorkspace 的 parseOutlineSections 保持一致
+    """
+    lines = outline.split('\n')
+    sections = []
+    current = None
+    prompt_lines = []
+
+    def flush():
+        if current is not None:
+            current['hint'] = '\n'.join(prompt_lines).strip()
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if re.match(r'^#{2,}\s+', stripped):
+            flush()
+            current = {'title': stripped, 'hint': ''}
+            sections.append(current)
+            prompt_lines = []
+        elif current is not None:
+            if stripped == '<!-- PROMPT_START -->':
+                i += 1
+                explicit = []
+                while i < len(lines) and lines[i].strip() != '<!-- PROMPT_END -->':
+                    explicit.append(lines[i])
+                    i += 1
+                if explicit:
+                    prompt_lines = explicit
+            elif stripped or prompt_lines:
+                prompt_lines.append(line)
+        i += 1
+    flush()
+
+    return sections
+
+
+class DocumentGeneration:
+    def __init__(self, sections: List[Dict[str, str]], generate_section: SectionGenerator,
+                 max_parallel: int = DOCUMENT_MAX_PARALLEL,
+                 sequential_window: int = DOCUMENT_SEQUENTIAL_WINDOW,
+                 dependent_sections: Optional[Iterable[int]] = None,
+                 on_section_done: Optional[Callable[[int, Dict[str, str], str], None]] = None):
+        """
+        sequential_window: 依赖前文的章节要等待前面多少个章节完成，并把它们的正文作为上下文
+        dependent_sections: 依赖前文的章节编号；为 None 时，窗口大于 0 则所有章节都依赖前文
+        """
+        self.sections = sections
+        self.generate_section = generate_section
+        self.max_parallel = max(1, min(max_parallel, DOCUMENT_MAX_PARALLEL))
+        self.sequential_window = max(0, sequential_window)
+        if dependent_sections is None:
+            dependent_sections = range(len(sections)) if self.sequential_window else ()
+        self.dependent_sections = set(dependent_sections)
+        self.on_section_done = on_section_done
+
+        self._events = queue.Queue()
+        self._finished = [threading.Event() for _ in sections]
+        self._texts = [''] * len(sections)
+        self._cancelled = threading.Event()
+        self._streams: Dict[int, object] = {}  # 正在输出的章节流，取消时关闭
+
+    def dependencies(self, index: int) -> List[int]:
+        """章节依赖的前文章节编号"""
+        if index not in self.dependent_sections or not self.sequential_window:
+            return []
+        return list(range(max(0, index - self.sequential_window), index))
+
+    def cancel(self):
+        """停止所有章节的生成（例如客户端断开），正在输出的章节立即关闭上游"""
+        self._cancelled.set()
+        for finished in self._finished:
+            finished.set()
+        for stream in list(self._streams.values()):
+            if hasattr(stream, 'close'):
+                stream.close()
+
+    def _run_section(self, index: int):
+        section = self.sections[index]
+        try:
+            dependencies = self.dependencies(index)
+            for dependency in dependencies:
+                self._finished[dependency].wait()
+            if self._cancelled.is_set():
+                return
+
+            previous_content = ''.join(
+                f"\n\n{self.sections[j]['title']}\n\n{self._texts[j]}" for j in dependencies
+            )
+            self._events.put({'section_id': index, 'section': section['title'], 'started': True})
+
+            stream = self.generate_section(index, section, previous_content)
+            self._streams[index] = stream
+            if self._cancelled.is_set():  # 登记之前已经取消
+                return
+            parts = []
+            try:
+                for text in stream:
+                    if self._cancelled.is_set():
+                        return
+                    parts.append(text)
+                    self._events.put({'section_id': index, 'content': text})
+            finally:
+                self._streams.pop(index, None)
+                if hasattr(stream, 'close'):
+                    stream.close()
+            if self._cancelled.is_set():  # 上游被关闭，输出不完整
+                return
+
+            self._texts[index] = ''.join(parts)
+            if self.on_section_done:
+                self.on_section_done(index, section, self._texts[index])
+            self._events.put({'section_id': index, 'section_done': True})
+        except Exception as e:
+            self._events.put({'section_id': index, 'error': str(e)})
+        finally:
+            self._finished[index].set()
+            self._events.put(_TASK_DONE)
+
+    def events(self) -> Iterator[Dict]:
+        """启动生成并按完成顺序产出事件"""
+        executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix='document-section')
+        try:
+            # 按顺序提交：依赖的章节编号总是更小，一定已经开始执行，不会占满线程池而死锁
+            for index in range(len(self.sections)):
+                executor.submit(self._run_section, index)
+
+            remaining = len(self.sections)
+            while remaining:
+                event = self._events.get()
+                if event is _TASK_DONE:
+                    remaining -= 1
+                    continue
+                yield event
+        finally:
+            self.cancel()
+            executor.shutdown(wait=False)
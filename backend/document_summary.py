@@ -0,0 +1,237 @@
+"""
+文档滚动摘要模块
+每个章节生成完成后，在后台把它压缩成章节摘要，再合并进文档整体摘要（两级结构）。
+生成后续章节时直接读取已有摘要作为上下文，不再同步调用 LLM 摘要整段 previous_content。
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from prompt_database import ConnectionPool
+
+
+DOC_SUMMARY_WORKERS = int(os.environ.get('DOC_SUMMARY_WORKERS', 2))
+SECTION_DIGEST_MAX_TOKENS = 300
+DOCUMENT_DIGEST_MAX_TOKENS = 600
+SECTION_DIRECT_CHARS = 300  # 章节正文不超过此长度时直接作为摘要
+DOCUMENT_DIRECT_CHARS = 1500  # 章节摘要合计不超过此长度时直接拼接为文档摘要
+DOCUMENT_REBUILD_INPUT_CHARS = 12000  # 重建文档摘要时输入的最大长度
+RECENT_SECTION_DIGESTS = 2  # 上下文中额外附带的最近章节摘要数
+
+# summarize(messages, max_tokens) -> str
+Summarizer = Callable[[List[Dict[str, str]], int], str]
+
+
+class DocumentSummaryStore:
+    def __init__(self, db_path: str, summarize: Summarizer, max_workers: int = DOC_SUMMARY_WORKERS):
+        """初始化摘要存储，summarize 为同步的 LLM 摘要调用"""
+        self.summarize = summarize
+        self.pool = ConnectionPool(db_path, max_size=4)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers),
+                                            thread_name_prefix='doc-summary')
+        self._locks = defaultdict(threading.Lock)
+        self._locks_guard = threading.Lock()
+        self._init_database()
+
+    def _init_database(self):
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS section_digests (
+                    document_id TEXT NOT NULL,
+                    section_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    title TEXT,
+                    digest TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (document_id, section_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_section_digests_position
+                ON section_digests(document_id, position)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS document_digests (
+                    document_id TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    last_position INTEGER NOT NULL,
+                    section_count INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+
+    def _document_lock(self, document_id: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks[document_id]
+
+    # ==================== 写入 ====================
+
+    def record_section(self, document_id: str, section_id: str, title: str, content: str,
+                       position: Optional[int] = None) -> Future:
+        """章节完成后调用：后台生成章节摘要并合并进文档摘要"""
+        return self._executor.submit(self._fold_section, document_id, section_id,
+                                     title, content, position)
+
+    def _fold_section(self, document_id: str, section_id: str, title: str, content: str,
+                      position: Optional[int]):
+        content = content.strip()
+        if not content:
+            return
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+        try:
+            with self._document_lock(document_id):
+                with self.pool.connection() as conn:
+                    existing = conn.execute(
+                        '''SELECT position, content_hash FROM section_digests
+                           WHERE document_id = ? AND section_id = ?''',
+                        (document_id, section_id)
+                    ).fetchone()
+                    if existing and existing['content_hash'] == content_hash:
+                        return
+                    if position is None:
+                        if existing:
+                            position = existing['position']
+                        else:
+                            row = conn.execute(
+                                'SELECT MAX(position) AS max_position FROM section_digests WHERE document_id = ?',
+                                (document_id,)
+                            ).fetchone()
+                            position = 0 if row['max_position'] is None else row['max_position'] + 1
+                    document = conn.execute(
+                        'SELECT digest, last_position FROM document_digests WHERE document_id = ?',
+                        (document_id,)
+                    ).fetchone()
+
+                # LLM 调用期间不占用数据库连接
+                digest = self._summarize_section(title, content)
+                now = time.time()
+                with self.pool.connection() as conn:
+                    conn.execute(
+                        '''INSERT OR REPLACE INTO section_digests
+                           (document_id, section_id, position, title, digest, content_hash, updated_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                        (document_id, section_id, position, title, digest, content_hash, now)
+                    )
+
+                # 新章节追加在末尾时滚动合并；修改了已有章节则从章节摘要重建
+                if existing is None and document is not None and position > document['last_position']:
+                    document_digest = self._fold(document['digest'], title, digest)
+                else:
+                    document_digest = self._rebuild(document_id)
+
+                with self.pool.connection() as conn:
+                    stats = conn.execute(
+                        '''SELECT COUNT(*) AS section_count, MAX(position) AS last_position
+                           FROM section_digests WHERE document_id = ?''',
+                        (document_id,)
+                    ).fetchone()
+                    conn.execute(
+                        '''INSERT OR REPLACE INTO document_digests
+                           (document_id, digest, last_position, section_count, updated_at)
+                           VALUES (?, ?, ?, ?, ?)''',
+                        (document_id, document_digest, stats['last_position'],
+                         stats['section_count'], time.time())
+                    )
+        except Exception as e:
+            print(f"更新文档摘要失败 ({document_id}/{section_id}): {e}")
+
+    def _summarize_section(self, title: str, content: str) -> str:
+        """第一级：章节摘要"""
+        if len(content) <= SECTION_DIRECT_CHARS:
+            return content
+        messages = [
+            {"role": "system", "content": "你是一位专业的内容总结助手。"},
+            {"role": "user", "content": f"请简要概括以下章节的核心要点（150字以内）：\n\n章节：{title}\n\n{content}"}
+        ]
+        return self.summarize(messages, SECTION_DIGEST_MAX_TOKENS).strip()
+
+    def _fold(self, document_digest: str, title: str, section_digest: str) -> str:
+        """第二级：把新章节摘要滚动合并进文档摘要"""
+        combined = f"{document_digest}\n{title}：{section_digest}"
+        if len(combined) <= DOCUMENT_DIRECT_CHARS:
+            return combined
+        messages = [
+            {"role": "system", "content": "你是一位专业的内容总结助手。"},
+            {"role": "user", "content": f"""下面是一篇文档已有内容的摘要，以及新完成章节的摘要。请把它们合并成一份新的文档摘要（400字以内），保留各章节的关键信息和先后顺序：
+
+已有摘要：
+{document_digest}
+
+新章节：{title}
+{section_digest}"""}
+        ]
+        return self.summarize(messages, DOCUMENT_DIGEST_MAX_TOKENS).strip()
+
+    def _rebuild(self, document_id: str) -> str:
+        """第二级：从全部章节摘要重建文档摘要"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT title, digest FROM section_digests WHERE document_id = ? ORDER BY position',
+                (document_id,)
+            ).fetchall()
+        combined = "\n".join(f"{row['title']}：{row['digest']}" for row in rows)
+        if len(combined) <= DOCUMENT_DIRECT_CHARS:
+            return combined
+        if len(combined) > DOCUMENT_REBUILD_INPUT_CHARS:
+            half = DOCUMENT_REBUILD_INPUT_CHARS // 2
+            combined = f"{combined[:half]}\n...（中间省略）...\n{combined[-half:]}"
+        messages = [
+            {"role": "system", "content": "你是一位专业的内容总结助手。"},
+            {"role": "user", "content": f"下面是一篇文档各章节的摘要，请合并成一份文档摘要（400字以内），保留各章节的关键信息和先后顺序：\n\n{combined}"}
+        ]
+        return self.summarize(messages, DOCUMENT_DIGEST_MAX_TOKENS).strip()
+
+    # ==================== 读取 ====================
+
+    def get_context(self, document_id: str, position: Optional[int] = None) -> Optional[str]:
+        """生成章节时使用的上下文：文档摘要 + 当前章节之前最近几个章节的摘要"""
+        with self.pool.connection() as conn:
+            document = conn.execute(
+                'SELECT digest FROM document_digests WHERE document_id = ?', (document_id,)
+            ).fetchone()
+            if not document:
+                return None
+            if position is None:
+                recent = conn.execute(
+                    '''SELECT title, digest FROM section_digests WHERE document_id = ?
+                       ORDER BY position DESC LIMIT ?''',
+                    (document_id, RECENT_SECTION_DIGESTS)
+                ).fetchall()
+            else:
+                recent = conn.execute(
+                    '''SELECT title, digest FROM section_digests WHERE document_id = ? AND position < ?
+                       ORDER BY position DESC LIMIT ?''',
+                    (document_id, position, RECENT_SECTION_DIGESTS)
+                ).fetchall()
+
+        parts = [document['digest']]
+        if recent:
+            parts.append("\n最近章节要点：")
+            parts.extend(f"{row['title']}：{row['digest']}" for row in reversed(recent))
+        return "\n".join(parts)
+
+    def get_summary(self, document_id: str) -> Optional[Dict]:
+        """获取文档摘要及各章节摘要"""
+        with self.pool.connection() as conn:
+            document = conn.execute(
+                'SELECT * FROM document_digests WHERE document_id = ?', (document_id,)
+            ).fetchone()
+            if not document:
+                return None
+            sections = conn.execute(
+                '''SELECT section_id, position, title, digest, updated_at FROM section_digests
+                   WHERE document_id = ? ORDER BY position''',
+                (document_id,)
+            ).fetchall()
+        return {
+            'document': dict(document),
+            'sections': [dict(row) for row in sections],
+        }
@@ -0,0 +1,512 @@
+"""
+生成缓冲区模块
+每次流式生成分配一个 generation id，生成结果写入服务端的有界环形缓冲区。
+生成在后台线程中进行，与 HTTP 连接解耦：客户端断线后带 Last-Event-ID 重连，
+可以从断开的位置继续读取，不需要再次调用 LLM。
+缓冲区在结束后按 TTL 过期，并受总内存上限约束。
+配置了 GenerationStore 时，后台线程每隔 GENERATION_PERSIST_INTERVAL 秒把新事件批量写入共享的 SQLite，
+重连落到其他 worker 时从共享存储轮询读取（RemoteGeneration），同样不需要再次调用 LLM。
+所有读取方都断开、且 GENERATION_DISCONNECT_GRACE 秒内没有重连时取消生成，也可以显式取消（停止按钮）；
+取消时调用登记的回调，立即关闭上游请求。
+停止请求落到其他 worker 时写入共享存储，生成所在的 worker 在写入事件的同时检查并取消。
+在其他 worker 上续读的读取方同样登记在共享存储中（定期刷新），宽限期结束时仍有读取方则不取消。
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import GENERATIONS_CANCELLED
+from prompt_database import ConnectionPool
+
+
+GENERATION_BUFFER_MAX_EVENTS = int(os.environ.get('GENERATION_BUFFER_MAX_EVENTS', 20000))
+GENERATION_BUFFER_TTL = float(os.environ.get('GENERATION_BUFFER_TTL', 600))
+GENERATION_BUFFER_MAX_BYTES = int(os.environ.get('GENERATION_BUFFER_MAX_BYTES', 64 * 1024 * 1024))
+# 最后一个读取方断开后等待重连的秒数（EventSource 默认约 3 秒后重连），0 表示断开即取消
+GENERATION_DISCONNECT_GRACE = float(os.environ.get('GENERATION_DISCONNECT_GRACE', 3))
+GENERATION_PERSIST_INTERVAL = float(os.environ.get('GENERATION_PERSIST_INTERVAL', 0.1))  # 写入共享存储的间隔
+GENERATION_POLL_INTERVAL = float(os.environ.get('GENERATION_POLL_INTERVAL', 0.1))  # 其他 worker 轮询的间隔
+# 未结束的生成超过这么久没有更新，认为所在的进程已经退出
+GENERATION_STALE_SECONDS = float(os.environ.get('GENERATION_STALE_SECONDS', 30))
+# 其他 worker 上的读取方刷新登记的间隔；超过 GENERATION_READER_TIMEOUT 秒没有刷新视为已断开
+GENERATION_READER_HEARTBEAT = float(os.environ.get('GENERATION_READER_HEARTBEAT', 1))
+GENERATION_READER_TIMEOUT = float(os.environ.get('GENERATION_READER_TIMEOUT', 5))
+
+_local = threading.local()
+
+
+class GenerationGone(Exception):
+    """缓冲区已过期，或请求的位置已经被环形缓冲区覆盖"""
+
+
+class GenerationBuffer:
+    def __init__(self, generation_id: str, max_events: int = GENERATION_BUFFER_MAX_EVENTS):
+        self.id = generation_id
+        self.max_events = max(1, max_events)
+        self._events: List[Dict] = []
+        self._first_seq = 0  # _events[0] 的序号，超出容量时从头部丢弃
+        self._cond = threading.Condition()
+        self.size = 0
+        self.finished = False
+        self.updated_at = time.time()
+        self.endpoint = ''
+        self.persist = False  # 是否写入共享存储
+        self.store: Optional['GenerationStore'] = None  # 共享存储，用于检查其他 worker 上的读取方
+        self.saved_finished = False  # 结束状态是否已经写入共享存储
+        self._unsaved: List[Tuple[int, Dict]] = []
+        self.subscribers = 0
+        self.cancelled = False
+        self._cancel_callbacks: List[Callable[[], None]] = []
+
+    @staticmethod
+    def _event_size(event: Dict) -> int:
+        return sum(len(str(value)) for value in event.values()) + 16
+
+    def append(self, event: Dict) -> int:
+        """写入一个事件，返回事件序号"""
+        with self._cond:
+            self._events.append(event)
+            self.size += self._event_size(event)
+            overflow = len(self._events) - self.max_events
+            if overflow > 0:
+                # 批量丢弃头部，摊销列表移动的开销
+                drop = max(overflow, self.max_events // 8)
+                self.size -= sum(self._event_size(e) for e in self._events[:drop])
+                del self._events[:drop]
+                self._first_seq += drop
+            self.updated_at = time.time()
+            self._cond.notify_all()
+            seq = self._first_seq + len(self._events) - 1
+            if self.persist:
+                self._unsaved.append((seq, event))
+            return seq
+
+    def take_unsaved(self) -> Tuple[List[Tuple[int, Dict]], bool]:
+        """取出还没有写入共享存储的事件，返回 ([(序号, 事件), ...], 是否已结束)"""
+        with self._cond:
+            events, self._unsaved = self._unsaved, []
+            return events, self.finished
+
+    def requeue_unsaved(self, events: List[Tuple[int, Dict]]):
+        """写入失败时放回，下次重试"""
+        with self._cond:
+            self._unsaved[:0] = events
+
+    def finish(self):
+        """标记生成结束"""
+        with self._cond:
+            self.finished = True
+            self.updated_at = time.time()
+            self._cond.notify_all()
+
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        """读取方断开；最后一个读取方断开且生成未结束时，宽限期内没有重连就取消生成"""
+        if not self._release():
+            return
+        if GENERATION_DISCONNECT_GRACE <= 0:
+            self._cancel_if_detached()
+            return
+        self._check_detached_later(GENERATION_DISCONNECT_GRACE)
+
+    def _check_detached_later(self, delay: float):
+        timer = threading.Timer(delay, self._cancel_if_detached)
+        timer.daemon = True
+        timer.start()
+
+    def _release(self) -> bool:
+        with self._cond:
+            self.subscribers -= 1
+            return self._detached()
+
+    def _detached(self) -> bool:
+        return self.subscribers <= 0 and not self.finished and not self.cancelled
+
+    def _cancel_if_detached(self):
+        with self._cond:
+            detached = self._detached()
+        if not detached:
+            return
+        if self._has_remote_readers():
+            # 客户端在其他 worker 上续读，稍后再检查
+            self._check_detached_later(max(GENERATION_DISCONNECT_GRACE, GENERATION_READER_HEARTBEAT))
+            return
+        self.cancel('disconnect')
+
+    def _has_remote_readers(self) -> bool:
+        if self.store is None:
+            return False
+        try:
+            return self.store.has_readers(self.id, GENERATION_READER_TIMEOUT)
+        except Exception as e:
+            print(f"检查生成 {self.id} 的读取方失败: {e}")
+            return True  # 无法确认时不取消，稍后再检查
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """登记取消时的回调（关闭上游流等）；已经取消时立即调用"""
+        with self._cond:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason: str) -> bool:
+        """取消生成；已经结束或已经取消时返回 False"""
+        with self._cond:
+            if self.finished or self.cancelled:
+                return False
+            self.cancelled = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        GENERATIONS_CANCELLED.inc(endpoint=self.endpoint, reason=reason)
+        print(f"生成 {self.id} 已取消（{reason}）")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消生成时关闭上游失败: {e}")
+        return True
+
+    def read_after(self, seq: int, timeout: Optional[float] = None) -> Tuple[List[Tuple[int, Dict]], bool]:
+        """读取序号大于 seq 的事件；没有新事件时最多等待 timeout 秒
+
+        返回 ([(序号, 事件), ...], 是否已结束)
+        """
+        with self._cond:
+            next_seq = self._first_seq + len(self._events)
+            if next_seq <= seq + 1 and not self.finished and timeout != 0:
+                self._cond.wait(timeout)
+            if self._first_seq > seq + 1:
+                raise GenerationGone(f'生成 {self.id} 的第 {seq + 1} 个事件已被覆盖')
+            start = seq + 1 - self._first_seq
+            events = list(enumerate(self._events[start:], start=seq + 1))
+            return events, self.finished
+
+
+class GenerationStore:
+    """生成事件的共享存储（SQLite，与 prompts.db 放在同一目录），所有 worker 都可以读取"""
+
+    def __init__(self, db_path: str):
+        self.pool = ConnectionPool(db_path, max_size=4)
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS generations (
+                    id TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL DEFAULT '',
+                    finished INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS generation_events (
+                    generation_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (generation_id, seq)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS generation_readers (
+                    generation_id TEXT NOT NULL,
+                    reader_id TEXT NOT NULL,
+                    seen_at REAL NOT NULL,
+                    PRIMARY KEY (generation_id, reader_id)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS generation_cancels (
+                    generation_id TEXT PRIMARY KEY,
+                    reason TEXT NOT NULL,
+                    requested_at REAL NOT NULL
+                )
+            ''')
+
+    def save(self, events: List[Tuple[str, int, str]], states: List[Tuple[str, str, int, float]]):
+        """在一个事务中写入事件 (id, 序号, JSON) 和生成状态 (id, 接口, 是否结束, 更新时间)"""
+        with self.pool.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO generation_events (generation_id, seq, data) VALUES (?, ?, ?)',
+                             events)
+            conn.executemany('''
+                INSERT INTO generations (id, endpoint, finished, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET finished = excluded.finished, updated_at = excluded.updated_at
+            ''', states)
+
+    def status(self, generation_id: str):
+        """返回 (接口, 是否结束, 更新时间)，不存在时返回 None"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT endpoint, finished, updated_at FROM generations WHERE id = ?',
+                               (generation_id,)).fetchone()
+        return None if row is None else (row['endpoint'], bool(row['finished']), row['updated_at'])
+
+    def read_after(self, generation_id: str, seq: int):
+        """读取序号大于 seq 的事件，返回 ([(序号, 事件), ...], 是否已结束, 更新时间)；生成不存在时返回 None"""
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN')  # 事件和状态在同一个快照中读取
+            row = conn.execute('SELECT finished, updated_at FROM generations WHERE id = ?',
+                               (generation_id,)).fetchone()
+            if row is None:
+                return None
+            rows = conn.execute('SELECT seq, data FROM generation_events WHERE generation_id = ? AND seq > ? '
+                                'ORDER BY seq', (generation_id, seq)).fetchall()
+        return [(r['seq'], json.loads(r['data'])) for r in rows], bool(row['finished']), row['updated_at']
+
+    def touch_reader(self, generation_id: str, reader_id: str):
+        """登记（或刷新）其他 worker 上的读取方"""
+        with self.pool.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO generation_readers (generation_id, reader_id, seen_at) '
+                         'VALUES (?, ?, ?)', (generation_id, reader_id, time.time()))
+
+    def remove_reader(self, generation_id: str, reader_id: str):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM generation_readers WHERE generation_id = ? AND reader_id = ?',
+                         (generation_id, reader_id))
+
+    def has_readers(self, generation_id: str, timeout: float) -> bool:
+        """是否有读取方在 timeout 秒内刷新过登记"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT 1 FROM generation_readers WHERE generation_id = ? AND seen_at > ? LIMIT 1',
+                               (generation_id, time.time() - timeout)).fetchone()
+        return row is not None
+
+    def request_cancel(self, generation_id: str, reason: str) -> bool:
+        """登记取消请求，由生成所在的 worker 执行；生成不存在、已经结束或已经登记过时返回 False"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO generation_cancels (generation_id, reason, requested_at)
+                SELECT id, ?, ? FROM generations WHERE id = ? AND finished = 0
+            ''', (reason, time.time(), generation_id))
+            return cursor.rowcount > 0
+
+    def cancel_requests(self, generation_ids: List[str]) -> Dict[str, str]:
+        """返回其中已登记取消请求的生成：{id: 原因}"""
+        if not generation_ids:
+            return {}
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f'SELECT generation_id, reason FROM generation_cancels '
+                f'WHERE generation_id IN ({", ".join(["?"] * len(generation_ids))})', generation_ids
+            ).fetchall()
+        return {row['generation_id']: row['reason'] for row in rows}
+
+    def prune(self, ttl: float):
+        """删除超过 ttl 秒没有更新的生成"""
+        cutoff = time.time() - ttl
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM generation_events WHERE generation_id IN '
+                         '(SELECT id FROM generations WHERE updated_at < ?)', (cutoff,))
+            conn.execute('DELETE FROM generation_cancels WHERE generation_id IN '
+                         '(SELECT id FROM generations WHERE updated_at < ?)', (cutoff,))
+            conn.execute('DELETE FROM generation_readers WHERE seen_at < ?', (cutoff,))
+            conn.execute('DELETE FROM generations WHERE updated_at < ?', (cutoff,))
+
+
+class RemoteGeneration:
+    """在其他 worker 中进行（或已经结束）的生成：从共享存储轮询读取，读取接口与 GenerationBuffer 相同"""
+
+    stream_profile = None
+
+    def __init__(self, store: GenerationStore, generation_id: str, endpoint: str, finished: bool):
+        self.store = store
+        self.id = generation_id
+        self.endpoint = endpoint
+        self.finished = finished
+        self.reader_id = uuid.uuid4().hex
+        self._subscribed = False
+        self._touched_at = 0.0
+
+    def subscribe(self):
+        """登记为读取方，生成所在的 worker 在宽限期结束时据此判断客户端是否已经重连"""
+        self._subscribed = True
+        self._touch()
+
+    def unsubscribe(self):
+        self._subscribed = False
+        try:
+            self.store.remove_reader(self.id, self.reader_id)
+        except Exception as e:
+            print(f"注销生成 {self.id} 的读取方失败: {e}")
+
+    def _touch(self):
+        try:
+            self.store.touch_reader(self.id, self.reader_id)
+            self._touched_at = time.monotonic()
+        except Exception as e:
+            print(f"登记生成 {self.id} 的读取方失败: {e}")
+
+    def cancel(self, reason: str) -> bool:
+        """登记取消请求；生成所在的 worker 下一次写入共享存储时关闭上游"""
+        return self.store.request_cancel(self.id, reason)
+
+    def read_after(self, seq: int, timeout: Optional[float] = None) -> Tuple[List[Tuple[int, Dict]], bool]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._subscribed and time.monotonic() - self._touched_at >= GENERATION_READER_HEARTBEAT:
+                self._touch()
+            result = self.store.read_after(self.id, seq)
+            if result is None:
+                raise GenerationGone(f'生成 {self.id} 已过期')
+            events, finished, updated_at = result
+            if not finished and time.time() - updated_at > GENERATION_STALE_SECONDS:
+                raise GenerationGone(f'生成 {self.id} 所在的进程已退出')
+            self.finished = finished
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if events or finished or (remaining is not None and remaining <= 0):
+                return events, finished
+            time.sleep(GENERATION_POLL_INTERVAL if remaining is None else min(GENERATION_POLL_INTERVAL, remaining))
+
+
+class GenerationRegistry:
+    def __init__(self, store: Optional[GenerationStore] = None, ttl: float = GENERATION_BUFFER_TTL,
+                 max_bytes: int = GENERATION_BUFFER_MAX_BYTES):
+        """store 为共享存储，不传时只能在创建生成的进程内续读"""
+        self.store = store
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._buffers = OrderedDict()  # generation_id -> GenerationBuffer，按创建顺序
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._pruned_at = 0.0
+
+    def create(self, endpoint: str = '') -> GenerationBuffer:
+        """创建新的生成缓冲区"""
+        buffer = GenerationBuffer(uuid.uuid4().hex)
+        buffer.endpoint = endpoint
+        buffer.persist = self.store is not None
+        buffer.store = self.store
+        with self._lock:
+            self._evict()
+            self._buffers[buffer.id] = buffer
+        if self.store is not None:
+            self._ensure_thread()
+        return buffer
+
+    def get(self, generation_id: str):
+        """本进程的缓冲区；不在本进程时从共享存储读取（RemoteGeneration），都没有时返回 None"""
+        with self._lock:
+            buffer = self._buffers.get(generation_id)
+        if buffer is not None or self.store is None:
+            return buffer
+        status = self.store.status(generation_id)
+        if status is None:
+            return None
+        endpoint, finished, _ = status
+        return RemoteGeneration(self.store, generation_id, endpoint, finished)
+
+    # ==================== 共享存储 ====================
+
+    def _ensure_thread(self):
+        """写入线程按进程启动（fork 出的 worker 各自启动）"""
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='generation-persist', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(GENERATION_PERSIST_INTERVAL)
+            try:
+                self.persist()
+            except Exception as e:
+                print(f"写入生成事件失败: {e}")
+
+    def persist(self):
+        """把本进程各生成的新事件和状态批量写入共享存储（未结束的生成同时刷新更新时间，作为心跳），
+        并执行其他 worker 登记的取消请求"""
+        with self._lock:
+            buffers = [buffer for buffer in self._buffers.values() if buffer.persist and not buffer.saved_finished]
+        if not buffers:
+            return
+        now = time.time()
+        taken = []
+        events, states = [], []
+        for buffer in buffers:
+            unsaved, finished = buffer.take_unsaved()
+            taken.append((buffer, unsaved, finished))
+            events.extend((buffer.id, seq, json.dumps(event, ensure_ascii=False)) for seq, event in unsaved)
+            states.append((buffer.id, buffer.endpoint, int(finished), now))
+        try:
+            self.store.save(events, states)
+        except Exception:
+            for buffer, unsaved, _ in taken:
+                buffer.requeue_unsaved(unsaved)
+            raise
+        for buffer, _, finished in taken:
+            buffer.saved_finished = finished
+        running = {buffer.id: buffer for buffer, _, finished in taken if not finished}
+        for generation_id, reason in self.store.cancel_requests(list(running)).items():
+            running[generation_id].cancel(reason)
+        if now - self._pruned_at > 60:
+            self._pruned_at = now
+            self.store.prune(self.ttl)
+
+    def _evict(self):
+        """清理过期缓冲区；超出内存上限时从最早的已结束缓冲区开始淘汰"""
+        now = time.time()
+        for generation_id, buffer in list(self._buffers.items()):
+            if now - buffer.updated_at > self.ttl:
+                del self._buffers[generation_id]
+
+        total = sum(buffer.size for buffer in self._buffers.values())
+        for generation_id, buffer in list(self._buffers.items()):
+            if total <= self.max_bytes:
+                break
+            if buffer.finished:
+                total -= buffer.size
+                del self._buffers[generation_id]
+
+    def run(self, buffer: GenerationBuffer, produce: Callable[[], Iterable[Dict]],
+            on_error: Callable[[Exception], Dict]):
+        """在后台线程中运行 produce()，把产出的事件写入缓冲区（与客户端连接无关）；
+        produce() 内可以通过 current_generation() 登记取消回调"""
+        def run():
+            _local.buffer = buffer
+            events = iter(produce())
+            try:
+                for data in events:
+                    if buffer.cancelled:
+                        break
+                    buffer.append(data)
+            except Exception as e:
+                if not buffer.cancelled:  # 取消时关闭上游导致的异常不再输出
+                    buffer.append(on_error(e))
+            finally:
+                if hasattr(events, 'close'):
+                    events.close()
+                if buffer.cancelled:
+                    buffer.append({'cancelled': True})
+                buffer.finish()
+
+        threading.Thread(target=run, name=f'generation-{buffer.id[:8]}', daemon=True).start()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'buffers': len(self._buffers),
+                'active': sum(1 for buffer in self._buffers.values() if not buffer.finished),
+                'cancelled': sum(1 for buffer in self._buffers.values() if buffer.cancelled),
+                'bytes': sum(buffer.size for buffer in self._buffers.values()),
+            }
+
+
+def current_generation() -> Optional[GenerationBuffer]:
+    """当前线程正在运行的生成（只在 GenerationRegistry.run 的后台线程中有值）"""
+    return getattr(_local, 'buffer', None)
+
+
+def parse_event_id(event_id: str) -> Optional[Tuple[str, int]]:
+    """解析 SSE 事件 id（格式为 "<generation_id>:<seq>"）"""
+    generation_id, _, seq = (event_id or '').strip().rpartition(':')
+    if not generation_id or not seq.lstrip('-').isdigit():
+        return None
+    return generation_id, int(seq)
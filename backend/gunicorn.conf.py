@@ -0,0 +1,34 @@
+"""
+gunicorn 配置
+流式接口的请求线程只阻塞在 LLM 网关的本地队列上，上游请求由每个进程的事件循环并发处理，
+因此使用 gthread worker 并开较多线程，单个进程即可同时保持大量 SSE 连接。
+
+上游请求不占线程，但 SSE 连接仍然是每个连接一个线程：打开的流在整个生成期间占用一个 gunicorn 线程
+（另有一个不计入 threads 的生成线程），所以每个 worker 同时打开的流最多 GUNICORN_THREADS 个，
+超出的连接（包括普通请求）在 gunicorn 队列中等待。按"每个 worker 预计同时打开的流 + 普通请求的余量"
+设置 GUNICORN_THREADS，总容量为 GUNICORN_WORKERS × GUNICORN_THREADS；每个线程都有自己的栈，
+线程数开得很大时注意内存。
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 200))  # 每个 worker 同时打开的 SSE 流的上限
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+keepalive = 5
+
+
+def worker_exit(server, worker):
+    """worker 退出前写入内存中累计的提示词使用次数和指标快照"""
+    from prompt_database import db
+    from metrics import metrics
+    db.usage.flush()
+    metrics.flush()
+
+
+def on_starting(server):
+    """清空上次运行留下的指标快照（各 worker 的快照在运行期间保留，已退出 worker 的计数不丢失）"""
+    from metrics import metrics
+    metrics.clear_directory()
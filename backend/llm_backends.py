@@ -0,0 +1,132 @@
+"""
+上游 LLM 后端模块
+按顺序配置的多个 OpenAI 兼容后端及其健康状态：
+- LLM_BACKENDS：JSON 数组（或 JSON 文件路径），每项包含 base_url、model，以及 api_key 或 api_key_env，
+  可选 name；未配置时使用 DEEPSEEK_API_KEY / DEEPSEEK_BASE_URL / DEEPSEEK_MODEL 组成的单个后端
+- 健康状态：连续失败 LLM_BACKEND_FAILURE_THRESHOLD 次后熔断 LLM_BACKEND_COOLDOWN 秒，
+  熔断期间排到列表末尾，冷却结束后重新尝试（成功一次即恢复）
+- TTFTTracker：记录最近的首 token 时间，用于计算对冲请求的触发阈值
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+
+LLM_BACKEND_FAILURE_THRESHOLD = int(os.environ.get('LLM_BACKEND_FAILURE_THRESHOLD', 3))
+LLM_BACKEND_COOLDOWN = float(os.environ.get('LLM_BACKEND_COOLDOWN', 30))
+LLM_TTFT_WINDOW = int(os.environ.get('LLM_TTFT_WINDOW', 500))  # 计算分位数使用的样本数
+
+
+class Backend:
+    """一个 OpenAI 兼容后端（客户端由网关在事件循环内创建）"""
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: str):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.client = None
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # 熔断结束时间
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now: Optional[float] = None) -> bool:
+        return (now or time.monotonic()) >= self.open_until
+
+    def on_success(self):
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def on_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= LLM_BACKEND_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + LLM_BACKEND_COOLDOWN
+            print(f"LLM 后端 {self.name} 连续失败 {self.consecutive_failures} 次，暂停 {LLM_BACKEND_COOLDOWN:g} 秒")
+
+    def stats(self) -> Dict:
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'model': self.model,
+            'available': self.available(),
+            'consecutive_failures': self.consecutive_failures,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+class BackendPool:
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError('至少需要配置一个 LLM 后端')
+        self.backends = backends
+
+    @property
+    def primary(self) -> Backend:
+        return self.backends[0]
+
+    def ordered(self, avoid: Optional[Backend] = None) -> List[Backend]:
+        """按配置顺序排列，熔断中的后端放到最后（全部熔断时仍按最早恢复的顺序尝试），
+        avoid 排在健康的后端之后"""
+        now = time.monotonic()
+        healthy = [backend for backend in self.backends if backend.available(now) and backend is not avoid]
+        broken = sorted((backend for backend in self.backends if not backend.available(now) and backend is not avoid),
+                        key=lambda backend: backend.open_until)
+        if avoid is not None and avoid in self.backends:
+            (healthy if avoid.available(now) else broken).append(avoid)
+        return healthy + broken
+
+    def stats(self) -> List[Dict]:
+        return [backend.stats() for backend in self.backends]
+
+
+class TTFTTracker:
+    """最近 LLM_TTFT_WINDOW 次请求的首 token 时间"""
+
+    def __init__(self, window: int = LLM_TTFT_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent: float, min_samples: int = 1) -> Optional[float]:
+        """样本不足 min_samples 时返回 None"""
+        with self.lock:
+            if len(self.samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def load_backends() -> List[Backend]:
+    """读取 LLM_BACKENDS；未配置时回退到 DEEPSEEK_* 环境变量"""
+    raw = os.environ.get('LLM_BACKENDS', '').strip()
+    if not raw:
+        return [Backend(
+            name='deepseek',
+            base_url=os.environ.get('DEEPSEEK_BASE_URL', "https://api.deepseek.com"),
+            model=os.environ.get('DEEPSEEK_MODEL', "deepseek-chat"),
+            api_key=os.environ.get('DEEPSEEK_API_KEY', ''),
+        )]
+
+    if not raw.startswith('['):
+        with open(raw, encoding='utf-8') as f:
+            raw = f.read()
+    backends = []
+    for index, item in enumerate(json.loads(raw)):
+        api_key = item.get('api_key') or os.environ.get(item.get('api_key_env', ''), '')
+        backends.append(Backend(
+            name=item.get('name') or f'backend-{index}',
+            base_url=item['base_url'],
+            model=item['model'],
+            api_key=api_key,
+        ))
+    return backends
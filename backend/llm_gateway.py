@@ -0,0 +1,474 @@
+"""
+LLM 网关模块
+基于 AsyncOpenAI 的异步并发调用层：每个 worker 进程内有一个后台事件循环线程，
+所有上游请求都在这个事件循环里并发执行，共享同一个 keep-alive 连接池。
+Flask 的同步视图通过 stream()/complete() 桥接过来，请求线程只阻塞在本地队列上。
+
+容错（上游后端见 llm_backends）：
+- 首 token 之前失败（连接错误、超时、429、5xx）时按带抖动的指数退避重试，并轮换到下一个后端
+- 首 token 超过最近 TTFT 的分位数阈值时向下一个后端发出对冲请求，先拿到首 token 的一方胜出，另一个被取消
+- 流式输出中途断开时，把已输出的文本作为 assistant 消息发出续写请求，接着输出剩余内容
+"""
+
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from context_budget import count_tokens, message_tokens, LLM_MIN_OUTPUT_TOKENS
+from llm_backends import Backend, BackendPool, TTFTTracker
+from metrics import LLM_BACKEND_ERRORS, LLM_HEDGES, LLM_RESUMES, LLM_RETRIES, LLM_STREAMS_CANCELLED
+from upstream_limits import PRIORITY_DEFAULT, UpstreamLimits
+
+
+# 网关配置（可通过环境变量调整）
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 64))  # 每个进程同时进行的上游请求数
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 100))
+LLM_MAX_KEEPALIVE = int(os.environ.get('LLM_MAX_KEEPALIVE', 20))
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', 10))
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', 120))  # 两个数据块之间的最长等待
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))  # 首 token 之前失败时的重试次数
+LLM_RETRY_BASE_DELAY = float(os.environ.get('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_MAX_DELAY = float(os.environ.get('LLM_RETRY_MAX_DELAY', 8))
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))  # 0 表示不发对冲请求
+LLM_HEDGE_MIN_DELAY = float(os.environ.get('LLM_HEDGE_MIN_DELAY', 2))  # 对冲阈值的下限（秒）
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20))  # TTFT 样本不足时不对冲
+LLM_MAX_RESUMES = int(os.environ.get('LLM_MAX_RESUMES', 2))  # 一次流式调用最多续写的次数
+
+CONTINUATION_PROMPT = '输出在中途中断了。请从中断的地方直接接着输出剩余内容，不要重复已经输出的部分，也不要添加任何说明。'
+CONTINUATION_OVERLAP_WINDOW = 64  # 续写开头先缓冲的字数，用于去掉与已输出文本重复的部分
+CONTINUATION_MIN_OVERLAP = 8
+
+_DONE = object()
+
+# on_usage(prompt_tokens, completion_tokens)：上游返回 usage 时回调，用于统计 token 用量
+UsageCallback = Callable[[int, int], None]
+
+
+def _is_overload(error: BaseException) -> bool:
+    """上游过载的信号：429、503 或超时"""
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, httpx.TimeoutException)):
+        return True
+    return getattr(error, 'status_code', None) in (429, 503)
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """连接失败、超时、读取中途断开、408/409/429、5xx 可以重试；其他 4xx（参数、鉴权错误）直接返回"""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return isinstance(error, (openai.APIError, httpx.TransportError, asyncio.TimeoutError))
+
+
+def _backoff(retry: int) -> float:
+    """完全抖动的指数退避：在 [0, min(上限, 基数 * 2^(n-1))] 内均匀取值"""
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (retry - 1)))
+
+
+def _continuation_messages(messages: List[Dict[str, str]], partial: str) -> List[Dict[str, str]]:
+    """续写请求：原对话 + 已输出的文本 + 继续输出的指令"""
+    return list(messages) + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUATION_PROMPT},
+    ]
+
+
+def _strip_overlap(output: str, text: str) -> str:
+    """去掉续写开头与已输出文本末尾重复的部分（模型有时会从中断前的几个字重新开始）"""
+    for size in range(min(len(output), len(text)), CONTINUATION_MIN_OVERLAP - 1, -1):
+        if output.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+class TextStream:
+    """流式结果的同步迭代器，逐个返回事件循环产生的文本片段"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._future: Optional[Future] = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        item = self._queue.get()
+        if item is _DONE:
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self):
+        """取消上游请求（例如客户端断开时）"""
+        if self._future is not None and not self._future.done():
+            self._future.cancel()
+            LLM_STREAMS_CANCELLED.inc()
+            # 任务可能在开始执行前就被取消，不会再写入结束标记
+            self._queue.put(_DONE)
+
+
+class _Attempt:
+    """发往某个后端的一次流式请求；task 负责取第一个文本片段"""
+
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.admitted = asyncio.Event()
+        self.admitted_at: Optional[float] = None
+        self.agen = None
+        self.task: Optional[asyncio.Future] = None
+
+    def start(self, agen) -> '_Attempt':
+        self.agen = agen
+        self.task = asyncio.ensure_future(agen.__anext__())
+        return self
+
+    def on_admitted(self):
+        self.admitted_at = time.monotonic()
+        self.admitted.set()
+
+    async def close(self):
+        """取消请求并关闭生成器（释放并发名额、关闭上游连接）"""
+        if not self.task.done():
+            self.task.cancel()
+        await asyncio.wait([self.task])
+        if not self.task.cancelled():
+            self.task.exception()  # 已经处理过的异常，避免事件循环再报告一次
+        await self.agen.aclose()
+
+
+class LLMGateway:
+    def __init__(self, backends: List[Backend],
+                 max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 timeout: Optional[httpx.Timeout] = None,
+                 limits: Optional[UpstreamLimits] = None):
+        """backends 按优先顺序排列（第一个为主后端）；
+        limits 为准入控制（优先级队列、自适应并发、共享限流），不传时只用固定的并发上限"""
+        self.pool = BackendPool(backends)
+        self.ttft = TTFTTracker()
+        self.limits = limits
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout or httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    # ==================== 事件循环 ====================
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """启动（或在 fork 之后重建）后台事件循环线程"""
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                threading.Thread(target=run, name='llm-gateway', daemon=True).start()
+                ready.wait()
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+                self._loop = loop
+                self._pid = os.getpid()
+        return self._loop
+
+    @property
+    def model(self) -> str:
+        """主后端的模型名（用于缓存键）"""
+        return self.pool.primary.model
+
+    async def _setup(self):
+        """在事件循环内创建各后端的客户端（共享连接池，重试由网关负责）和并发信号量"""
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            ),
+            timeout=self.timeout,
+        )
+        for backend in self.pool.backends:
+            backend.client = AsyncOpenAI(
+                api_key=backend.api_key,
+                base_url=backend.base_url,
+                http_client=http_client,
+                max_retries=0,
+            )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def submit(self, coro) -> Future:
+        """把协程提交到网关的事件循环执行"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    # ==================== 异步接口 ====================
+
+    @asynccontextmanager
+    async def _admit(self, messages: List[Dict[str, str]], max_tokens: int, priority: int):
+        """取得上游请求的名额，yield 预扣的 token 数"""
+        if self.limits is None:
+            async with self._semaphore:
+                yield 0
+            return
+        async with self.limits.admit(priority, message_tokens(messages) + max_tokens) as reserved:
+            yield reserved
+
+    def _on_usage(self, usage, reserved: int, on_usage: Optional[UsageCallback]):
+        if usage is None:
+            return
+        if on_usage is not None:
+            on_usage(usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        if self.limits is not None:
+            self.limits.refund(reserved, usage.total_tokens or 0)
+
+    def _on_first_token(self, backend: Backend, ttft: Optional[float] = None):
+        backend.on_success()
+        if ttft is not None:
+            self.ttft.add(ttft)
+        if self.limits is not None:
+            self.limits.on_success(ttft)
+
+    def _on_error(self, backend: Backend, error: BaseException):
+        LLM_BACKEND_ERRORS.inc(backend=backend.name, error=type(error).__name__)
+        if _is_retryable(error):
+            backend.on_failure()
+        if self.limits is not None and _is_overload(error):
+            self.limits.on_overload()
+
+    def _hedge_delay(self) -> Optional[float]:
+        """对冲阈值：最近 TTFT 的 LLM_HEDGE_PERCENTILE 分位数；样本不足或请求在排队时不对冲"""
+        if LLM_HEDGE_PERCENTILE <= 0 or (self.limits is not None and self.limits.congested()):
+            return None
+        threshold = self.ttft.percentile(LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+        return None if threshold is None else max(threshold, LLM_HEDGE_MIN_DELAY)
+
+    async def _hedge_timeout(self, attempt: _Attempt) -> Optional[float]:
+        """距离发出对冲请求还要等待的秒数（从请求通过准入控制开始计时，排队时间不算），None 表示不对冲"""
+        delay = self._hedge_delay()
+        if delay is None:
+            return None
+        if not attempt.admitted.is_set():
+            waiter = asyncio.ensure_future(attempt.admitted.wait())
+            await asyncio.wait([attempt.task, waiter], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+        if attempt.admitted_at is None:
+            return 0
+        return max(0.0, delay - (time.monotonic() - attempt.admitted_at))
+
+    async def _backend_stream(self, backend: Backend, messages: List[Dict[str, str]], max_tokens: int,
+                              temperature: float, timeout: Optional[float], on_usage: Optional[UsageCallback],
+                              priority: int, on_admitted: Callable[[], None]) -> AsyncIterator[str]:
+        """向一个后端发起流式请求（重试、对冲、续写都是独立的请求，各自经过准入控制）"""
+        async with self._admit(messages, max_tokens, priority) as reserved:
+            on_admitted()
+            backend.requests += 1
+            started = time.monotonic()
+            first = True
+            settled = False
+            try:
+                response = await backend.client.chat.completions.create(
+                    model=backend.model,
+                    messages=messages,
+                    stream=True,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout or self.timeout,
+                    stream_options={'include_usage': True},
+                )
+                try:
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first:
+                                self._on_first_token(backend, time.monotonic() - started)
+                                first = False
+                            yield chunk.choices[0].delta.content
+                        usage = getattr(chunk, 'usage', None)
+                        if usage is not None:
+                            self._on_usage(usage, reserved, on_usage)
+                            settled = True
+                finally:
+                    await response.close()
+            except Exception as e:
+                self._on_error(backend, e)
+                raise
+            finally:
+                if first and not settled and self.limits is not None:
+                    self.limits.refund(reserved, 0)  # 没有任何输出（失败或被取消），预扣的额度全部退还
+
+    def _launch(self, backend: Backend, messages: List[Dict[str, str]], params: Dict) -> _Attempt:
+        attempt = _Attempt(backend)
+        return attempt.start(self._backend_stream(backend, messages, on_admitted=attempt.on_admitted, **params))
+
+    async def _start(self, messages: List[Dict[str, str]], params: Dict,
+                     avoid: Optional[Backend] = None) -> Tuple[_Attempt, Optional[str]]:
+        """发起流式请求直到拿到第一个文本片段，返回胜出的请求和该片段（没有输出时为 None）；
+        avoid 为刚刚中断的后端，续写时排到最后"""
+        last_error = None
+        for retry in range(LLM_MAX_RETRIES + 1):
+            backends = self.pool.ordered(avoid)
+            backend = backends[retry % len(backends)]
+            if retry:
+                await asyncio.sleep(_backoff(retry))
+                LLM_RETRIES.inc(backend=backend.name)
+            attempts = [self._launch(backend, messages, params)]
+            hedge = None
+            try:
+                while attempts:
+                    timeout = None if hedge is not None else await self._hedge_timeout(attempts[0])
+                    done, _ = await asyncio.wait([attempt.task for attempt in attempts], timeout=timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        hedge = self._launch(backends[(retry + 1) % len(backends)], messages, params)
+                        attempts.append(hedge)
+                        LLM_HEDGES.inc(outcome='started')
+                        continue
+                    for attempt in [attempt for attempt in attempts if attempt.task in done]:
+                        attempts.remove(attempt)
+                        error = attempt.task.exception()
+                        if error is None or isinstance(error, StopAsyncIteration):
+                            if attempt is hedge:
+                                LLM_HEDGES.inc(outcome='won')
+                            return attempt, None if error is not None else attempt.task.result()
+                        await attempt.close()
+                        if not _is_retryable(error):
+                            raise error
+                        last_error = error
+                        print(f"LLM 后端 {attempt.backend.name} 请求失败（第 {retry + 1} 次）: {error}")
+            finally:
+                for attempt in attempts:
+                    await attempt.close()
+        raise last_error
+
+    async def astream(self, messages: List[Dict[str, str]], max_tokens: int = 4000,
+                      temperature: float = 0.7, timeout: Optional[float] = None,
+                      on_usage: Optional[UsageCallback] = None,
+                      priority: int = PRIORITY_DEFAULT) -> AsyncIterator[str]:
+        """流式调用，逐个产出文本片段；首 token 之前失败时重试 / 对冲，中途断开时续写"""
+        params = dict(max_tokens=max_tokens, temperature=temperature, timeout=timeout,
+                      on_usage=on_usage, priority=priority)
+        output = ''  # 已经产出的全部文本
+        request = messages
+        interrupted = None
+        for resume in range(LLM_MAX_RESUMES + 1):
+            attempt, text = await self._start(request, params, interrupted)
+            head = '' if resume else None  # 续写的开头先缓冲，去掉与已输出文本重复的部分
+            try:
+                while text is not None:
+                    if head is not None:
+                        head += text
+                        text = None
+                        if len(head) >= CONTINUATION_OVERLAP_WINDOW:
+                            text, head = _strip_overlap(output, head), None
+                    if text:
+                        output += text
+                        yield text
+                    try:
+                        text = await attempt.agen.__anext__()
+                    except StopAsyncIteration:
+                        text = None
+                if head:
+                    text = _strip_overlap(output, head)
+                    if text:
+                        output += text
+                        yield text
+                return
+            except Exception as e:
+                if not _is_retryable(e) or resume >= LLM_MAX_RESUMES:
+                    raise
+                print(f"LLM 后端 {attempt.backend.name} 流式输出中断（已输出 {len(output)} 字）: {e}，发起续写")
+                LLM_RESUMES.inc(backend=attempt.backend.name)
+                interrupted = attempt.backend
+                request = _continuation_messages(messages, output)
+                params['max_tokens'] = max(LLM_MIN_OUTPUT_TOKENS, max_tokens - count_tokens(output))
+            finally:
+                await attempt.close()
+
+    async def _backend_complete(self, backend: Backend, messages: List[Dict[str, str]], max_tokens: int,
+                                temperature: float, timeout: Optional[float], on_usage: Optional[UsageCallback],
+                                priority: int) -> str:
+        async with self._admit(messages, max_tokens, priority) as reserved:
+            backend.requests += 1
+            try:
+                response = await backend.client.chat.completions.create(
+                    model=backend.model,
+                    messages=messages,
+                    stream=False,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout or self.timeout,
+                )
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    self._on_error(backend, e)
+                if self.limits is not None:
+                    self.limits.refund(reserved, 0)
+                raise
+            self._on_first_token(backend)
+            self._on_usage(response.usage, reserved, on_usage)
+            return response.choices[0].message.content
+
+    async def acomplete(self, messages: List[Dict[str, str]], max_tokens: int = 4000,
+                        temperature: float = 0.7, timeout: Optional[float] = None,
+                        on_usage: Optional[UsageCallback] = None,
+                        priority: int = PRIORITY_DEFAULT) -> str:
+        """非流式调用，返回完整文本；可重试的失败按退避重试并轮换后端"""
+        last_error = None
+        for retry in range(LLM_MAX_RETRIES + 1):
+            backends = self.pool.ordered()
+            backend = backends[retry % len(backends)]
+            if retry:
+                await asyncio.sleep(_backoff(retry))
+                LLM_RETRIES.inc(backend=backend.name)
+            try:
+                return await self._backend_complete(backend, messages, max_tokens, temperature, timeout,
+                                                    on_usage, priority)
+            except Exception as e:
+                if not _is_retryable(e):
+                    raise
+                last_error = e
+                print(f"LLM 后端 {backend.name} 请求失败（第 {retry + 1} 次）: {e}")
+        raise last_error
+
+    def stats(self) -> Dict:
+        return {
+            'backends': self.pool.stats(),
+            'hedge_threshold': self._hedge_delay(),
+            'ttft_p50': self.ttft.percentile(50),
+            'ttft_p95': self.ttft.percentile(95),
+        }
+
+    # ==================== 同步桥接 ====================
+
+    def stream(self, messages: List[Dict[str, str]], **kwargs) -> TextStream:
+        """在 Flask 线程中使用的流式调用"""
+        text_stream = TextStream()
+
+        async def pump():
+            try:
+                async for text in self.astream(messages, **kwargs):
+                    text_stream._queue.put(text)
+                text_stream._queue.put(_DONE)
+            except asyncio.CancelledError:
+                text_stream._queue.put(_DONE)
+                raise
+            except Exception as e:
+                text_stream._queue.put(e)
+
+        text_stream._future = self.submit(pump())
+        return text_stream
+
+    def complete(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """在 Flask 线程中使用的非流式调用"""
+        return self.submit(self.acomplete(messages, **kwargs)).result()
@@ -0,0 +1,253 @@
+"""
+指标模块
+进程内的计数器和直方图（固定分桶，记录时只做一次加法，开销很小），
+后台线程每隔 METRICS_FLUSH_INTERVAL 秒把本进程的快照写入 METRICS_DIR/<pid>.json，
+/api/metrics 读取目录下所有 worker 的快照求和，输出 Prometheus 文本格式。
+已退出的 worker 的快照保留（计数器保持单调递增），gunicorn 启动时清空目录。
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+
+class Counter:
+    def __init__(self, registry: 'MetricsRegistry', name: str, help: str, labels: Sequence[str]):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        if self.registry.pid != os.getpid():
+            self.registry.start()
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def snapshot(self) -> Dict:
+        return {'type': 'counter', 'help': self.help, 'labels': self.labels,
+                'values': [[list(key), value] for key, value in self.values.items()]}
+
+
+class Histogram:
+    def __init__(self, registry: 'MetricsRegistry', name: str, help: str, labels: Sequence[str],
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], List[float]] = {}  # 各桶计数（最后一个为 +Inf）+ [sum, count]
+
+    def observe(self, value: float, **labels):
+        if self.registry.pid != os.getpid():
+            self.registry.start()
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * (len(self.buckets) + 3)
+            data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def snapshot(self) -> Dict:
+        return {'type': 'histogram', 'help': self.help, 'labels': self.labels, 'buckets': self.buckets,
+                'values': [[list(key), list(data)] for key, data in self.values.items()]}
+
+
+class MetricsRegistry:
+    def __init__(self, directory: str = METRICS_DIR, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+        self.pid = None
+        atexit.register(self.flush)
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = self._metrics[name] = Counter(self, name, help, labels)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = self._metrics[name] = Histogram(self, name, help, labels, buckets)
+        return metric
+
+    # ==================== 跨进程汇总 ====================
+
+    def start(self):
+        """写快照的线程按进程启动（fork 出的 worker 清空继承的数值，各自计数）"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                for metric in self._metrics.values():
+                    metric.values.clear()
+            self.pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"写入指标快照失败: {e}")
+
+    def flush(self):
+        """把本进程的快照写入 <pid>.json（先写临时文件再改名，读取方不会读到一半的文件）"""
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            snapshot = {name: metric.snapshot() for name, metric in self._metrics.items()}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def _snapshots(self) -> Iterator[Dict]:
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def collect(self) -> Dict[str, Dict]:
+        """汇总所有 worker 的快照（先写入本进程的最新数值）"""
+        self.start()
+        self.flush()
+        merged: Dict[str, Dict] = {}
+        for snapshot in self._snapshots():
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, dict(metric, values={}))
+                for key, value in metric['values']:
+                    key = tuple(key)
+                    if metric['type'] == 'counter':
+                        target['values'][key] = target['values'].get(key, 0) + value
+                    else:
+                        current = target['values'].get(key)
+                        target['values'][key] = value if current is None else [a + b for a, b in zip(current, value)]
+        return merged
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labels = metric['labels']
+            for key, value in sorted(metric['values'].items()):
+                if metric['type'] == 'counter':
+                    lines.append(f'{name}{_format_labels(labels, key)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ['+Inf'], value):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels + ['le'], list(key) + [_format_value(bound)])
+                    lines.append(f'{name}_bucket{bucket_labels} {_format_value(cumulative)}')
+                lines.append(f'{name}_sum{_format_labels(labels, key)} {_format_value(value[-2])}')
+                lines.append(f'{name}_count{_format_labels(labels, key)} {_format_value(value[-1])}')
+        return '\n'.join(lines) + '\n'
+
+    def clear_directory(self):
+        """删除所有快照（服务启动时调用）"""
+        for filename in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if filename.endswith('.json') or filename.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, filename))
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+metrics = MetricsRegistry()
+
+# LLM 接口
+LLM_TTFT_SECONDS = metrics.histogram(
+    'llm_time_to_first_token_seconds', '请求开始到第一个文本片段的时间', ['endpoint'])
+LLM_STREAM_SECONDS = metrics.histogram(
+    'llm_stream_duration_seconds', '流式生成的总时长', ['endpoint'])
+LLM_REQUEST_SECONDS = metrics.histogram(
+    'llm_request_duration_seconds', '非流式 LLM 调用的时长', ['endpoint'])
+LLM_STREAM_CHUNKS = metrics.counter('llm_stream_chunks_total', '输出的文本片段数', ['endpoint'])
+LLM_STREAM_BYTES = metrics.counter('llm_stream_bytes_total', '输出的文本字节数（UTF-8）', ['endpoint'])
+LLM_PROMPT_TOKENS = metrics.counter('llm_prompt_tokens_total', '上游返回的提示词 token 数', ['endpoint'])
+LLM_COMPLETION_TOKENS = metrics.counter('llm_completion_tokens_total', '上游返回的生成 token 数', ['endpoint'])
+LLM_ERRORS = metrics.counter('llm_upstream_errors_total', 'LLM 调用失败次数', ['endpoint', 'error'])
+LLM_QUEUE_SECONDS = metrics.histogram(
+    'llm_queue_wait_seconds', '上游请求在并发队列和限流中等待的时间', ['priority'])
+LLM_RETRIES = metrics.counter('llm_retries_total', '首 token 前失败后重试的次数（按重试使用的后端）', ['backend'])
+LLM_RESUMES = metrics.counter('llm_stream_resumes_total', '流式输出中途断开后用续写提示继续的次数', ['backend'])
+LLM_HEDGES = metrics.counter(
+    'llm_hedged_requests_total', '首 token 超过阈值后发出的对冲请求（won 表示对冲请求先返回）', ['outcome'])
+LLM_BACKEND_ERRORS = metrics.counter('llm_backend_errors_total', '各后端的请求失败次数', ['backend', 'error'])
+LLM_STREAMS_CANCELLED = metrics.counter(
+    'llm_streams_cancelled_total', '在输出结束之前被关闭的上游流式请求（客户端断开或取消）')
+GENERATIONS_CANCELLED = metrics.counter(
+    'generations_cancelled_total', '被取消的流式生成（disconnect 为客户端断开，client 为停止按钮）',
+    ['endpoint', 'reason'])
+SUMMARY_SECONDS = metrics.histogram(
+    'llm_summary_duration_seconds', '生成上下文摘要的耗时（cached 表示命中摘要缓存）', ['kind', 'cached'])
+
+# SQLite
+DB_QUERY_SECONDS = metrics.histogram(
+    'db_query_duration_seconds', 'PromptDatabase 操作耗时', ['operation'], buckets=DB_BUCKETS)
+
+
+def instrument_stream(endpoint: str, events: Iterable[Dict], started: Optional[float] = None) -> Iterator[Dict]:
+    """包装流式接口产出的事件，记录首个文本片段时间、总时长、片段数和字节数、异常"""
+    started = time.perf_counter() if started is None else started
+    first = True
+    chunks = 0
+    size = 0
+    try:
+        for event in events:
+            content = event.get('content')
+            if content:
+                if first:
+                    LLM_TTFT_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                    first = False
+                chunks += 1
+                size += len(content.encode('utf-8'))
+            yield event
+    except Exception as e:
+        LLM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+        raise
+    finally:
+        LLM_STREAM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+        LLM_STREAM_CHUNKS.inc(chunks, endpoint=endpoint)
+        LLM_STREAM_BYTES.inc(size, endpoint=endpoint)
@@ -0,0 +1,90 @@
+"""
+提示词库备份模块
+备份格式为 NDJSON（每行一条记录，第一行是 meta，之后是分类和提示词），可选 gzip 压缩。
+导出和恢复都是流式的：导出边读游标边编码输出，恢复边读请求体边分批写入，
+内存占用与提示词库大小无关。
+"""
+
+import json
+import zlib
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator
+
+from prompt_database import PromptDatabase
+
+
+BACKUP_FORMAT_VERSION = 1
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def iter_backup(database: PromptDatabase, compress: bool = False) -> Iterator[bytes]:
+    """逐块产出备份内容（NDJSON，compress 为 True 时为 gzip 流）"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 输出 gzip 格式
+    chunk = []
+    size = 0
+
+    def encode(record: Dict) -> bytes:
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    def flush() -> bytes:
+        data = b''.join(chunk)
+        chunk.clear()
+        return compressor.compress(data) if compressor else data
+
+    meta = {'type': 'meta', 'version': BACKUP_FORMAT_VERSION, 'exported_at': datetime.now().isoformat()}
+    chunk.append(encode(meta))
+    for record in database.iter_backup_records():
+        line = encode(record)
+        chunk.append(line)
+        size += len(line)
+        if size >= BACKUP_CHUNK_SIZE:
+            data = flush()
+            size = 0
+            if data:
+                yield data
+
+    data = flush()
+    if compressor:
+        data += compressor.flush()
+    if data:
+        yield data
+
+
+def iter_backup_lines(stream: BinaryIO) -> Iterator[bytes]:
+    """从二进制流中逐行读取备份内容，根据开头的字节自动识别 gzip"""
+    head = stream.read(BACKUP_CHUNK_SIZE)
+    decompressor = zlib.decompressobj(31) if head.startswith(GZIP_MAGIC) else None
+    pending = b''
+    data = head
+    while data:
+        if decompressor:
+            data = decompressor.decompress(data)
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+        data = stream.read(BACKUP_CHUNK_SIZE)
+    if decompressor:
+        pending += decompressor.flush()
+    if pending.strip():
+        yield pending
+
+
+def iter_backup_records(stream: BinaryIO) -> Iterator[Dict]:
+    """解析备份流中的记录，检查格式版本"""
+    for number, line in enumerate(iter_backup_lines(stream), start=1):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f'第 {number} 行不是合法的 JSON')
+        if record.get('type') == 'meta' and record.get('version', 1) > BACKUP_FORMAT_VERSION:
+            raise ValueError(f"不支持的备份格式版本: {record.get('version')}")
+        yield record
+
+
+def restore_backup(database: PromptDatabase, stream: BinaryIO, batch_size: int = 1000) -> Dict[str, int]:
+    """从备份流恢复提示词库（分批事务写入，按名称/标题合并到已有数据）"""
+    return database.restore_records(iter_backup_records(stream), batch_size=batch_size)
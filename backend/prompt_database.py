@@ -3,29 +3,296 @@
 使用 SQLite 存储和管理提示词
 """
 
+import atexit
+import base64
 import sqlite3
 import json
 import os
-from typing import List, Dict, Optional
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterable, List, Dict, Optional, Iterator, Tuple
 from datetime import datetime
 import re
 
+from metrics import DB_QUERY_SECONDS
+
+
+# 连接池配置（可通过环境变量调整）
+DB_POOL_SIZE = int(os.environ.get('PROMPT_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('PROMPT_DB_POOL_TIMEOUT', 30))
+
+# 使用次数写回：最多缓存多少秒，或累计多少次后提前写入
+USAGE_FLUSH_INTERVAL = float(os.environ.get('PROMPT_USAGE_FLUSH_INTERVAL', 2))
+USAGE_FLUSH_THRESHOLD = int(os.environ.get('PROMPT_USAGE_FLUSH_THRESHOLD', 500))
+
+# Excel 导入每个事务写入的行数
+EXCEL_IMPORT_BATCH_SIZE = int(os.environ.get('EXCEL_IMPORT_BATCH_SIZE', 1000))
+
+# 每个连接建立时设置的 PRAGMA（journal_mode=WAL 是持久化的，只在初始化时设置一次）
+DB_PRAGMAS = {
+    'synchronous': os.environ.get('PROMPT_DB_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.environ.get('PROMPT_DB_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('PROMPT_DB_CACHE_SIZE', -16000)),  # 负数表示 KB
+    'temp_store': 'MEMORY',
+}
+
+
+class ConnectionPool:
+    """SQLite 连接池
+
+    - 每个进程一个有界的连接池，gunicorn fork 之后子进程会重建自己的连接池
+    - 同一线程内嵌套使用时复用同一个连接（可重入），事务只在最外层提交
+    """
+
+    def __init__(self, db_path: str, max_size: int = DB_POOL_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT, pragmas: Optional[Dict] = None):
+        self.db_path = db_path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.pragmas = pragmas if pragmas is not None else DB_PRAGMAS
+        self._reset()
+
+    def _reset(self):
+        """重置连接池状态（进程初始化或 fork 之后调用）"""
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _check_pid(self):
+        # 父进程的连接不能跨 fork 使用，直接丢弃
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self) -> sqlite3.Connection:
+        """建立一个新连接并设置 PRAGMA"""
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # 使用字典形式返回结果
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """从连接池取出一个连接，池满时等待其他线程归还"""
+        self._check_pid()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.max_size
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'获取数据库连接超时（连接池大小 {self.max_size}）')
+
+    def release(self, conn: sqlite3.Connection):
+        """归还连接"""
+        if self._pid != os.getpid():
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """上下文管理器：正常退出时提交，异常时回滚，无论如何都归还连接"""
+        self._check_pid()
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            # 同一线程内嵌套调用，复用外层连接
+            yield conn
+            return
+
+        conn = self.acquire()
+        local.conn = conn
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            local.conn = None
+            self.release(conn)
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def timed(method):
+    """记录数据库操作耗时（指标 db_query_duration_seconds，operation 为方法名）"""
+    operation = method.__name__
+    
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, operation=operation)
+    return wrapper
+
+
+class UsageCounters:
+    """提示词使用次数的延迟写回
+    
+    increment 只在内存中累加，后台线程每 flush_interval 秒（或累计达到 threshold 次时立即）
+    在一个事务中批量写入；进程退出时写入剩余的计数。
+    按 id 读取提示词时加上本进程尚未写入的计数（pending）；列表按数据库中的使用次数排序和分页，
+    最多落后 flush_interval 秒
+    """
+    
+    def __init__(self, pool: ConnectionPool, on_flush: Optional[Callable[[], None]] = None,
+                 flush_interval: float = USAGE_FLUSH_INTERVAL, threshold: int = USAGE_FLUSH_THRESHOLD):
+        self.pool = pool
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.threshold = max(1, threshold)
+        self._pending: Dict[int, int] = {}
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread_pid = None
+        atexit.register(self.flush)
+    
+    def _ensure_thread(self):
+        """写回线程按进程启动（fork 出的 worker 各自启动，父进程未写入的计数不继承）"""
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            if self._thread_pid is not None:
+                self._pending = {}
+                self._pending_total = 0
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='prompt-usage-flush', daemon=True).start()
+    
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"写入提示词使用次数失败: {e}")
+    
+    def increment(self, prompt_id: int, count: int = 1):
+        self._ensure_thread()
+        with self._lock:
+            self._pending[prompt_id] = self._pending.get(prompt_id, 0) + count
+            self._pending_total += count
+            if self._pending_total >= self.threshold:
+                self._wake.set()
+    
+    def pending(self, prompt_id: int) -> int:
+        """尚未写入数据库的使用次数"""
+        with self._lock:
+            return self._pending.get(prompt_id, 0)
+    
+    def apply_pending(self, prompt: Dict) -> Dict:
+        """把尚未写入的使用次数加到读取到的提示词上"""
+        prompt['usage_count'] += self.pending(prompt['id'])
+        return prompt
+    
+    def flush(self):
+        """把累计的使用次数在一个事务中写入；失败时计数放回，下次重试"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, {}
+                self._pending_total = 0
+            started = time.perf_counter()
+            try:
+                with self.pool.connection() as conn:
+                    conn.executemany(
+                        'UPDATE prompts SET usage_count = usage_count + ? WHERE id = ?',
+                        [(count, prompt_id) for prompt_id, count in pending.items()]
+                    )
+                DB_QUERY_SECONDS.observe(time.perf_counter() - started, operation='flush_usage')
+            except Exception:
+                with self._lock:
+                    for prompt_id, count in pending.items():
+                        self._pending[prompt_id] = self._pending.get(prompt_id, 0) + count
+                        self._pending_total += count
+                raise
+            if self.on_flush:
+                self.on_flush()
+
 
 class PromptDatabase:
-    def __init__(self, db_path: str = 'prompts.db'):
-        """初始化数据库连接"""
+    def __init__(self, db_path: str = 'prompts.db', pool_size: int = DB_POOL_SIZE):
+        """初始化数据库连接池"""
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, max_size=pool_size)
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self.usage = UsageCounters(self.pool, on_flush=self._bump_generation)
         self.init_database()
     
-    def get_connection(self):
-        """获取数据库连接"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # 使用字典形式返回结果
-        return conn
+    @property
+    def generation(self) -> int:
+        """本进程的写入代数：每次通过 connection() 提交了修改后加一（用于缓存失效）"""
+        return self._generation
+    
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """获取数据库连接（上下文管理器，用完自动归还连接池）"""
+        with self.pool.connection() as conn:
+            changes = conn.total_changes
+            yield conn
+        # 提交之后再增加代数，读到新代数的线程一定能读到新数据
+        if conn.total_changes != changes:
+            self._bump_generation()
+    
+    def _bump_generation(self):
+        with self._generation_lock:
+            self._generation += 1
     
     def init_database(self):
         """初始化数据库表结构"""
-        conn = self.get_connection()
+        # WAL 模式允许读写并发，只需设置一次（持久化在数据库文件中）
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._create_tables(conn)
+            self.fts_enabled = self._create_fts_index(conn)
+            self._create_change_log(conn)
+        
+        # 插入默认分类
+        self.ensure_default_categories()
+    
+    def _create_tables(self, conn: sqlite3.Connection):
+        """创建表和索引"""
         cursor = conn.cursor()
         
         # 创建分类表
@@ -64,11 +331,94 @@ class PromptDatabase:
             ON prompts(category_id)
         ''')
         
-        conn.commit()
-        conn.close()
+        # 提示词列表的排序（使用次数、创建时间倒序），全部和按分类两种
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_prompts_usage 
+            ON prompts(usage_count DESC, created_at DESC, id DESC)
+        ''')
         
-        # 插入默认分类
-        self.ensure_default_categories()
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_prompts_category_usage 
+            ON prompts(category_id, usage_count DESC, created_at DESC, id DESC)
+        ''')
+        
+        # 恢复备份时按（分类, 标题）查找已有提示词
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_prompts_category_title 
+            ON prompts(category_id, title)
+        ''')
+    
+    def _create_fts_index(self, conn: sqlite3.Connection) -> bool:
+        """创建 FTS5 全文索引（trigram 分词，支持中文子串匹配），并用触发器保持同步
+
+        返回 False 表示当前 SQLite 不支持 FTS5/trigram，搜索会退回 LIKE 扫描
+        """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'prompts_fts'"
+        ).fetchone()
+        
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(
+                    title, keywords, content,
+                    content='prompts', content_rowid='id',
+                    tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"FTS5 不可用，提示词搜索将使用 LIKE 匹配: {e}")
+            return False
+        
+        conn.executescript('''
+            CREATE TRIGGER IF NOT EXISTS prompts_fts_ai AFTER INSERT ON prompts BEGIN
+                INSERT INTO prompts_fts(rowid, title, keywords, content)
+                VALUES (new.id, new.title, new.keywords, new.content);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS prompts_fts_ad AFTER DELETE ON prompts BEGIN
+                INSERT INTO prompts_fts(prompts_fts, rowid, title, keywords, content)
+                VALUES ('delete', old.id, old.title, old.keywords, old.content);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS prompts_fts_au AFTER UPDATE OF title, keywords, content ON prompts BEGIN
+                INSERT INTO prompts_fts(prompts_fts, rowid, title, keywords, content)
+                VALUES ('delete', old.id, old.title, old.keywords, old.content);
+                INSERT INTO prompts_fts(rowid, title, keywords, content)
+                VALUES (new.id, new.title, new.keywords, new.content);
+            END;
+        ''')
+        
+        # 已有数据库第一次创建索引时，回填历史数据
+        if not exists:
+            conn.execute("INSERT INTO prompts_fts(prompts_fts) VALUES ('rebuild')")
+        
+        return True
+    
+    def _create_change_log(self, conn: sqlite3.Connection):
+        """创建提示词变更日志：触发器记录每次增删改的提示词 id，供语义索引增量同步
+
+        只记录影响向量的字段（使用次数的更新不记录）
+        """
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS prompt_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                prompt_id INTEGER NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            
+            CREATE TRIGGER IF NOT EXISTS prompts_changes_ai AFTER INSERT ON prompts BEGIN
+                INSERT INTO prompt_changes(prompt_id) VALUES (new.id);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS prompts_changes_ad AFTER DELETE ON prompts BEGIN
+                INSERT INTO prompt_changes(prompt_id) VALUES (old.id);
+            END;
+            
+            CREATE TRIGGER IF NOT EXISTS prompts_changes_au
+            AFTER UPDATE OF title, keywords, content, category_id ON prompts BEGIN
+                INSERT INTO prompt_changes(prompt_id) VALUES (new.id);
+            END;
+        ''')
     
     def ensure_default_categories(self):
         """确保有默认分类"""
@@ -82,147 +432,202 @@ class PromptDatabase:
             ('通用', '通用场景的提示词'),
         ]
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        for name, description in default_categories:
-            cursor.execute(
+        with self.connection() as conn:
+            conn.executemany(
                 'INSERT OR IGNORE INTO categories (name, description) VALUES (?, ?)',
-                (name, description)
+                default_categories
             )
-        
-        conn.commit()
-        conn.close()
     
     # ==================== 分类管理 ====================
     
+    @timed
     def get_all_categories(self) -> List[Dict]:
         """获取所有分类"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM categories ORDER BY name')
-        categories = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return categories
+        with self.connection() as conn:
+            cursor = conn.execute('SELECT * FROM categories ORDER BY name')
+            return [dict(row) for row in cursor.fetchall()]
     
+    @timed
     def create_category(self, name: str, description: str = '') -> int:
         """创建新分类"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO categories (name, description) VALUES (?, ?)',
-            (name, description)
-        )
-        category_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return category_id
+        with self.connection() as conn:
+            cursor = conn.execute(
+                'INSERT INTO categories (name, description) VALUES (?, ?)',
+                (name, description)
+            )
+            return cursor.lastrowid
     
+    @timed
     def update_category(self, category_id: int, name: str, description: str = '') -> bool:
         """更新分类"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE categories SET name = ?, description = ? WHERE id = ?',
-            (name, description, category_id)
-        )
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        with self.connection() as conn:
+            cursor = conn.execute(
+                'UPDATE categories SET name = ?, description = ? WHERE id = ?',
+                (name, description, category_id)
+            )
+            return cursor.rowcount > 0
     
+    @timed
     def delete_category(self, category_id: int) -> bool:
         """删除分类（会将该分类下的提示词移到"通用"分类）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 获取"通用"分类ID
-        cursor.execute('SELECT id FROM categories WHERE name = ?', ('通用',))
-        general_category = cursor.fetchone()
-        if not general_category:
-            return False
-        
-        general_id = general_category['id']
-        
-        # 将该分类下的所有提示词移到"通用"
-        cursor.execute(
-            'UPDATE prompts SET category_id = ? WHERE category_id = ?',
-            (general_id, category_id)
-        )
-        
-        # 删除分类
-        cursor.execute('DELETE FROM categories WHERE id = ?', (category_id,))
-        success = cursor.rowcount > 0
-        
-        conn.commit()
-        conn.close()
-        return success
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 获取"通用"分类ID
+            cursor.execute('SELECT id FROM categories WHERE name = ?', ('通用',))
+            general_category = cursor.fetchone()
+            if not general_category:
+                return False
+            
+            general_id = general_category['id']
+            
+            # 将该分类下的所有提示词移到"通用"
+            cursor.execute(
+                'UPDATE prompts SET category_id = ? WHERE category_id = ?',
+                (general_id, category_id)
+            )
+            
+            # 删除分类
+            cursor.execute('DELETE FROM categories WHERE id = ?', (category_id,))
+            return cursor.rowcount > 0
     
     # ==================== 提示词管理 ====================
     
+    @timed
     def create_prompt(self, title: str, content: str, category_id: int = None, keywords: str = '') -> int:
         """创建新提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 如果没有指定分类，使用"通用"分类
-        if category_id is None:
-            cursor.execute('SELECT id FROM categories WHERE name = ?', ('通用',))
-            general_category = cursor.fetchone()
-            if general_category:
-                category_id = general_category['id']
-        
-        cursor.execute(
-            '''INSERT INTO prompts (title, content, category_id, keywords) 
-               VALUES (?, ?, ?, ?)''',
-            (title, content, category_id, keywords)
-        )
-        prompt_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return prompt_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 如果没有指定分类，使用"通用"分类
+            if category_id is None:
+                cursor.execute('SELECT id FROM categories WHERE name = ?', ('通用',))
+                general_category = cursor.fetchone()
+                if general_category:
+                    category_id = general_category['id']
+            
+            cursor.execute(
+                '''INSERT INTO prompts (title, content, category_id, keywords) 
+                   VALUES (?, ?, ?, ?)''',
+                (title, content, category_id, keywords)
+            )
+            return cursor.lastrowid
     
+    @timed
     def get_prompt(self, prompt_id: int) -> Optional[Dict]:
         """获取单个提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM prompts WHERE id = ?', (prompt_id,))
-        prompt = cursor.fetchone()
-        conn.close()
-        return dict(prompt) if prompt else None
+        with self.connection() as conn:
+            prompt = conn.execute('SELECT * FROM prompts WHERE id = ?', (prompt_id,)).fetchone()
+            return self.usage.apply_pending(dict(prompt)) if prompt else None
     
-    def get_all_prompts(self, category_id: Optional[int] = None) -> List[Dict]:
-        """获取所有提示词（可按分类筛选）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    @timed
+    def get_prompts_by_ids(self, prompt_ids: List[int]) -> List[Dict]:
+        """按 id 批量获取提示词（按传入顺序返回，不存在的 id 跳过）"""
+        prompts = {}
+        with self.connection() as conn:
+            # 分批查询，避免超过 SQLite 的参数个数上限
+            for start in range(0, len(prompt_ids), 500):
+                batch = prompt_ids[start:start + 500]
+                cursor = conn.execute(
+                    f'''SELECT p.*, c.name as category_name 
+                        FROM prompts p 
+                        LEFT JOIN categories c ON p.category_id = c.id 
+                        WHERE p.id IN ({','.join('?' * len(batch))})''',
+                    batch
+                )
+                prompts.update((row['id'], self.usage.apply_pending(dict(row))) for row in cursor.fetchall())
+        return [prompts[prompt_id] for prompt_id in prompt_ids if prompt_id in prompts]
+    
+    def iter_prompts(self, batch_size: int = 500) -> Iterator[List[Dict]]:
+        """按 id 顺序分批遍历所有提示词（用于重建索引，不会一次读入全部数据）"""
+        last_id = 0
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute(
+                    'SELECT * FROM prompts WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+            last_id = rows[-1]['id']
+    
+    # 提示词列表可以返回的字段（category_name 来自分类表）
+    PROMPT_LIST_FIELDS = ('id', 'title', 'content', 'category_id', 'keywords', 'usage_count',
+                          'created_at', 'updated_at', 'category_name')
+    PROMPT_LIST_MAX_LIMIT = 500
+    
+    @staticmethod
+    def _encode_cursor(row: sqlite3.Row) -> str:
+        """游标：最后一行的排序键（使用次数, 创建时间, id）"""
+        payload = json.dumps([row['usage_count'], row['created_at'], row['id']], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+    
+    @staticmethod
+    def _decode_cursor(cursor: str) -> List:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except ValueError:
+            raise ValueError('无效的分页游标')
+        if not isinstance(values, list) or len(values) != 3:
+            raise ValueError('无效的分页游标')
+        return values
+    
+    @timed
+    def list_prompts(self, category_id: Optional[int] = None, fields: Optional[List[str]] = None,
+                     limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """按使用次数、创建时间倒序列出提示词（可按分类筛选）
         
+        fields: 只返回这些字段（id 总是返回），列表页可以不取 content
+        limit/cursor: 键集分页，按上一页返回的游标继续，不使用 OFFSET，翻页开销不随页码增长
+        使用次数为数据库中的值（排序和游标依赖它），最多落后一个写回间隔
+        返回 (提示词列表, 下一页游标)，没有下一页时游标为 None
+        """
+        fields = list(dict.fromkeys(['id'] + list(fields))) if fields else list(self.PROMPT_LIST_FIELDS)
+        unknown = [field for field in fields if field not in self.PROMPT_LIST_FIELDS]
+        if unknown:
+            raise ValueError(f"不支持的字段: {', '.join(unknown)}")
+        
+        # 排序键总是查询出来（用于生成游标），返回前去掉未请求的字段
+        columns = ['c.name AS category_name' if field == 'category_name' else f'p.{field}' for field in fields]
+        columns += [f'p.{key}' for key in ('usage_count', 'created_at') if key not in fields]
+        query = f"SELECT {', '.join(columns)} FROM prompts p"
+        if 'category_name' in fields:
+            query += ' LEFT JOIN categories c ON p.category_id = c.id'
+        
+        conditions = []
+        params = []
         if category_id:
-            cursor.execute(
-                '''SELECT p.*, c.name as category_name 
-                   FROM prompts p 
-                   LEFT JOIN categories c ON p.category_id = c.id 
-                   WHERE p.category_id = ? 
-                   ORDER BY p.usage_count DESC, p.created_at DESC''',
-                (category_id,)
-            )
-        else:
-            cursor.execute(
-                '''SELECT p.*, c.name as category_name 
-                   FROM prompts p 
-                   LEFT JOIN categories c ON p.category_id = c.id 
-                   ORDER BY p.usage_count DESC, p.created_at DESC'''
-            )
+            conditions.append('p.category_id = ?')
+            params.append(category_id)
+        if cursor:
+            conditions.append('(p.usage_count, p.created_at, p.id) < (?, ?, ?)')
+            params.extend(self._decode_cursor(cursor))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY p.usage_count DESC, p.created_at DESC, p.id DESC'
+        if limit is not None:
+            limit = max(1, min(limit, self.PROMPT_LIST_MAX_LIMIT))
+            query += ' LIMIT ?'
+            params.append(limit + 1)  # 多取一行判断是否还有下一页
         
-        prompts = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return prompts
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_cursor(rows[-1])
+        return [{field: row[field] for field in fields} for row in rows], next_cursor
+    
+    def get_all_prompts(self, category_id: Optional[int] = None) -> List[Dict]:
+        """获取所有提示词（可按分类筛选）"""
+        return self.list_prompts(category_id)[0]
     
+    @timed
     def update_prompt(self, prompt_id: int, title: str = None, content: str = None, 
                      category_id: int = None, keywords: str = None) -> bool:
         """更新提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         updates = []
         params = []
         
@@ -242,155 +647,319 @@ class PromptDatabase:
             updates.append('keywords = ?')
             params.append(keywords)
         
-        if updates:
-            updates.append('updated_at = CURRENT_TIMESTAMP')
-            params.append(prompt_id)
-            
-            query = f'UPDATE prompts SET {", ".join(updates)} WHERE id = ?'
-            cursor.execute(query, params)
-            success = cursor.rowcount > 0
-            conn.commit()
-        else:
-            success = False
+        if not updates:
+            return False
+        
+        updates.append('updated_at = CURRENT_TIMESTAMP')
+        params.append(prompt_id)
         
-        conn.close()
-        return success
+        query = f'UPDATE prompts SET {", ".join(updates)} WHERE id = ?'
+        with self.connection() as conn:
+            cursor = conn.execute(query, params)
+            return cursor.rowcount > 0
     
+    @timed
     def delete_prompt(self, prompt_id: int) -> bool:
         """删除提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM prompts WHERE id = ?', (prompt_id,))
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        with self.connection() as conn:
+            cursor = conn.execute('DELETE FROM prompts WHERE id = ?', (prompt_id,))
+            return cursor.rowcount > 0
     
     def increment_usage(self, prompt_id: int):
-        """增加提示词使用次数"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE prompts SET usage_count = usage_count + 1 WHERE id = ?',
-            (prompt_id,)
-        )
-        conn.commit()
-        conn.close()
+        """增加提示词使用次数（先在内存中累计，由后台线程批量写入）"""
+        self.usage.increment(prompt_id)
     
     # ==================== 智能匹配 ====================
     
+    # 全文检索排序参数：title、keywords、content 三列的 BM25 权重，以及使用次数的加成上限
+    FTS_COLUMN_WEIGHTS = (10.0, 5.0, 1.0)
+    FTS_USAGE_WEIGHT = 1.0
+    
+    @staticmethod
+    def _split_keywords(query: str) -> List[str]:
+        """将查询词分割成关键词"""
+        return [kw.strip() for kw in re.split(r'[,\s，、]+', query.lower()) if kw.strip()]
+    
+    @staticmethod
+    def _build_match_expression(keywords: List[str]) -> Optional[str]:
+        """构建 FTS5 MATCH 表达式；trigram 分词要求每个词至少 3 个字符，
+        有更短的词时返回 None，由调用方改用 LIKE 匹配（否则只命中短词的提示词会被漏掉）"""
+        if not keywords or any(len(kw) < 3 for kw in keywords):
+            return None
+        return ' OR '.join('"' + kw.replace('"', '""') + '"' for kw in keywords)
+    
+    @timed
     def search_prompts_by_keywords(self, query: str, category_id: Optional[int] = None, limit: int = 5) -> List[Dict]:
-        """根据关键词搜索提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 将查询词分割成关键词
-        keywords = [kw.strip() for kw in re.split(r'[,\s，、]+', query.lower()) if kw.strip()]
+        """根据关键词搜索提示词（FTS5 + BM25 排序，结合使用次数）"""
+        keywords = self._split_keywords(query)
         
         if not keywords:
             return []
         
-        # 构建搜索条件
+        match_expression = self._build_match_expression(keywords) if self.fts_enabled else None
+        if match_expression is None:
+            # 有太短的关键词（如两个汉字）或不支持 FTS5 时，退回 LIKE 扫描
+            return self._search_prompts_like(keywords, category_id, limit)
+        
+        title_weight, keywords_weight, content_weight = self.FTS_COLUMN_WEIGHTS
+        query_sql = f'''
+            SELECT p.*, c.name as category_name,
+                   -bm25(prompts_fts, {title_weight}, {keywords_weight}, {content_weight}) AS score
+            FROM prompts_fts f
+            JOIN prompts p ON p.id = f.rowid
+            LEFT JOIN categories c ON p.category_id = c.id
+            WHERE prompts_fts MATCH ?
+        '''
+        params = [match_expression]
+        
         if category_id:
-            query_sql = '''
-                SELECT p.*, c.name as category_name 
-                FROM prompts p 
-                LEFT JOIN categories c ON p.category_id = c.id 
-                WHERE p.category_id = ? AND (
-            '''
-            params = [category_id]
-        else:
-            query_sql = '''
-                SELECT p.*, c.name as category_name 
-                FROM prompts p 
-                LEFT JOIN categories c ON p.category_id = c.id 
-                WHERE (
-            '''
-            params = []
-        
-        # 构建关键词匹配条件
-        conditions = []
-        for keyword in keywords:
-            conditions.append('LOWER(p.title) LIKE ? OR LOWER(p.keywords) LIKE ? OR LOWER(p.content) LIKE ?')
-            params.extend([f'%{keyword}%', f'%{keyword}%', f'%{keyword}%'])
+            query_sql += ' AND p.category_id = ?'
+            params.append(category_id)
         
-        query_sql += ' OR '.join(conditions)
-        query_sql += ') ORDER BY p.usage_count DESC, p.created_at DESC LIMIT ?'
-        params.append(limit)
+        # BM25 分数越大越相关；使用次数的加成随次数饱和，最多 FTS_USAGE_WEIGHT
+        query_sql += '''
+            ORDER BY score + ? * p.usage_count / (p.usage_count + 10.0) DESC, p.created_at DESC
+            LIMIT ?
+        '''
+        params.extend([self.FTS_USAGE_WEIGHT, limit])
         
-        cursor.execute(query_sql, params)
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.execute(query_sql, params)
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def _search_prompts_like(self, keywords: List[str], category_id: Optional[int], limit: int) -> List[Dict]:
+        """LIKE 模糊匹配（全表扫描，仅用于含短关键词的查询）；score 为命中的关键词个数"""
+        # 每个关键词一个条件，命中为 1，相加即命中个数
+        condition = '(LOWER(p.title) LIKE ? OR LOWER(p.keywords) LIKE ? OR LOWER(p.content) LIKE ?)'
+        patterns = [pattern for keyword in keywords for pattern in [f'%{keyword}%'] * 3]
+        score_sql = ' + '.join([condition] * len(keywords))
+        
+        query_sql = f'''
+            SELECT p.*, c.name as category_name, {score_sql} AS score
+            FROM prompts p 
+            LEFT JOIN categories c ON p.category_id = c.id 
+            WHERE ({' OR '.join([condition] * len(keywords))})
+        '''
+        params = patterns + patterns
+        
+        if category_id:
+            query_sql += ' AND p.category_id = ?'
+            params.append(category_id)
+        
+        query_sql += ' ORDER BY score DESC, p.usage_count DESC, p.created_at DESC LIMIT ?'
+        params.append(limit)
         
-        return results
+        with self.connection() as conn:
+            cursor = conn.execute(query_sql, params)
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @timed
+    def get_category_id(self, category_name: str) -> Optional[int]:
+        """根据分类名称获取分类ID"""
+        with self.connection() as conn:
+            category = conn.execute(
+                'SELECT id FROM categories WHERE name = ?', (category_name,)
+            ).fetchone()
+            return category['id'] if category else None
     
     def find_best_match_for_section(self, section_title: str, category_name: str = '章节生成') -> Optional[Dict]:
         """为章节标题找到最佳匹配的提示词"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        return self.find_best_matches_for_sections([section_title], category_name)[0]
+    
+    @timed
+    def find_best_matches_for_sections(self, section_titles: List[str],
+                                       category_name: str = '章节生成') -> List[Optional[Dict]]:
+        """为多个章节标题批量匹配提示词，返回与 section_titles 一一对应的最佳匹配（没有匹配时为 None）
         
-        # 获取分类ID
-        cursor.execute('SELECT id FROM categories WHERE name = ?', (category_name,))
-        category = cursor.fetchone()
-        category_id = category['id'] if category else None
+        分类只查一次；所有标题的检索条件放进一个 VALUES 表，全文检索和 LIKE 回退各一条查询，
+        用窗口函数取每个章节排名第一的提示词
+        """
+        category_id = self.get_category_id(category_name)
         
-        # 提取章节标题中的关键词
-        title_clean = re.sub(r'^#+\s*', '', section_title)  # 移除 markdown 标记
+        fts_queries = []  # (章节序号, MATCH 表达式)
+        like_queries = []  # (章节序号, LIKE 模式)
+        for index, section_title in enumerate(section_titles):
+            title_clean = re.sub(r'^#+\s*', '', section_title or '')  # 移除 markdown 标记
+            keywords = self._split_keywords(title_clean)
+            match_expression = self._build_match_expression(keywords) if self.fts_enabled else None
+            if match_expression:
+                fts_queries.append((index, match_expression))
+            else:
+                # 有太短的关键词（如两个汉字）或不支持 FTS5 时，退回 LIKE 匹配
+                like_queries.extend((index, f'%{keyword}%') for keyword in keywords)
         
-        # 搜索匹配的提示词
-        results = self.search_prompts_by_keywords(title_clean, category_id, limit=1)
+        category_filter = ' AND p.category_id = ?' if category_id else ''
+        category_params = [category_id] if category_id else []
+        matches: List[Optional[Dict]] = [None] * len(section_titles)
         
-        conn.close()
+        with self.connection() as conn:
+            if fts_queries:
+                title_weight, keywords_weight, content_weight = self.FTS_COLUMN_WEIGHTS
+                rows = conn.execute(f'''
+                    WITH q(section_index, expression) AS (VALUES {', '.join(['(?, ?)'] * len(fts_queries))}),
+                    hits AS (
+                        -- CROSS JOIN 固定连接顺序：每个章节一次全文检索，再按 rowid 取提示词
+                        SELECT q.section_index, p.id, p.usage_count, p.created_at,
+                               -bm25(prompts_fts, {title_weight}, {keywords_weight}, {content_weight}) AS score
+                        FROM q CROSS JOIN prompts_fts f CROSS JOIN prompts p
+                        WHERE prompts_fts MATCH q.expression AND p.id = f.rowid{category_filter}
+                    ),
+                    ranked AS (
+                        SELECT section_index, score, id,
+                               ROW_NUMBER() OVER (
+                                   PARTITION BY section_index
+                                   ORDER BY score + ? * usage_count / (usage_count + 10.0) DESC, created_at DESC
+                               ) AS rank
+                        FROM hits
+                    )
+                    SELECT r.section_index, r.score, p.*, c.name AS category_name
+                    FROM ranked r
+                    JOIN prompts p ON p.id = r.id
+                    LEFT JOIN categories c ON p.category_id = c.id
+                    WHERE r.rank = 1
+                ''', [value for query in fts_queries for value in query] + category_params + [self.FTS_USAGE_WEIGHT])
+                for row in rows:
+                    match = dict(row)
+                    matches[match.pop('section_index')] = match
+            
+            if like_queries:
+                rows = conn.execute(f'''
+                    WITH q(section_index, pattern) AS (VALUES {', '.join(['(?, ?)'] * len(like_queries))}),
+                    ranked AS (
+                        -- score 为命中的关键词个数，与 search_prompts_by_keywords 的 LIKE 回退一致
+                        SELECT q.section_index, p.id, p.usage_count, p.created_at,
+                               COUNT(DISTINCT q.pattern) AS score
+                        FROM prompts p CROSS JOIN q  -- CROSS JOIN 固定连接顺序：提示词表只扫描一遍
+                        WHERE (LOWER(p.title) LIKE q.pattern OR LOWER(p.keywords) LIKE q.pattern
+                               OR LOWER(p.content) LIKE q.pattern){category_filter}
+                        GROUP BY q.section_index, p.id
+                    ),
+                    best AS (
+                        SELECT section_index, score, id,
+                               ROW_NUMBER() OVER (
+                                   PARTITION BY section_index ORDER BY score DESC, usage_count DESC, created_at DESC
+                               ) AS rank
+                        FROM ranked
+                    )
+                    SELECT b.section_index, b.score, p.*, c.name AS category_name
+                    FROM best b
+                    JOIN prompts p ON p.id = b.id
+                    LEFT JOIN categories c ON p.category_id = c.id
+                    WHERE b.rank = 1
+                ''', [value for query in like_queries for value in query] + category_params)
+                for row in rows:
+                    match = dict(row)
+                    matches[match.pop('section_index')] = match
         
-        return results[0] if results else None
+        return matches
+    
+    # ==================== 变更日志 ====================
+    
+    def get_last_change_id(self) -> int:
+        """最新的变更日志 id"""
+        with self.connection() as conn:
+            row = conn.execute('SELECT MAX(id) AS id FROM prompt_changes').fetchone()
+            return row['id'] or 0
+    
+    @timed
+    def get_prompt_changes(self, after_id: int, limit: int = 1000) -> List[Dict]:
+        """获取 id 大于 after_id 的变更记录"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                'SELECT id, prompt_id FROM prompt_changes WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def prune_prompt_changes(self, max_age_seconds: float) -> int:
+        """清理过期的变更记录（始终保留最新一条，get_last_change_id 不会退回 0）"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                '''DELETE FROM prompt_changes 
+                   WHERE changed_at < datetime('now', ?) 
+                   AND id < (SELECT MAX(id) FROM prompt_changes)''',
+                (f'-{int(max_age_seconds)} seconds',)
+            )
+            return cursor.rowcount
     
     # ==================== 数据导入 ====================
     
-    def import_from_excel(self, excel_path: str) -> Dict[str, int]:
-        """从Excel文件导入提示词"""
+    def _get_or_create_category(self, conn: sqlite3.Connection, name: str, cache: Dict[str, int]) -> int:
+        """在当前事务中获取或创建分类，结果记入本次导入的缓存"""
+        category_id = cache.get(name)
+        if category_id is None:
+            conn.execute('INSERT OR IGNORE INTO categories (name, description) VALUES (?, ?)', (name, ''))
+            category_id = conn.execute('SELECT id FROM categories WHERE name = ?', (name,)).fetchone()['id']
+            cache[name] = category_id
+        return category_id
+    
+    @timed
+    def import_from_excel(self, excel_path: str, batch_size: int = EXCEL_IMPORT_BATCH_SIZE,
+                          progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+        """从Excel文件导入提示词
+        
+        以只读模式逐行读取工作表，每 batch_size 行在一个事务中 executemany 写入；
+        每个批次提交后调用 progress({'processed', 'imported', 'skipped', 'total'})
+        """
+        imported = 0
+        skipped = 0
+        processed = 0
+        workbook = None
         try:
             import openpyxl
             
-            workbook = openpyxl.load_workbook(excel_path)
+            workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
             sheet = workbook.active
+            total = max(0, sheet.max_row - 1) if sheet.max_row else None  # 只读模式下可能未知
+            
+            # 本次导入的分类缓存：名称 -> id
+            categories = {category['name']: category['id'] for category in self.get_all_categories()}
             
-            imported = 0
-            skipped = 0
+            def write_batch(rows):
+                with self.connection() as conn:
+                    conn.executemany(
+                        '''INSERT INTO prompts (title, content, category_id, keywords) 
+                           VALUES (?, ?, ?, ?)''',
+                        [(title, content, self._get_or_create_category(conn, category_name, categories), keywords)
+                         for title, content, category_name, keywords in rows]
+                    )
             
+            batch = []
             # 假设Excel格式：第一列是标题，第二列是内容，第三列是分类，第四列是关键词
             for row in sheet.iter_rows(min_row=2, values_only=True):
-                if not row[0] or not row[1]:  # 标题和内容必须有
+                processed += 1
+                if len(row) < 2 or not row[0] or not row[1]:  # 标题和内容必须有
                     skipped += 1
-                    continue
-                
-                title = str(row[0]).strip()
-                content = str(row[1]).strip()
-                category_name = str(row[2]).strip() if len(row) > 2 and row[2] else '通用'
-                keywords = str(row[3]).strip() if len(row) > 3 and row[3] else ''
-                
-                # 获取或创建分类
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute('SELECT id FROM categories WHERE name = ?', (category_name,))
-                category = cursor.fetchone()
-                
-                if category:
-                    category_id = category['id']
                 else:
-                    # 创建新分类
-                    category_id = self.create_category(category_name)
-                
-                conn.close()
+                    batch.append((
+                        str(row[0]).strip(),
+                        str(row[1]).strip(),
+                        str(row[2]).strip() if len(row) > 2 and row[2] else '通用',
+                        str(row[3]).strip() if len(row) > 3 and row[3] else '',
+                    ))
                 
-                # 创建提示词
-                self.create_prompt(title, content, category_id, keywords)
-                imported += 1
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    imported += len(batch)
+                    batch = []
+                    if progress:
+                        progress({'processed': processed, 'imported': imported, 'skipped': skipped, 'total': total})
+            
+            if batch:
+                write_batch(batch)
+                imported += len(batch)
+            if progress:
+                progress({'processed': processed, 'imported': imported, 'skipped': skipped, 'total': processed})
             
             return {'imported': imported, 'skipped': skipped}
         
         except Exception as e:
+            # 已提交的批次保留，返回中包含已导入的数量
             print(f"导入Excel失败: {e}")
-            return {'imported': 0, 'skipped': 0, 'error': str(e)}
+            return {'imported': imported, 'skipped': skipped, 'error': str(e)}
+        finally:
+            if workbook is not None:
+                workbook.close()
     
     def export_to_dict(self) -> Dict:
         """导出所有数据为字典（用于备份）"""
@@ -401,31 +970,125 @@ class PromptDatabase:
         }
     
     def import_from_dict(self, data: Dict) -> bool:
-        """从字典导入数据（用于恢复）"""
+        """从字典导入数据（用于恢复，按名称/标题合并到已有数据）"""
+        records = [dict(category, type='category') for category in data.get('categories', [])]
+        records += [dict(prompt, type='prompt') for prompt in data.get('prompts', [])]
+        result = self.restore_records(records)
+        return 'error' not in result
+    
+    # ==================== 流式备份与恢复 ====================
+    
+    def iter_backup_records(self, batch_size: int = 500) -> Iterator[Dict]:
+        """逐条产出备份记录：分类在前，提示词在后
+        
+        在同一个读事务中用游标分批读取，得到一致的快照，内存占用与数据量无关；
+        直接使用连接池连接（不绑定到线程），生成器挂起期间不影响同线程的其他查询
+        """
+        conn = self.pool.acquire()
         try:
-            # 导入分类
-            category_mapping = {}  # 旧ID -> 新ID
-            for cat in data.get('categories', []):
-                old_id = cat['id']
-                new_id = self.create_category(cat['name'], cat.get('description', ''))
-                category_mapping[old_id] = new_id
+            conn.execute('BEGIN')
+            for table, record_type in (('categories', 'category'), ('prompts', 'prompt')):
+                cursor = conn.execute(f'SELECT * FROM {table} ORDER BY id')
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = dict(row)
+                        record['type'] = record_type
+                        yield record
+        finally:
+            self.pool.release(conn)
+    
+    def _restore_batch(self, conn: sqlite3.Connection, records: List[Dict],
+                       category_mapping: Dict[int, int], stats: Dict[str, int]):
+        """在一个事务中写入一批备份记录
+        
+        分类按名称合并（已存在时更新描述）；提示词按（分类, 标题）合并，内容有变化时才更新；
+        备份中的分类 id 通过 category_mapping 映射为当前数据库的 id
+        """
+        general_id = category_mapping.get(None)
+        for record in records:
+            record_type = record.get('type')
+            if record_type == 'category':
+                if not record.get('name'):
+                    stats['skipped'] += 1
+                    continue
+                existing = conn.execute('SELECT id FROM categories WHERE name = ?', (record['name'],)).fetchone()
+                if existing:
+                    if record.get('description'):
+                        conn.execute('UPDATE categories SET description = ? WHERE id = ?',
+                                     (record['description'], existing['id']))
+                    category_id = existing['id']
+                    stats['categories_updated'] += 1
+                else:
+                    category_id = conn.execute(
+                        'INSERT INTO categories (name, description) VALUES (?, ?)',
+                        (record['name'], record.get('description') or '')
+                    ).lastrowid
+                    stats['categories_created'] += 1
+                if record.get('id') is not None:
+                    category_mapping[record['id']] = category_id
             
-            # 导入提示词
-            for prompt in data.get('prompts', []):
-                old_category_id = prompt.get('category_id')
-                new_category_id = category_mapping.get(old_category_id) if old_category_id else None
-                
-                self.create_prompt(
-                    title=prompt['title'],
-                    content=prompt['content'],
-                    category_id=new_category_id,
-                    keywords=prompt.get('keywords', '')
-                )
+            elif record_type == 'prompt':
+                if not record.get('title') or not record.get('content'):
+                    stats['skipped'] += 1
+                    continue
+                category_id = category_mapping.get(record.get('category_id'), general_id)
+                keywords = record.get('keywords') or ''
+                existing = conn.execute(
+                    'SELECT id, content, keywords FROM prompts WHERE category_id IS ? AND title = ? LIMIT 1',
+                    (category_id, record['title'])
+                ).fetchone()
+                if existing is None:
+                    conn.execute(
+                        '''INSERT INTO prompts (title, content, category_id, keywords, usage_count, created_at)
+                           VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''',
+                        (record['title'], record['content'], category_id, keywords,
+                         record.get('usage_count') or 0, record.get('created_at'))
+                    )
+                    stats['prompts_created'] += 1
+                elif existing['content'] != record['content'] or (existing['keywords'] or '') != keywords:
+                    conn.execute(
+                        '''UPDATE prompts SET content = ?, keywords = ?, updated_at = CURRENT_TIMESTAMP 
+                           WHERE id = ?''',
+                        (record['content'], keywords, existing['id'])
+                    )
+                    stats['prompts_updated'] += 1
+                else:
+                    stats['prompts_unchanged'] += 1
             
-            return True
+            elif record_type != 'meta':
+                stats['skipped'] += 1
+    
+    @timed
+    def restore_records(self, records: Iterable[Dict], batch_size: int = 1000,
+                        progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+        """从备份记录流恢复数据：每 batch_size 条记录一个事务，返回各类记录的数量"""
+        stats = {
+            'categories_created': 0, 'categories_updated': 0,
+            'prompts_created': 0, 'prompts_updated': 0, 'prompts_unchanged': 0,
+            'skipped': 0,
+        }
+        category_mapping = {None: self.get_category_id('通用')}  # 备份中的分类 id -> 当前 id
+        batch = []
+        try:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    with self.connection() as conn:
+                        self._restore_batch(conn, batch, category_mapping, stats)
+                    batch = []
+                    if progress:
+                        progress(dict(stats))
+            if batch:
+                with self.connection() as conn:
+                    self._restore_batch(conn, batch, category_mapping, stats)
+            return stats
         except Exception as e:
-            print(f"导入数据失败: {e}")
-            return False
+            # 已提交的批次保留
+            print(f"恢复数据失败: {e}")
+            return dict(stats, error=str(e))
 
 
 # 全局数据库实例
@@ -0,0 +1,93 @@
+"""
+提示词模板模块
+模板只解析一次，编译成"文本片段 + 占位符"的列表，按内容哈希缓存；
+渲染时一次 join 完成，不再对整段提示词做多次 str.replace。
+占位符的值可以是函数，只有模板实际用到时才会调用，避免构建用不到的大段上下文。
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, List, Union
+
+
+PROMPT_TEMPLATE_CACHE_SIZE = int(os.environ.get('PROMPT_TEMPLATE_CACHE_SIZE', 256))
+
+PLACEHOLDER_PATTERN = re.compile(r'\{([A-Za-z_][\w-]*)\}')
+
+TemplateValue = Union[str, Callable[[], str]]
+
+
+class CompiledTemplate:
+    def __init__(self, source: str):
+        """解析模板：偶数位置是文本片段，奇数位置是占位符名称"""
+        self.source = source
+        self._segments: List[str] = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(source):
+            self._segments.append(source[position:match.start()])
+            self._segments.append(match.group(1))
+            position = match.end()
+        self._segments.append(source[position:])
+        self.placeholders: FrozenSet[str] = frozenset(self._segments[1::2])
+
+    def uses(self, name: str) -> bool:
+        """模板是否用到某个占位符"""
+        return name in self.placeholders
+
+    def render(self, values: Dict[str, TemplateValue]) -> str:
+        """渲染模板；没有提供值的占位符原样保留，函数值只在用到时调用一次"""
+        resolved = {}
+        parts = []
+        for index, segment in enumerate(self._segments):
+            if index % 2 == 0:
+                parts.append(segment)
+            elif segment in resolved:
+                parts.append(resolved[segment])
+            elif segment in values:
+                value = values[segment]
+                if callable(value):
+                    value = value()
+                resolved[segment] = value
+                parts.append(value)
+            else:
+                parts.append('{' + segment + '}')
+        return ''.join(parts)
+
+
+class TemplateCache:
+    def __init__(self, max_entries: int = PROMPT_TEMPLATE_CACHE_SIZE):
+        self.max_entries = max(1, max_entries)
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source: str) -> CompiledTemplate:
+        """获取编译后的模板，按内容哈希缓存"""
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+
+        template = CompiledTemplate(source)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return template
+
+
+_cache = TemplateCache()
+
+
+def compile_template(source: str) -> CompiledTemplate:
+    """编译（或从缓存获取）模板"""
+    return _cache.get(source)
+
+
+def compile_prompt(prompt: Dict) -> CompiledTemplate:
+    """编译数据库中的提示词；按内容哈希缓存，同一秒内的多次修改也不会命中旧模板"""
+    return _cache.get(prompt['content'])
@@ -0,0 +1,366 @@
+"""
+提示词语义索引模块
+提示词向量按行存放在连续的 float32 矩阵中，磁盘快照用 np.load 内存映射打开，
+查询时一次矩阵-向量乘法（向量已归一化，即余弦相似度）加 argpartition 取 top-k。
+向量由可替换的 embedder 计算：默认是本地确定性的特征哈希（字符 n-gram），不需要网络；
+也可以配置 OpenAI 兼容的 embedding 接口。
+提示词的增删改由数据库触发器写入 prompt_changes 变更日志，索引在查询前按日志增量同步，
+每个 worker 进程各自同步，不需要进程间通信。
+"""
+
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+PROMPT_INDEX_DIM = int(os.environ.get('PROMPT_INDEX_DIM', 128))
+PROMPT_EMBEDDER = os.environ.get('PROMPT_EMBEDDER', 'hashing')
+PROMPT_EMBEDDING_MODEL = os.environ.get('PROMPT_EMBEDDING_MODEL', 'text-embedding-3-small')
+PROMPT_INDEX_SAVE_EVERY = int(os.environ.get('PROMPT_INDEX_SAVE_EVERY', 500))
+PROMPT_CHANGES_RETENTION = float(os.environ.get('PROMPT_CHANGES_RETENTION', 7 * 24 * 3600))
+PROMPT_TEXT_MAX_CHARS = 500
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def prompt_text(prompt: Dict) -> str:
+    """用于计算向量的提示词文本（标题出现两次以提高权重）"""
+    title = prompt.get('title') or ''
+    keywords = prompt.get('keywords') or ''
+    content = (prompt.get('content') or '')[:PROMPT_TEXT_MAX_CHARS]
+    return f"{title}\n{title}\n{keywords}\n{content}"
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行 L2 归一化（全零行保持为零）"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+class HashingEmbedder:
+    """本地特征哈希：英文单词 + 中文字符二元/三元组，带符号哈希到固定维度，次线性词频"""
+
+    def __init__(self, dim: int = PROMPT_INDEX_DIM):
+        self.dim = dim
+        self.name = f'hashing-v1-{dim}'
+        self._bucket = lru_cache(maxsize=1 << 18)(self._hash_feature)
+
+    def _hash_feature(self, feature: str) -> Tuple[int, float]:
+        h = zlib.crc32(feature.encode('utf-8'))
+        return h % self.dim, (1.0 if h & 0x80000000 else -1.0)
+
+    @staticmethod
+    def features(text: str) -> Counter:
+        counts = Counter()
+        for run in _TOKEN_PATTERN.findall(text.lower()):
+            if run.isascii():
+                counts['w:' + run] += 1
+                continue
+            if len(run) == 1:
+                counts[run] += 1
+            for n in (2, 3):
+                for i in range(len(run) - n + 1):
+                    counts[run[i:i + n]] += 1
+        return counts
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            values = [0.0] * self.dim
+            for feature, count in self.features(text).items():
+                index, sign = self._bucket(feature)
+                values[index] += sign * (1.0 + math.log(count))
+            matrix[row] = values
+        return normalize_rows(matrix)
+
+
+class OpenAIEmbedder:
+    """OpenAI 兼容的 embedding 接口（需要网络），按批调用"""
+
+    def __init__(self, api_key: str, base_url: str, model: str = PROMPT_EMBEDDING_MODEL,
+                 batch_size: int = 64):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.model = model
+        self.batch_size = batch_size
+        self.name = f'openai-{model}'
+        self._dim = None
+
+    @property
+    def dim(self) -> int:
+        if self._dim is None:
+            self.embed(['维度探测'])
+        return self._dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(model=self.model, input=texts[start:start + self.batch_size])
+            vectors.extend(item.embedding for item in response.data)
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        self._dim = matrix.shape[1]
+        return normalize_rows(matrix)
+
+
+def create_embedder():
+    """按 PROMPT_EMBEDDER 环境变量创建 embedder（hashing / openai）"""
+    if PROMPT_EMBEDDER == 'openai':
+        return OpenAIEmbedder(
+            api_key=os.environ.get('PROMPT_EMBEDDING_API_KEY') or os.environ.get('OPENAI_API_KEY', ''),
+            base_url=os.environ.get('PROMPT_EMBEDDING_BASE_URL', 'https://api.openai.com/v1'),
+        )
+    return HashingEmbedder()
+
+
+class PromptVectorIndex:
+    def __init__(self, database, path: str, embedder=None, save_every: int = PROMPT_INDEX_SAVE_EVERY):
+        """
+        database: PromptDatabase（提供 iter_prompts / get_prompts_by_ids / 变更日志）
+        path: 快照文件路径前缀，如 /data/prompt_vectors（会生成 .json 和 .npy 文件）
+        """
+        self.database = database
+        self.path = path
+        self.embedder = embedder or create_embedder()
+        self.save_every = save_every
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((0, 0), dtype=np.float32)  # (容量, 维度)
+        self._ids = np.zeros(0, dtype=np.int64)  # 每行的提示词 id，空行为 -1
+        self._categories = np.zeros(0, dtype=np.int64)  # 每行的分类 id，无分类为 -1
+        self._rows: Dict[int, int] = {}  # 提示词 id -> 行号
+        self._free: List[int] = []  # 删除后空出的行
+        self._count = 0  # 已使用的行数上界
+        self._change_id = None  # 已同步到的变更日志 id，None 表示尚未加载
+        self._unsaved = 0
+        self._saving = False
+        atexit.register(self.save)
+
+    # ==================== 存储 ====================
+
+    def _allocate(self, capacity: int, dim: int):
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self._ids = np.full(capacity, -1, dtype=np.int64)
+        self._categories = np.full(capacity, -1, dtype=np.int64)
+        self._rows = {}
+        self._free = []
+        self._count = 0
+
+    def _ensure_capacity(self, rows: int):
+        """容量不足时按倍数扩容（扩容后矩阵在内存中，下次保存快照后重新映射）"""
+        capacity = len(self._ids)
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        matrix = np.zeros((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:self._count] = self._matrix[:self._count]
+        ids = np.full(capacity, -1, dtype=np.int64)
+        ids[:self._count] = self._ids[:self._count]
+        categories = np.full(capacity, -1, dtype=np.int64)
+        categories[:self._count] = self._categories[:self._count]
+        self._matrix, self._ids, self._categories = matrix, ids, categories
+
+    def _upsert(self, prompts: List[Dict]):
+        if not prompts:
+            return
+        vectors = self.embedder.embed([prompt_text(prompt) for prompt in prompts])
+        new_rows = sum(1 for prompt in prompts if prompt['id'] not in self._rows)
+        self._ensure_capacity(self._count + max(0, new_rows - len(self._free)))
+        for prompt, vector in zip(prompts, vectors):
+            row = self._rows.get(prompt['id'])
+            if row is None:
+                if self._free:
+                    row = self._free.pop()
+                else:
+                    row = self._count
+                    self._count += 1
+                self._rows[prompt['id']] = row
+            self._matrix[row] = vector
+            self._ids[row] = prompt['id']
+            self._categories[row] = prompt.get('category_id') or -1
+
+    def _remove(self, prompt_ids: Iterable[int]):
+        for prompt_id in prompt_ids:
+            row = self._rows.pop(prompt_id, None)
+            if row is not None:
+                self._matrix[row] = 0
+                self._ids[row] = -1
+                self._categories[row] = -1
+                self._free.append(row)
+
+    def _rebuild(self):
+        """从数据库全量重建索引"""
+        change_id = self.database.get_last_change_id()  # 重建期间的变更之后会再同步一次
+        self._allocate(0, self.embedder.dim)
+        for prompts in self.database.iter_prompts():
+            self._upsert(prompts)
+        self._change_id = change_id
+        self._unsaved = max(1, self._count)
+        print(f"提示词语义索引已重建: {len(self._rows)} 条, 维度 {self._matrix.shape[1]}")
+
+    # ==================== 快照 ====================
+
+    def _load_snapshot(self) -> bool:
+        """加载磁盘快照（向量矩阵以写时复制方式内存映射），与当前 embedder 不一致时返回 False"""
+        try:
+            with open(self.path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['embedder'] != self.embedder.name:
+                return False
+            directory = os.path.dirname(self.path)
+            matrix = np.load(os.path.join(directory, meta['vectors']), mmap_mode='c')
+            rows = np.load(os.path.join(directory, meta['rows']))
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"加载提示词语义索引快照失败: {e}")
+            return False
+
+        self._matrix, self._ids, self._categories = matrix, rows[0].copy(), rows[1].copy()
+        self._count = meta['count']
+        used = np.flatnonzero(self._ids[:self._count] >= 0)
+        self._rows = dict(zip(self._ids[used].tolist(), used.tolist()))
+        self._free = np.flatnonzero(self._ids[:self._count] < 0).tolist()
+        self._change_id = meta['change_id']
+        return True
+
+    def save(self):
+        """把当前索引写成快照（新文件写完后替换元数据，其他进程读到的始终是完整快照）"""
+        with self._lock:
+            if self._change_id is None or not self._unsaved:
+                return
+            change_id, count = self._change_id, self._count
+            matrix = np.array(self._matrix)
+            rows = np.stack([self._ids, self._categories])
+            self._unsaved = 0
+
+        directory = os.path.dirname(self.path)
+        prefix = os.path.basename(self.path)
+        meta = {
+            'embedder': self.embedder.name,
+            'change_id': change_id,
+            'count': count,
+            'vectors': f'{prefix}.{change_id}.{os.getpid()}.vectors.npy',
+            'rows': f'{prefix}.{change_id}.{os.getpid()}.rows.npy',
+        }
+        try:
+            np.save(os.path.join(directory, meta['vectors']), matrix)
+            np.save(os.path.join(directory, meta['rows']), rows)
+            temp_path = f'{self.path}.json.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(temp_path, self.path + '.json')
+        except OSError as e:
+            print(f"保存提示词语义索引快照失败: {e}")
+            return
+
+        # 清理旧快照文件（已经映射它的进程在关闭前仍可读取）；
+        # 刚写出的文件可能属于正在保存的其他进程，留到下次再清理
+        for name in os.listdir(directory or '.'):
+            if not name.startswith(prefix + '.') or not name.endswith('.npy') or name in (meta['vectors'], meta['rows']):
+                continue
+            file_path = os.path.join(directory, name)
+            try:
+                if time.time() - os.path.getmtime(file_path) > 60:
+                    os.remove(file_path)
+            except OSError:
+                pass
+        self.database.prune_prompt_changes(PROMPT_CHANGES_RETENTION)
+
+    def _save_in_background(self):
+        if self._saving:
+            return
+        self._saving = True
+
+        def run():
+            try:
+                self.save()
+            finally:
+                self._saving = False
+
+        threading.Thread(target=run, name='prompt-index-save', daemon=True).start()
+
+    # ==================== 同步与查询 ====================
+
+    def sync(self):
+        """按变更日志把数据库中的增删改应用到索引（首次调用时加载快照或全量重建）"""
+        with self._lock:
+            if self._change_id is None and not self._load_snapshot():
+                self._rebuild()
+
+            while True:
+                changes = self.database.get_prompt_changes(self._change_id)
+                if not changes:
+                    break
+                if changes[0]['id'] > self._change_id + 1:
+                    # 需要的变更记录已被清理，无法增量同步
+                    self._rebuild()
+                    continue
+                prompt_ids = list(dict.fromkeys(change['prompt_id'] for change in changes))
+                prompts = self.database.get_prompts_by_ids(prompt_ids)
+                found = {prompt['id'] for prompt in prompts}
+                self._upsert(prompts)
+                self._remove(prompt_id for prompt_id in prompt_ids if prompt_id not in found)
+                self._change_id = changes[-1]['id']
+                self._unsaved += len(changes)
+
+            if self._unsaved >= self.save_every:
+                self._save_in_background()
+
+    def warm_up(self):
+        """在后台线程中加载或重建索引，避免第一次查询等待"""
+        threading.Thread(target=self.sync, name='prompt-index-warm-up', daemon=True).start()
+
+    def search(self, query: str, top_k: int = 5, category_id: Optional[int] = None,
+               prompt_ids: Optional[List[int]] = None) -> List[Tuple[int, float]]:
+        """返回与 query 余弦相似度最高的 top_k 个 (提示词 id, 相似度)"""
+        self.sync()
+        vector = self.embedder.embed([query])[0]
+        with self._lock:
+            count = self._count
+            matrix, ids, categories = self._matrix, self._ids, self._categories
+
+        if not count or top_k <= 0:
+            return []
+        # 矩阵乘法在锁外执行（numpy 会释放 GIL），扩容只会替换数组，不影响这里持有的引用
+        scores = matrix[:count] @ vector
+        invalid = ids[:count] < 0
+        if category_id is not None:
+            invalid |= categories[:count] != category_id
+        if prompt_ids is not None:
+            invalid |= ~np.isin(ids[:count], prompt_ids)
+        scores[invalid] = -np.inf
+
+        k = min(top_k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[row]), float(scores[row])) for row in top if scores[row] != -np.inf]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'prompts': len(self._rows),
+                'capacity': len(self._ids),
+                'dim': self._matrix.shape[1] if self._matrix.ndim == 2 else 0,
+                'embedder': self.embedder.name,
+                'change_id': self._change_id,
+            }
+
+
+if __name__ == '__main__':
+    # 离线构建索引快照：python prompt_vectors.py
+    from prompt_database import db
+
+    index = PromptVectorIndex(db, os.path.join(os.path.dirname(os.path.abspath(db.db_path)), 'prompt_vectors'))
+    index.sync()
+    index.save()
+    print(json.dumps(index.stats(), ensure_ascii=False))
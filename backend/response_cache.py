@@ -0,0 +1,171 @@
+"""
+LLM 响应缓存模块
+对确定性较强的接口（章节提示词生成、自动生成提示词等）按请求内容缓存完整结果，
+存放在本地 SQLite（与 prompts.db 放在同一目录），多个 worker 共享。
+流式调用记录所有文本片段，命中时按片段重新输出；只有完整结束的流才会写入缓存。
+每个接口单独设置 TTL，总大小超过上限时淘汰最久未命中的条目。
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from prompt_database import ConnectionPool
+
+
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RESPONSE_CACHE_DEFAULT_TTL = float(os.environ.get('RESPONSE_CACHE_DEFAULT_TTL', 24 * 3600))
+
+# 各接口的缓存时间（秒），可用 RESPONSE_CACHE_TTL_<接口名大写、- 换成 _> 覆盖，设为 0 表示不缓存
+RESPONSE_CACHE_TTLS = {
+    'generate-section-prompt': 7 * 24 * 3600,
+    'auto-generate': 24 * 3600,
+}
+
+
+def endpoint_ttl(endpoint: str) -> float:
+    env_name = 'RESPONSE_CACHE_TTL_' + endpoint.upper().replace('-', '_')
+    return float(os.environ.get(env_name, RESPONSE_CACHE_TTLS.get(endpoint, RESPONSE_CACHE_DEFAULT_TTL)))
+
+
+class CachedStream:
+    """按记录的片段重新输出缓存的流式结果"""
+
+    def __init__(self, chunks: List[str]):
+        self._chunks = iter(chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        return next(self._chunks)
+
+    def close(self):
+        pass
+
+
+class RecordingStream:
+    """包装上游流：透传文本片段，完整结束后把所有片段写入缓存；中途 close() 的不完整结果不写入"""
+
+    def __init__(self, cache: 'ResponseCache', key: str, endpoint: str, upstream):
+        self._cache = cache
+        self._key = key
+        self._endpoint = endpoint
+        self._upstream = upstream
+        self._chunks: List[str] = []
+        self.aborted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        try:
+            chunk = next(self._upstream)
+        except StopIteration:
+            # 上游被关闭（取消生成、客户端断开）时同样以 StopIteration 结束，此时内容不完整
+            if not self.aborted:
+                self._cache.set(self._key, self._endpoint, self._chunks)
+            raise
+        self._chunks.append(chunk)
+        return chunk
+
+    def close(self):
+        # 先标记再关闭：读取线程可能正阻塞在 next() 上，随即收到 StopIteration
+        self.aborted = True
+        if hasattr(self._upstream, 'close'):
+            self._upstream.close()
+
+
+class ResponseCache:
+    def __init__(self, db_path: str, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.pool = ConnectionPool(db_path, max_size=4)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    chunks TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_response_cache_last_hit
+                ON response_cache(last_hit_at)
+            ''')
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """读取未过期的缓存（文本片段列表）"""
+        now = time.time()
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'SELECT chunks FROM response_cache WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row:
+                conn.execute('UPDATE response_cache SET last_hit_at = ? WHERE key = ?', (now, key))
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row['chunks']) if row else None
+
+    def set(self, key: str, endpoint: str, chunks: List[str]):
+        ttl = endpoint_ttl(endpoint)
+        if ttl <= 0 or not chunks:
+            return
+        data = json.dumps(chunks, ensure_ascii=False)
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                conn.execute(
+                    '''INSERT OR REPLACE INTO response_cache (key, endpoint, chunks, size, expires_at, last_hit_at)
+                       VALUES (?, ?, ?, ?, ?, ?)''',
+                    (key, endpoint, data, len(data.encode('utf-8')), now + ttl, now)
+                )
+        except Exception as e:
+            print(f"写入响应缓存失败: {e}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 100 == 0
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        """删除过期条目；总大小超过上限时按最久未命中淘汰，直到降到上限的 90%"""
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) AS total FROM response_cache').fetchone()['total']
+            if total <= self.max_bytes:
+                return
+            excess = total - int(self.max_bytes * 0.9)
+            removed = 0
+            for row in conn.execute('SELECT key, size FROM response_cache ORDER BY last_hit_at').fetchall():
+                if removed >= excess:
+                    break
+                conn.execute('DELETE FROM response_cache WHERE key = ?', (row['key'],))
+                removed += row['size']
+
+    def record(self, key: str, endpoint: str, upstream: Iterator[str]) -> RecordingStream:
+        return RecordingStream(self, key, endpoint, upstream)
+
+    def stats(self) -> Dict:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM response_cache'
+            ).fetchone()
+        with self._lock:
+            return {'entries': row['entries'], 'bytes': row['bytes'], 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,181 @@
+"""
+请求合并模块（single-flight）
+完全相同的 LLM 请求（消息、模型、参数的规范化哈希相同）同时进行时只向上游发起一次：
+- 流式调用：上游结果写入共享缓冲区，每个订阅者从头读取，各自独立迭代
+- 非流式调用：后到的调用等待同一个结果
+请求结束后立即从表中移除（这里只合并进行中的请求，不做结果缓存）。
+所有订阅者都关闭后，取消上游请求。
+"""
+
+import hashlib
+import json
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class Flight:
+    """一次进行中的上游调用：文本片段列表 + 完成状态"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.upstream = None  # 流式调用的上游迭代器（用于取消）
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def append(self, chunk: str):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self.cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+            self.cond.notify_all()
+
+    def result(self) -> str:
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        return ''.join(self.chunks)
+
+
+class FlightStream:
+    """共享缓冲区上的一个订阅者（同步迭代器，可调用 close()）"""
+
+    def __init__(self, group: 'SingleFlight', key: str, flight: Flight):
+        self._group = group
+        self._key = key
+        self._flight = flight
+        self._position = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        flight = self._flight
+        with flight.cond:
+            while self._position >= len(flight.chunks) and not flight.done:
+                flight.cond.wait()
+            if self._position < len(flight.chunks):
+                chunk = flight.chunks[self._position]
+                self._position += 1
+                return chunk
+        self.close()
+        if flight.error is not None:
+            raise flight.error
+        raise StopIteration
+
+    def close(self):
+        """退订；最后一个订阅者退订且上游未结束时取消上游请求"""
+        if not self._closed:
+            self._closed = True
+            self._group._unsubscribe(self._key, self._flight)
+
+
+class SingleFlightCancelled(Exception):
+    """所有订阅者都已退订，上游请求被取消"""
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+        self.started = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(messages: List[Dict[str, str]], model: str, **params) -> str:
+        """规范化键：消息 + 模型 + 参数的哈希（键顺序无关）"""
+        payload = json.dumps([messages, model, params], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _join(self, key: str) -> Tuple[Flight, bool]:
+        """加入进行中的调用；没有时创建，返回 (flight, 是否为发起者)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+                self.started += 1
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+            return flight, leader
+
+    def _remove(self, key: str, flight: Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _unsubscribe(self, key: str, flight: Flight):
+        with self._lock:
+            flight.subscribers -= 1
+            cancel = flight.subscribers <= 0 and not flight.done
+            if cancel:
+                flight.cancelled = True
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+        if cancel:
+            if flight.upstream is not None and hasattr(flight.upstream, 'close'):
+                flight.upstream.close()
+            flight.finish(SingleFlightCancelled('请求已取消'))
+
+    def stream(self, key: str, start: Callable[[], Iterable[str]]) -> FlightStream:
+        """流式调用：发起者在后台线程中读取上游并写入共享缓冲区"""
+        flight, leader = self._join(key)
+        if leader:
+            def pump():
+                try:
+                    flight.upstream = start()
+                    for chunk in flight.upstream:
+                        if flight.cancelled:
+                            break
+                        flight.append(chunk)
+                    flight.finish()
+                except Exception as e:
+                    flight.finish(e)
+                finally:
+                    # 上游迭代器建立之前就被取消时，在这里补上取消
+                    if flight.cancelled and hasattr(flight.upstream, 'close'):
+                        flight.upstream.close()
+                    self._remove(key, flight)
+
+            threading.Thread(target=pump, name='single-flight', daemon=True).start()
+        return FlightStream(self, key, flight)
+
+    def complete(self, key: str, call: Callable[[], str]) -> str:
+        """非流式调用：发起者在当前线程中调用，其他调用者等待同一个结果"""
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                return flight.result()
+            finally:
+                with self._lock:
+                    flight.subscribers -= 1
+
+        try:
+            result = call()
+            flight.append(result)
+            flight.finish()
+            return result
+        except Exception as e:
+            flight.finish(e)
+            raise
+        finally:
+            self._remove(key, flight)
+            with self._lock:
+                flight.subscribers -= 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'in_flight': len(self._flights), 'started': self.started, 'coalesced': self.coalesced}
@@ -0,0 +1,142 @@
+"""
+SSE 编码模块
+把生成缓冲区里的事件编码成 SSE 帧：连续的文本片段按时间窗口或字节阈值合并成一帧，
+一次写出多条消息，空闲时发送心跳注释，避免每个上游片段（常常只有一个汉字）都单独写一次。
+"""
+
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from generation_buffers import GenerationBuffer, GenerationGone
+
+
+SSE_COALESCE_MS = float(os.environ.get('SSE_COALESCE_MS', 40))
+SSE_COALESCE_BYTES = int(os.environ.get('SSE_COALESCE_BYTES', 4096))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+
+HEARTBEAT_FRAME = b': keep-alive\n\n'
+
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class StreamProfile:
+    """单个流式接口的编码参数"""
+
+    def __init__(self, coalesce_ms: float = SSE_COALESCE_MS, coalesce_bytes: int = SSE_COALESCE_BYTES,
+                 heartbeat_seconds: float = SSE_HEARTBEAT_SECONDS):
+        self.window = max(0.0, coalesce_ms) / 1000
+        self.max_bytes = max(1, coalesce_bytes)
+        self.heartbeat = heartbeat_seconds
+
+
+DEFAULT_PROFILE = StreamProfile()
+
+
+def _merge_key(event: Dict) -> Optional[Tuple]:
+    """可以合并的文本事件返回合并键（同一章节的片段才能合并），否则返回 None"""
+    if 'content' not in event:
+        return None
+    if len(event) == 1:
+        return ()
+    if len(event) == 2 and 'section_id' in event:
+        return (event['section_id'],)
+    return None
+
+
+class SSEEncoder:
+    def __init__(self, generation_id: str, profile: StreamProfile = DEFAULT_PROFILE):
+        self.profile = profile
+        self._id_prefix = f'id: {generation_id}:'.encode('ascii')
+        self._events: List[Tuple[int, Dict]] = []
+        self.pending_bytes = 0
+
+    def add(self, seq: int, event: Dict):
+        """加入一个待输出的事件"""
+        self._events.append((seq, event))
+        self.pending_bytes += len(event.get('content') or '') * 3 or 16
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._events)
+
+    def _merge(self) -> List[Dict]:
+        """合并文本片段：非文本事件作为分隔，分隔之间同一章节的片段按原顺序拼接"""
+        messages = []
+        groups = OrderedDict()  # 合并键 -> 片段列表
+        for _, event in self._events:
+            key = _merge_key(event)
+            if key is None:
+                messages.extend(groups.values())
+                groups.clear()
+                messages.append(event)
+            elif key in groups:
+                groups[key]['content'].append(event['content'])
+            else:
+                merged = dict(event)
+                merged['content'] = [event['content']]
+                groups[key] = merged
+        messages.extend(groups.values())
+        for message in messages:
+            if isinstance(message.get('content'), list):
+                message['content'] = ''.join(message['content'])
+        return messages
+
+    def flush(self) -> bytes:
+        """把待输出的事件编码为一次写出的字节串
+
+        只有最后一条消息带 id（本批最大序号），断线重连时从整批之后继续
+        """
+        if not self._events:
+            return b''
+        last_seq = self._events[-1][0]
+        messages = self._merge()
+        frames = [b'data: ' + _json_encode(message).encode('ascii') + b'\n\n' for message in messages[:-1]]
+        frames.append(self._id_prefix + str(last_seq).encode('ascii') + b'\ndata: '
+                      + _json_encode(messages[-1]).encode('ascii') + b'\n\n')
+        self._events = []
+        self.pending_bytes = 0
+        return b''.join(frames)
+
+
+def encode_event(event: Dict) -> bytes:
+    """编码不带 id 的单条消息"""
+    return b'data: ' + _json_encode(event).encode('ascii') + b'\n\n'
+
+
+def iter_sse(buffer: GenerationBuffer, after_seq: int = -1,
+             profile: StreamProfile = DEFAULT_PROFILE) -> Iterator[bytes]:
+    """从缓冲区读取事件，按时间窗口/字节阈值合并后输出 SSE 帧，空闲时输出心跳"""
+    encoder = SSEEncoder(buffer.id, profile)
+    seq = after_seq
+    pending_since = None
+    buffer.subscribe()  # 连接断开时 WSGI 服务器关闭生成器，在 finally 中退订
+    try:
+        while True:
+            if pending_since is None:
+                timeout = profile.heartbeat
+            else:
+                timeout = max(0.0, profile.window - (time.monotonic() - pending_since))
+
+            events, finished = buffer.read_after(seq, timeout=timeout)
+            for seq, event in events:
+                encoder.add(seq, event)
+            if events and pending_since is None:
+                pending_since = time.monotonic()
+
+            if encoder.has_pending:
+                if (finished or encoder.pending_bytes >= profile.max_bytes
+                        or time.monotonic() - pending_since >= profile.window):
+                    yield encoder.flush()
+                    pending_since = None
+            elif not events and not finished:
+                yield HEARTBEAT_FRAME
+
+            if finished and not encoder.has_pending:
+                break
+    except GenerationGone as e:
+        yield encode_event({'error': str(e)})
+    finally:
+        buffer.unsubscribe()
@@ -0,0 +1,134 @@
+"""
+摘要缓存模块
+对 previous_content 摘要调用的结果按内容哈希缓存：内存 LRU + TTL，
+可选 SQLite 持久化层（与 prompts.db 放在同一目录），重启或多个 worker 之间共享
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from prompt_database import ConnectionPool
+
+
+SUMMARY_CACHE_SIZE = int(os.environ.get('SUMMARY_CACHE_SIZE', 1024))
+SUMMARY_CACHE_TTL = float(os.environ.get('SUMMARY_CACHE_TTL', 7 * 24 * 3600))
+SUMMARY_CACHE_DB_MAX_ENTRIES = int(os.environ.get('SUMMARY_CACHE_DB_MAX_ENTRIES', 100000))
+
+
+class SummaryCache:
+    def __init__(self, max_entries: int = SUMMARY_CACHE_SIZE, ttl: float = SUMMARY_CACHE_TTL,
+                 db_path: Optional[str] = None, db_max_entries: int = SUMMARY_CACHE_DB_MAX_ENTRIES):
+        """初始化缓存，db_path 为空时只使用内存层"""
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.db_max_entries = db_max_entries
+        self._entries = OrderedDict()  # key -> (summary, created_at)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        self.pool = ConnectionPool(db_path, max_size=4) if db_path else None
+        if self.pool:
+            self._init_database()
+
+    def _init_database(self):
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS summary_cache (
+                    key TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_summary_cache_created
+                ON summary_cache(created_at)
+            ''')
+
+    @staticmethod
+    def make_key(messages: List[Dict[str, str]], model: str, max_tokens: int) -> str:
+        """缓存键：被摘要的完整输入 + 模型 + max_tokens 的哈希"""
+        payload = json.dumps([messages, model, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，先查内存再查持久化层"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+
+        if self.pool:
+            with self.pool.connection() as conn:
+                row = conn.execute(
+                    'SELECT summary, created_at FROM summary_cache WHERE key = ? AND created_at >= ?',
+                    (key, now - self.ttl)
+                ).fetchone()
+            if row:
+                self._remember(key, row['summary'], row['created_at'])
+                with self._lock:
+                    self.persistent_hits += 1
+                return row['summary']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, summary: str):
+        """写入缓存"""
+        now = time.time()
+        self._remember(key, summary, now)
+
+        if self.pool:
+            with self.pool.connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO summary_cache (key, summary, created_at) VALUES (?, ?, ?)',
+                    (key, summary, now)
+                )
+                with self._lock:
+                    self._writes += 1
+                    need_prune = self._writes % 100 == 0
+                if need_prune:
+                    self._prune(conn, now)
+
+    def _remember(self, key: str, summary: str, created_at: float):
+        with self._lock:
+            self._entries[key] = (summary, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _prune(self, conn, now: float):
+        """清理持久化层中过期和超出容量的条目"""
+        conn.execute('DELETE FROM summary_cache WHERE created_at < ?', (now - self.ttl,))
+        conn.execute(
+            '''DELETE FROM summary_cache WHERE key IN (
+                   SELECT key FROM summary_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+               )''',
+            (self.db_max_entries,)
+        )
+
+    def stats(self) -> Dict:
+        """命中统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'persistent': self.pool is not None,
+            }
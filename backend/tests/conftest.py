@@ -0,0 +1,17 @@
+"""
+测试环境：把 backend 目录加入导入路径，数据库文件（prompts.db 等按当前目录创建）放到临时目录，
+LLM 指向不存在的地址（测试不访问上游）
+"""
+
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix='long-context-tests-')
+os.chdir(WORK_DIR)
+os.environ.setdefault('DEEPSEEK_API_KEY', 'test')
+os.environ.setdefault('DEEPSEEK_BASE_URL', 'http://127.0.0.1:9')
+os.environ.setdefault('METRICS_DIR', os.path.join(WORK_DIR, 'metrics'))
@@ -0,0 +1,55 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.mark.parametrize('field, value', [
+    ('max_parallel', 'abc'),
+    ('max_parallel', None),
+    ('sequential_window', 'x'),
+    ('sequential_window', [1]),
+])
+def test_generate_document_rejects_non_integer_params(client, field, value):
+    response = client.post('/api/generate-document', json={'topic': '主题', 'outline': '## 一\n## 二', field: value})
+    assert response.status_code == 400
+    assert field in response.get_json()['error']
+
+
+@pytest.mark.parametrize('value', ['abc', None, {}])
+def test_generate_section_prompts_rejects_non_integer_max_parallel(client, value):
+    response = client.post('/api/generate-section-prompts', json={'section_titles': ['## 一'], 'max_parallel': value})
+    assert response.status_code == 400
+    assert 'max_parallel' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('field, value', [
+    ('section_hints', ['## 一']),
+    ('section_hints', {'## 一': 1}),
+    ('dependent_sections', 3),
+    ('dependent_sections', ['1']),
+    ('sections', '## 一'),
+    ('prompt_id', 'abc'),
+    ('prompt_id', [1]),
+])
+def test_generate_document_rejects_malformed_fields(client, field, value):
+    response = client.post('/api/generate-document', json={'topic': '主题', 'outline': '## 一\n## 二', field: value})
+    assert response.status_code == 400
+    assert field in response.get_json()['error']
+
+
+def test_custom_template_outline_and_previous_content_fit_budget():
+    from context_budget import SECTION_CONTEXT_TOKENS, count_tokens
+    outline = '\n'.join(f'## 第{i}章 大纲条目' for i in range(3000))
+    previous_content = '已经写好的正文内容。' * 20000
+    messages, _ = app_module.build_section_messages(
+        '主题', outline, '## 第1章', previous_content=previous_content,
+        custom_prompt='大纲：{outline}\n前文：{previous_content}\n请写：{current_section}')
+    prompt = messages[-1]['content']
+    assert count_tokens(prompt) <= SECTION_CONTEXT_TOKENS + 100
+    assert prompt.startswith('大纲：## 第0章')
+    assert '前文：' in prompt and prompt.rstrip().endswith('请写：## 第1章')
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+import pytest
+
+import generation_buffers
+from generation_buffers import GenerationGone, GenerationRegistry, GenerationStore, RemoteGeneration
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return os.path.join(str(tmp_path), 'generations.db')
+
+
+def run_to_end(registry, buffer, events):
+    done = threading.Event()
+
+    def produce():
+        yield from events
+        done.set()
+
+    registry.run(buffer, produce, on_error=lambda e: {'error': str(e)})
+    assert done.wait(5)
+    # 等后台线程写入结束标记
+    for _ in range(100):
+        if buffer.finished:
+            break
+        threading.Event().wait(0.01)
+
+
+def test_second_registry_reads_generation_from_shared_store(store_path):
+    owner = GenerationRegistry(GenerationStore(store_path))
+    other = GenerationRegistry(GenerationStore(store_path))  # 另一个 worker
+
+    buffer = owner.create('edit-selection')
+    buffer.append({'generation_id': buffer.id})
+    run_to_end(owner, buffer, [{'content': '第一段'}, {'content': '第二段'}, {'done': True}])
+    owner.persist()
+
+    remote = other.get(buffer.id)
+    assert isinstance(remote, RemoteGeneration)
+    assert remote.endpoint == 'edit-selection'
+
+    events, finished = remote.read_after(-1, timeout=0)
+    assert finished
+    assert [event for _, event in events] == [
+        {'generation_id': buffer.id}, {'content': '第一段'}, {'content': '第二段'}, {'done': True}]
+
+    # 从断开的位置续读
+    events, finished = remote.read_after(1, timeout=0)
+    assert [seq for seq, _ in events] == [2, 3]
+
+
+def test_remote_reader_sees_events_written_while_running(store_path):
+    owner = GenerationRegistry(GenerationStore(store_path))
+    other = GenerationRegistry(GenerationStore(store_path))
+
+    buffer = owner.create()
+    buffer.append({'content': 'a'})
+    owner.persist()
+    events, finished = other.get(buffer.id).read_after(-1, timeout=0)
+    assert [event for _, event in events] == [{'content': 'a'}]
+    assert not finished
+
+    buffer.append({'content': 'b'})
+    buffer.finish()
+    owner.persist()
+    events, finished = other.get(buffer.id).read_after(0, timeout=0)
+    assert [event for _, event in events] == [{'content': 'b'}]
+    assert finished
+
+
+def test_unknown_or_expired_generation(store_path):
+    owner = GenerationRegistry(GenerationStore(store_path))
+    other = GenerationRegistry(GenerationStore(store_path))
+    assert other.get('missing') is None
+
+    buffer = owner.create()
+    buffer.finish()
+    owner.persist()
+    remote = other.get(buffer.id)
+    owner.store.prune(-1)
+    with pytest.raises(GenerationGone):
+        remote.read_after(-1, timeout=0)
+
+
+def test_cancel_from_second_registry_reaches_owner(store_path):
+    owner = GenerationRegistry(GenerationStore(store_path))
+    other = GenerationRegistry(GenerationStore(store_path))
+
+    buffer = owner.create('generate-section')
+    closed = threading.Event()
+    buffer.on_cancel(closed.set)
+    buffer.append({'content': 'a'})
+    owner.persist()
+
+    assert other.get(buffer.id).cancel('client')
+    assert not other.get(buffer.id).cancel('client')  # 已经登记过
+    assert not buffer.cancelled
+
+    owner.persist()  # 生成所在的 worker 写入事件时检查取消请求
+    assert buffer.cancelled
+    assert closed.is_set()
+
+    buffer.finish()
+    owner.persist()
+    assert not other.get(buffer.id).cancel('client')
+
+
+def wait_until(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def test_reader_resumed_on_second_registry_keeps_generation_alive(store_path, monkeypatch):
+    monkeypatch.setattr(generation_buffers, 'GENERATION_DISCONNECT_GRACE', 0.2)
+    monkeypatch.setattr(generation_buffers, 'GENERATION_READER_HEARTBEAT', 0.1)
+    owner = GenerationRegistry(GenerationStore(store_path))
+    other = GenerationRegistry(GenerationStore(store_path))
+
+    buffer = owner.create('generate-section')
+    buffer.append({'content': 'a'})
+    owner.persist()
+
+    # 客户端从生成所在的 worker 断开，带 Last-Event-ID 重连到另一个 worker
+    buffer.subscribe()
+    buffer.unsubscribe()
+    remote = other.get(buffer.id)
+    remote.subscribe()
+    for _ in range(5):
+        remote.read_after(0, timeout=0.1)  # 读取时刷新登记
+    assert not buffer.cancelled
+
+    remote.unsubscribe()
+    assert wait_until(lambda: buffer.cancelled)
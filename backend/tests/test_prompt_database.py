@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from prompt_database import PromptDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = PromptDatabase(os.path.join(str(tmp_path), 'prompts.db'))
+    category_id = database.get_category_id('章节生成')
+    database.create_prompt('市场分析', '分析市场规模与竞争', category_id, '市场,竞争')
+    database.create_prompt('市场', '介绍市场', category_id, '市场')
+    return database
+
+
+def test_short_keyword_search_returns_match_count_score(db):
+    # 两个汉字的关键词短于 trigram 长度，走 LIKE 回退
+    results = db.search_prompts_by_keywords('市场 竞争')
+    assert [row['title'] for row in results] == ['市场分析', '市场']
+    assert [row['score'] for row in results] == [2, 1]
+
+
+def test_section_match_like_fallback_has_score(db):
+    match, = db.find_best_matches_for_sections(['## 市场 竞争'])
+    assert match['title'] == '市场分析'
+    assert match['score'] == 2
+
+
+def test_get_prompt_includes_unflushed_usage(db):
+    prompt_id = db.search_prompts_by_keywords('市场分析')[0]['id']
+    db.increment_usage(prompt_id)
+    db.increment_usage(prompt_id)
+    assert db.get_prompt(prompt_id)['usage_count'] == 2
+    assert db.get_prompts_by_ids([prompt_id])[0]['usage_count'] == 2
+
+    db.usage.flush()
+    assert db.get_prompt(prompt_id)['usage_count'] == 2
+
+
+def test_mixed_length_keywords_keep_short_term_matches(db):
+    db.create_prompt('竞争分析', '分析竞争对手', db.get_category_id('章节生成'), '竞争分析')
+    # '市场' 短于 trigram 长度，不能因为 '竞争分析' 足够长就被忽略
+    titles = {row['title'] for row in db.search_prompts_by_keywords('市场 竞争分析', limit=10)}
+    assert {'市场', '竞争分析'} <= titles
+
+    # 长词没有命中时，只命中短词的提示词仍然是最佳匹配
+    match, = db.find_best_matches_for_sections(['## 市场 行业格局'])
+    assert match['title'] in ('市场', '市场分析')
+    assert match['score'] == 1
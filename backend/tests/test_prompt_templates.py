@@ -0,0 +1,10 @@
+from prompt_templates import compile_prompt
+
+
+def test_compile_prompt_follows_content_not_updated_at():
+    # 同一秒内修改两次，updated_at 不变
+    prompt = {'id': 1, 'updated_at': '2026-01-01 00:00:00', 'content': '旧模板 {topic}'}
+    assert compile_prompt(prompt).render({'topic': 'x'}) == '旧模板 x'
+
+    prompt = dict(prompt, content='新模板 {topic}')
+    assert compile_prompt(prompt).render({'topic': 'x'}) == '新模板 x'
@@ -0,0 +1,24 @@
+import os
+
+from response_cache import ResponseCache
+
+
+def upstream():
+    yield 'partial '
+    yield 'rest'
+
+
+def test_closed_stream_is_not_cached(tmp_path):
+    cache = ResponseCache(os.path.join(str(tmp_path), 'response_cache.db'))
+    stream = cache.record('key', 'generate-section-prompt', upstream())
+
+    assert next(stream) == 'partial '
+    stream.close()  # 取消生成：上游随后以 StopIteration 结束
+    assert list(stream) == []
+    assert cache.get('key') is None
+
+
+def test_finished_stream_is_cached(tmp_path):
+    cache = ResponseCache(os.path.join(str(tmp_path), 'response_cache.db'))
+    assert ''.join(cache.record('key', 'generate-section-prompt', upstream())) == 'partial rest'
+    assert cache.get('key') == ['partial ', 'rest']
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from upstream_limits import SharedRateLimiter, UpstreamLimits, UpstreamOverloaded
+
+
+def test_refund_runs_off_the_event_loop(tmp_path):
+    rate_limiter = SharedRateLimiter(os.path.join(str(tmp_path), 'rate_limits.db'),
+                                     requests_per_minute=0, tokens_per_minute=1000)
+    refunded = []
+    original = rate_limiter.refund
+
+    def refund(tokens):
+        refunded.append((tokens, threading.get_ident()))
+        original(tokens)
+
+    rate_limiter.refund = refund
+    limits = UpstreamLimits(rate_limiter)
+
+    async def main():
+        async with limits.admit(0, 600) as reserved:
+            limits.refund(reserved, 100)
+        for _ in range(100):
+            if refunded:
+                break
+            await asyncio.sleep(0.01)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert len(refunded) == 1
+    tokens, thread = refunded[0]
+    assert tokens == 500
+    assert thread != loop_thread
+    assert rate_limiter.stats()['tokens'] >= 900
+
+
+def test_fixed_concurrency_keeps_shared_rate_limit(tmp_path):
+    rate_limiter = SharedRateLimiter(os.path.join(str(tmp_path), 'rate_limits.db'),
+                                     requests_per_minute=1, tokens_per_minute=0)
+    limits = UpstreamLimits(rate_limiter, maximum=8, queue_timeout=0.5, adaptive=False)
+    assert limits.concurrency.limit == 8
+    limits.on_overload()
+    limits.on_success(ttft=100)
+    assert limits.concurrency.limit == 8
+
+    async def main():
+        async with limits.admit(0, 10):
+            pass
+        async with limits.admit(0, 10):
+            pass
+
+    with pytest.raises(UpstreamOverloaded):
+        asyncio.run(main())
@@ -0,0 +1,291 @@
+"""
+上游限流模块
+LLM 网关在发起每个上游请求之前经过这里的准入控制：
+- SharedRateLimiter：每分钟请求数 / token 数的令牌桶，状态存放在 SQLite（与 prompts.db 放在同一目录），
+  所有 gunicorn worker 共享同一组桶；token 按"提示词估算 + max_tokens"预扣，拿到实际用量后退还多扣的部分
+- AdaptiveConcurrency：AIMD 方式调整本进程的并发上限，请求成功时缓慢增加，
+  遇到 429 / 超时减半，首 token 时间超过目标值时小幅下调
+- PriorityGate：并发名额不够时按优先级排队（数值越小越优先，同优先级先到先得），
+  交互式编辑优先于批量生成提示词
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from metrics import LLM_QUEUE_SECONDS
+from prompt_database import ConnectionPool
+
+
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get('LLM_REQUESTS_PER_MINUTE', 0))  # 0 表示不限制
+LLM_TOKENS_PER_MINUTE = float(os.environ.get('LLM_TOKENS_PER_MINUTE', 0))
+LLM_MIN_CONCURRENCY = int(os.environ.get('LLM_MIN_CONCURRENCY', 2))
+LLM_INITIAL_CONCURRENCY = int(os.environ.get('LLM_INITIAL_CONCURRENCY', 16))
+LLM_TTFT_TARGET = float(os.environ.get('LLM_TTFT_TARGET', 5))  # 首 token 时间的目标值（秒）
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 120))  # 排队等待的最长时间
+
+# 各接口的优先级（数值越小越优先），没有列出的接口为 PRIORITY_DEFAULT
+PRIORITY_DEFAULT = 2
+ENDPOINT_PRIORITIES = {
+    'edit-selection': 0,
+    'generate-section': 1,
+    'regenerate-section': 1,
+    'generate-outline': 1,
+    'auto-generate': 1,
+    'previous-content-summary': 1,
+    'generate-document': 2,
+    'generate-section-prompt': 3,
+    'document-summary': 3,
+}
+
+
+def endpoint_priority(endpoint: str) -> int:
+    return ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_DEFAULT)
+
+
+class UpstreamOverloaded(Exception):
+    """排队超时（上游持续过载或被限流）"""
+
+
+class SharedRateLimiter:
+    """跨进程共享的令牌桶（每分钟请求数、每分钟 token 数）"""
+
+    def __init__(self, db_path: str, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = LLM_TOKENS_PER_MINUTE):
+        self.buckets: Dict[str, float] = {}  # 桶名 -> 每分钟容量
+        if requests_per_minute > 0:
+            self.buckets['requests'] = requests_per_minute
+        if tokens_per_minute > 0:
+            self.buckets['tokens'] = tokens_per_minute
+        self.pool = ConnectionPool(db_path, max_size=4)
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    name TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.buckets)
+
+    def try_acquire(self, tokens: int) -> float:
+        """尝试扣除 1 个请求和 tokens 个 token；成功返回 0，否则返回需要等待的秒数（不扣除）"""
+        costs = {'requests': 1, 'tokens': tokens}
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')  # 读取和扣除在同一个写事务中，多个进程不会同时扣同一份额度
+            levels: List[Tuple[str, float]] = []
+            wait = 0.0
+            for name, capacity in self.buckets.items():
+                rate = capacity / 60
+                cost = min(costs[name], capacity)  # 单次请求超过容量时按容量计，避免永远等待
+                row = conn.execute('SELECT level, updated_at FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+                level = capacity if row is None else min(capacity, row['level'] + (now - row['updated_at']) * rate)
+                if level < cost:
+                    wait = max(wait, (cost - level) / rate)
+                levels.append((name, level - cost))
+            if wait == 0:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO rate_buckets (name, level, updated_at) VALUES (?, ?, ?)',
+                    [(name, level, now) for name, level in levels]
+                )
+        return wait
+
+    def refund(self, tokens: int):
+        """退还预扣但没有用掉的 token"""
+        if tokens <= 0 or 'tokens' not in self.buckets:
+            return
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE rate_buckets SET level = MIN(level + ?, ?) WHERE name = ?',
+                         (tokens, self.buckets['tokens'], 'tokens'))
+
+    def stats(self) -> Dict:
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT name, level, updated_at FROM rate_buckets').fetchall()
+        now = time.time()
+        return {row['name']: round(min(self.buckets.get(row['name'], 0),
+                                       row['level'] + (now - row['updated_at']) * self.buckets.get(row['name'], 0) / 60), 1)
+                for row in rows if row['name'] in self.buckets}
+
+
+class AdaptiveConcurrency:
+    """AIMD 并发上限：成功时每个"窗口"加 1，过载时按比例下调；adaptive=False 时固定为 maximum"""
+
+    def __init__(self, minimum: int = LLM_MIN_CONCURRENCY, maximum: int = 64,
+                 initial: int = LLM_INITIAL_CONCURRENCY, ttft_target: float = LLM_TTFT_TARGET,
+                 adaptive: bool = True):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial, self.minimum), self.maximum) if adaptive else self.maximum)
+        self.ttft_target = ttft_target
+        self._last_decrease = 0.0
+        self.decreases = 0
+
+    def on_success(self, ttft: Optional[float] = None):
+        if not self.adaptive:
+            return
+        if ttft is not None and self.ttft_target > 0 and ttft > self.ttft_target:
+            self._decrease(0.9)
+            return
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        """429 / 超时：减半"""
+        self._decrease(0.5)
+
+    def _decrease(self, factor: float):
+        if not self.adaptive:
+            return
+        # 同一时刻的多个失败来自同一次过载，一秒内只下调一次
+        now = time.monotonic()
+        if now - self._last_decrease < 1:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+        self.decreases += 1
+
+
+class PriorityGate:
+    """按优先级分配并发名额（在网关的事件循环内使用，不需要加锁）"""
+
+    def __init__(self, concurrency: AdaptiveConcurrency):
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority: int, timeout: Optional[float] = None):
+        self.wake()  # 先清理已取消的等待者、把空出的名额按优先级分给排队的请求
+        if self.in_flight < int(self.concurrency.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if future.done() and not future.cancelled():
+                self.release()  # 名额已经分配给了这个等待者，转交给下一个
+            else:
+                future.cancel()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """并发上限变化或有名额空出时，按优先级唤醒等待者"""
+        while self._waiters and self.in_flight < int(self.concurrency.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def queued(self) -> Dict[int, int]:
+        counts: Dict[int, int] = {}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                counts[priority] = counts.get(priority, 0) + 1
+        return counts
+
+
+class UpstreamLimits:
+    """网关使用的准入控制：先在优先级队列中拿到并发名额，再从共享令牌桶扣除额度"""
+
+    def __init__(self, rate_limiter: Optional[SharedRateLimiter] = None, maximum: int = 64,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT, adaptive: bool = True):
+        """adaptive=False 时并发上限固定为 maximum，优先级排队和共享令牌桶照常生效"""
+        self.rate_limiter = rate_limiter if rate_limiter is not None and rate_limiter.enabled else None
+        self.concurrency = AdaptiveConcurrency(maximum=maximum, adaptive=adaptive)
+        self.queue_timeout = queue_timeout
+        self._gate: Optional[PriorityGate] = None
+        self._gate_loop = None
+
+    def gate(self) -> PriorityGate:
+        """队列绑定在网关的事件循环上（fork 之后网关会新建事件循环）"""
+        loop = asyncio.get_running_loop()
+        if self._gate_loop is not loop:
+            self._gate = PriorityGate(self.concurrency)
+            self._gate_loop = loop
+        return self._gate
+
+    @asynccontextmanager
+    async def admit(self, priority: int, tokens: int):
+        """准入上下文：退出时归还并发名额；yield 出预扣的 token 数"""
+        gate = self.gate()
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        try:
+            await gate.acquire(priority, self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamOverloaded('上游繁忙，排队超时')
+        try:
+            if self.rate_limiter is not None:
+                while True:
+                    wait = await asyncio.get_running_loop().run_in_executor(
+                        None, self.rate_limiter.try_acquire, tokens)
+                    if wait <= 0:
+                        break
+                    if time.monotonic() + wait > deadline:
+                        raise UpstreamOverloaded('超出每分钟请求数 / token 数限制')
+                    await asyncio.sleep(min(wait, 5))
+            LLM_QUEUE_SECONDS.observe(time.monotonic() - started, priority=priority)
+            yield tokens
+        finally:
+            gate.release()
+
+    def refund(self, reserved: int, used: int):
+        """退还多扣的 token；在事件循环中调用时放到线程池写 SQLite，不阻塞网关的事件循环"""
+        if self.rate_limiter is None or reserved <= used:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._refund(reserved - used)
+            return
+        loop.run_in_executor(None, self._refund, reserved - used)
+
+    def _refund(self, tokens: int):
+        try:
+            self.rate_limiter.refund(tokens)
+        except Exception as e:
+            print(f"退还 token 额度失败: {e}")
+
+    def on_success(self, ttft: Optional[float] = None):
+        self.concurrency.on_success(ttft)
+        self._wake()
+
+    def on_overload(self):
+        self.concurrency.on_overload()
+
+    def congested(self) -> bool:
+        """是否有请求在排队等待并发名额"""
+        return self._gate is not None and bool(self._gate.queued())
+
+    def _wake(self):
+        if self._gate is not None:
+            self._gate.wake()
+
+    def stats(self) -> Dict:
+        gate = self._gate
+        stats = {
+            'concurrency_limit': round(self.concurrency.limit, 2),
+            'adaptive': self.concurrency.adaptive,
+            'decreases': self.concurrency.decreases,
+            'in_flight': gate.in_flight if gate else 0,
+            'queued': gate.queued() if gate else {},
+        }
+        if self.rate_limiter is not None:
+            stats['buckets'] = self.rate_limiter.stats()
+        return stats
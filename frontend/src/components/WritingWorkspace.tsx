@@ -373,6 +373,8 @@ const WritingWorkspace: React.FC<WritingWorkspaceProps> = ({
           previous_content: currentContent,
           custom_prompt: sectionPrompt !== DEFAULT_SECTION_PROMPT ? sectionPrompt : '',
           section_hint: sectionHint,
+          document_id: document.id,
+          section_index: sectionIndex,
         }),
       });
 
@@ -489,6 +491,8 @@ const WritingWorkspace: React.FC<WritingWorkspaceProps> = ({
             previous_content: accumulatedContent,
             custom_prompt: sectionPrompt !== DEFAULT_SECTION_PROMPT ? sectionPrompt : '',
             section_hint: sectionHint,
+            document_id: document.id,
+            section_index: i,
           }),
         });
 